@@ -1,3 +1,6 @@
+import hashlib
+import hmac
+import json
 import os
 import logging
 import pytz
@@ -5,11 +8,16 @@ import controller
 from spotipy.oauth2 import SpotifyOauthError
 from clients.spotify_client import SpotifyClient, SpotifyForbiddenException, DEFAULT_TRACKS_PER_YEAR
 from datetime import datetime, timedelta
-from dotenv import load_dotenv
-from flask import Flask, render_template, request, redirect, session
-from clients.monitoring_client import GoogleMonitoringClient
+from flask import (
+    Flask, render_template, request, redirect, session, jsonify, make_response, Response, stream_with_context, g
+)
+from flask_session import Session
+from markupsafe import Markup
+from clients.monitoring_client import GoogleMonitoringClient, PROMETHEUS_METRICS, PROMETHEUS_METRICS_TOKEN
+from clients import tracing
+from clients.log_events import start_request_log, end_request_log, log_request_summary, set_request_fields
+from clients.profiling import profiled, PROFILE_HEADER
 
-load_dotenv()
 app = Flask(__name__)
 
 logging.basicConfig(level=logging.INFO)
@@ -18,15 +26,201 @@ logger = logging.getLogger(__name__)
 app.secret_key = os.getenv("SESSION_SECRET_KEY")
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=25)
 
+# Session data is kept server-side and the cookie only holds the session ID. Set SESSION_TYPE=cookie to keep the
+# session in Flask's signed cookie or SESSION_TYPE=redis with SESSION_REDIS_URL to share sessions between instances.
+SESSION_TYPE = os.getenv("SESSION_TYPE", "filesystem")
+if SESSION_TYPE != "cookie":
+    app.config["SESSION_TYPE"] = SESSION_TYPE
+    app.config["SESSION_KEY_PREFIX"] = "lasthop:"
+    if SESSION_TYPE == "filesystem":
+        app.config["SESSION_FILE_DIR"] = os.getenv("SESSION_FILE_DIR") or os.path.join(
+            os.getcwd(), "local_cache", "sessions"
+        )
+        app.config["SESSION_FILE_THRESHOLD"] = int(os.getenv("SESSION_FILE_THRESHOLD") or 1000)
+    elif SESSION_TYPE == "redis":
+        import redis
+        app.config["SESSION_REDIS"] = redis.from_url(os.getenv("SESSION_REDIS_URL", "redis://localhost:6379"))
+    Session(app)
+
+def get_profile_secret() -> str:
+    return request.headers.get(PROFILE_HEADER)
+
+
+@app.before_request
+def start_trace():
+    if request.endpoint != "static" and tracing.should_trace():
+        g.trace_token = tracing.start_trace(f"{request.method} {request.path}")
+
+
+@app.after_request
+def finish_trace(response):
+    token = g.pop("trace_token", None)
+    if token:
+        if response.is_streamed:
+            # A streamed body, e.g. /stats/stream, is generated after this, so end the trace once it's been sent
+            response.call_on_close(lambda: end_and_write_trace(token))
+        else:
+            end_and_write_trace(token, response)
+    return response
+
+
+def end_and_write_trace(token, response: Response = None):
+    trace = tracing.end_trace(token)
+    logger.info(f"Trace:\n{trace.waterfall()}")
+    if response is not None and tracing.TRACE_HEADER:
+        response.headers["Server-Timing"] = trace.server_timing()
+    tracing.write_trace(trace)
+
+
+@app.teardown_request
+def discard_trace(exception=None):
+    # after_request doesn't run if the request raised, and the thread's context outlives the request
+    token = g.pop("trace_token", None)
+    if token:
+        tracing.end_trace(token)
+
+
+@app.before_request
+def start_log_summary():
+    g.request_log_token = start_request_log(f"{request.method} {request.path}")
+
+
+@app.after_request
+def log_summary(response):
+    token = g.pop("request_log_token", None)
+    if token:
+        if response.is_streamed:
+            # Like the trace, log the summary once the streamed body has been sent, so it counts the whole request
+            response.call_on_close(
+                lambda: log_request_summary(logger, end_request_log(token), status=response.status_code)
+            )
+        else:
+            log_request_summary(logger, end_request_log(token), status=response.status_code)
+    return response
+
+
+@app.teardown_request
+def discard_log_summary(exception=None):
+    token = g.pop("request_log_token", None)
+    if token:
+        end_request_log(token)
+
+
+@app.after_request
+def record_header_bytes(response):
+    if request.endpoint == "static":
+        return response
+    request_header_bytes = sum(len(k) + len(v) + 4 for k, v in request.headers.items())
+    response_header_bytes = sum(len(k) + len(v) + 4 for k, v in response.headers.items())
+    logger.debug(f"Header bytes: request {request_header_bytes} response {response_header_bytes}")
+    GoogleMonitoringClient().time_series_thread("request-header-bytes", request_header_bytes)
+    GoogleMonitoringClient().time_series_thread("response-header-bytes", response_header_bytes)
+    return response
+
+
+STREAM_STATS = os.getenv("STREAM_STATS", "false").lower() == "true"
+
+# view: (template for all years, template for a single year)
+STATS_FRAGMENT_TEMPLATES = {
+    "top_artist": ("partials/stats/_stats_top_artist_view.html", "partials/stats/_stats_top_artist_year.html"),
+    "chronological": (
+        "partials/stats/_stats_chronological_view.html", "partials/stats/_stats_chronological_year.html"
+    ),
+    "clipboard": ("partials/stats/_stats_clipboard.html", None),
+}
+
+
+def get_local_today(tz_offset: int) -> datetime:
+    return (datetime.utcnow()).replace(tzinfo=pytz.UTC) - timedelta(minutes=tz_offset)
+
+
+def render_stats_fragment(stats: list, lastfm_user_data: dict, tz_offset: int, view: str, year: int = None) -> Markup:
+    """
+    Render one view of the stats, for all years or a single year
+    """
+    view_template, year_template = STATS_FRAGMENT_TEMPLATES[view]
+    today = get_local_today(tz_offset)
+    if year is None:
+        return Markup(render_template(view_template, stats=stats, lastfm_user_data=lastfm_user_data, today=today))
+    year_data = next((year_data for year_data in stats or [] if year_data["day"].year == year), None)
+    if year_data and year_template:
+        return Markup(render_template(year_template, year_data=year_data, lastfm_user_data=lastfm_user_data,
+                                      today=today))
+
+
+def get_stats_etag(username: str, tz_offset: int, date_cached: datetime, *args) -> str:
+    """
+    Identifies a response built from the user's stats, which only change when the stats are re-fetched
+    """
+    today = get_local_today(tz_offset)
+    return hashlib.md5(repr((username, tz_offset, today.date(), date_cached) + args).encode()).hexdigest()
+
+
+def get_playlist_bounds(stats: list) -> (int, int, int):
+    """
+    :return: (min_tracks_per_year, max_tracks_per_year, default_tracks_per_year) for the playlist options
+    """
+    max_tracks_per_year = SpotifyClient.get_max_tracks_per_year(stats)
+    return 1, max_tracks_per_year, min(max_tracks_per_year, DEFAULT_TRACKS_PER_YEAR)
+
+
+def summarize_stats(stats: list, lastfm_user_data: dict, stats_page: dict) -> dict:
+    """
+    The /api/stats response body
+    """
+    date_cached = stats_page["date_cached"]
+    result = {
+        "username": lastfm_user_data["username"],
+        "date_cached": date_cached.isoformat() if date_cached else None,
+        "partial": stats_page["partial"],
+        "failed": stats_page["failed"],
+        "years": [
+            {
+                "year": year_data["day"].year,
+                "day": year_data["day"].strftime("%Y-%m-%d"),
+                "scrobbles": len(year_data["scrobble_list"]),
+                "top_artist": year_data["data"][0]["artist"],
+                "tag": year_data["data"][0].get("tag"),
+                "artists": [
+                    {"artist": artist_data["artist"], "playcount": artist_data["track_data"]["playcount"]}
+                    for artist_data in year_data["data"]
+                ],
+            }
+            for year_data in stats if year_data["data"]
+        ],
+    }
+    if stats:
+        result["min_tracks_per_year"], result["max_tracks_per_year"], result["default_tracks_per_year"] = (
+            get_playlist_bounds(stats)
+        )
+    return result
+
+
+def server_sent_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def get_playlist_options(form) -> dict:
+    playlist_opt_skip_recent = bool(form.get("playlist_opt_skip_recent"))
+    playlist_opt_skip_recent_time = form.get("playlist_opt_skip_recent_time")
+    return {
+        "playlist_tracks_per_year": int(form.get("playlist_opt_tracks_per_year")),
+        "playlist_order_recent_first": bool(form.get("playlist_opt_order_recent_first")),
+        "playlist_repeat_artists": bool(form.get("playlist_opt_repeat_artists")),
+        "playlist_skip_recent_time": playlist_opt_skip_recent_time if playlist_opt_skip_recent else None,
+    }
+
+
 @app.route("/", methods=["POST", "GET"])
+@profiled("index", get_profile_secret)
 def index():
     session.permanent = True
-    start_time = datetime.now()
     lastfm_user_data = None
     username = None
     message = None
     playlist_url = None
-    stats = None
+    has_stats = False
+    stats_fragments = None
     tz_offset = 0
     tz = None
     auth_url = None
@@ -35,6 +229,9 @@ def index():
     spotify_authorized = False
 
     no_data_today = None
+    stream_stats = False
+    stats_partial = False
+    stats_failed = False
 
     min_tracks_per_year, max_tracks_per_year, default_tracks_per_year = None, None, None
 
@@ -99,12 +296,6 @@ def index():
                     username = session["username"] = lastfm_user_data["username"]
 
             if request.form.get("make_playlist") and lastfm_user_data:
-                playlist_opt_tracks_per_year = int(request.form.get("playlist_opt_tracks_per_year"))
-                playlist_opt_order_recent_first = bool(request.form.get("playlist_opt_order_recent_first"))
-                playlist_opt_repeat_artists = bool(request.form.get("playlist_opt_repeat_artists"))
-                playlist_opt_skip_recent = bool(request.form.get("playlist_opt_skip_recent"))
-                playlist_opt_skip_recent_time = request.form.get("playlist_opt_skip_recent_time")
-                playlist_opt_skip_recent_time = playlist_opt_skip_recent_time if playlist_opt_skip_recent else None
                 spotify_available_market = controller.get_spotify_available_market_from_timezone(tz)
                 spotify_client = SpotifyClient(session=session, available_market=spotify_available_market,
                                                tz_offset=tz_offset)
@@ -112,11 +303,8 @@ def index():
                 playlist_id, playlist_url = controller.make_playlist(
                     spotify_client=spotify_client,
                     lastfm_user_data=lastfm_user_data,
-                    playlist_tracks_per_year=playlist_opt_tracks_per_year,
-                    playlist_order_recent_first=playlist_opt_order_recent_first,
-                    playlist_repeat_artists=playlist_opt_repeat_artists,
-                    playlist_skip_recent_time=playlist_opt_skip_recent_time,
                     tz_offset=tz_offset,
+                    **get_playlist_options(request.form),
                 )
                 session["playlist_url"] = playlist_url
 
@@ -126,14 +314,26 @@ def index():
                     f"{username} has been on Last.fm since "
                     f"{datetime.strftime(lastfm_user_data.get('join_date').date(), '%-d %B %Y')}"
                 )
-                stats, date_cached = controller.get_stats(lastfm_user_data, tz_offset)
-                if stats:
-                    min_tracks_per_year = 1
-                    max_tracks_per_year = SpotifyClient.get_max_tracks_per_year(stats)
-                    default_tracks_per_year = min(max_tracks_per_year, DEFAULT_TRACKS_PER_YEAR)
+                if STREAM_STATS and not controller.is_stats_cached(lastfm_user_data, tz_offset):
+                    stream_stats = True
                 else:
-                    no_data_today = True
-                    # message = f"{username} has no listening data for today"
+                    stats_page = controller.get_stats_page(lastfm_user_data, tz_offset)
+                    has_stats, date_cached = stats_page["has_stats"], stats_page["date_cached"]
+                    stats_partial = stats_page["partial"]
+                    stats_failed = stats_page["failed"]
+                    if has_stats:
+                        stats_fragments = {"top_artist": controller.get_stats_fragment(
+                            stats_page, ("top_artist", None),
+                            lambda _stats: render_stats_fragment(_stats, lastfm_user_data, tz_offset, "top_artist"),
+                            lastfm_user_data, tz_offset
+                        )}
+                        min_tracks_per_year, max_tracks_per_year, default_tracks_per_year = (
+                            controller.get_stats_fragment(stats_page, ("playlist_bounds", None), get_playlist_bounds,
+                                                          lastfm_user_data, tz_offset)
+                        )
+                    elif not stats_partial and not stats_failed:
+                        no_data_today = True
+                        # message = f"{username} has no listening data for today"
 
                 if not auth_url and not playlist_url:
                     spotify_auth_manager = SpotifyClient.get_auth_manager(session)
@@ -141,48 +341,49 @@ def index():
                     session["auth_url"] = auth_url
             else:
                 message = f"{username} not found on Last.fm"
-        logger.info(f"Total time: {(datetime.now() - start_time).seconds} seconds)")
     except SpotifyOauthError:
         session["access_token"] = None
         session["auth_url"] = None
         spotify_authorized = False
-        logger.exception(
-            f"SpotifyOauthError Exception occurred. username:{username} lastfm_user_data:{lastfm_user_data} "
-            f"tz:{tz} tz_offset:{tz_offset}"
-        )
+        logger.exception("SpotifyOauthError Exception occurred. username:%s tz:%s tz_offset:%s",
+                         username, tz, tz_offset)
         # message = "There was an error authorizing Spotify - Please try again"
         GoogleMonitoringClient().increment_thread("spotify-oath-exception")
     except SpotifyForbiddenException:
         session["access_token"] = None
         session["auth_url"] = None
         spotify_authorized = False
-        logger.exception(
-            f"SpotifyForbiddenException Exception occurred. username:{username} lastfm_user_data:{lastfm_user_data}"
-            f" tz:{tz} tz_offset:{tz_offset}"
-        )
+        logger.exception("SpotifyForbiddenException Exception occurred. username:%s tz:%s tz_offset:%s",
+                         username, tz, tz_offset)
         # message = "Please authorize Spotify to create a playlist"
     except:
         session["access_token"] = None
         session["auth_url"] = None
         spotify_authorized = False
-        logger.exception(
-            f"Unhandled Exception occurred. username:{username} lastfm_user_data:{lastfm_user_data} "
-            f"tz:{tz} tz_offset:{tz_offset}"
-        )
+        logger.exception("Unhandled Exception occurred. username:%s tz:%s tz_offset:%s", username, tz, tz_offset)
         message = "Something went wrong :("
         GoogleMonitoringClient().increment_thread("unhandled-exception")
 
-    logger.info(f"Response message: {message} Referer:{request.referrer}")
-    logger.info(f"{username} User-Agent: {request.headers.get('User-Agent')}")
-    today = (datetime.utcnow()).replace(tzinfo=pytz.UTC) - timedelta(minutes=tz_offset)
+    set_request_fields(username=username, message=message, referrer=request.referrer,
+                       user_agent=request.headers.get("User-Agent"))
+    today = get_local_today(tz_offset)
 
-    return render_template(
+    etag = None
+    if request.method == "GET" and has_stats and not stats_partial and not stats_failed:
+        etag = get_stats_etag(username, tz_offset, date_cached, playlist_url, auth_url, spotify_authorized, message)
+        if request.if_none_match.contains(etag):
+            response = make_response("", 304)
+            response.set_etag(etag)
+            return response
+
+    response = make_response(render_template(
         "index.html",
         lastfm_user_data=lastfm_user_data,
         playlist_url=playlist_url,
         message=message,
         auth_url=auth_url,
-        stats=stats,
+        stats=has_stats,
+        stats_fragments=stats_fragments,
         date_cached=date_cached,
         today=today,
         min_tracks_per_year=min_tracks_per_year,
@@ -190,4 +391,159 @@ def index():
         default_tracks_per_year=default_tracks_per_year,
         no_data_today=no_data_today,
         spotify_authorized=spotify_authorized,
+        stream_stats=stream_stats,
+        stats_partial=stats_partial,
+        stats_failed=stats_failed,
+    ))
+    if etag:
+        response.set_etag(etag)
+        response.last_modified = date_cached + timedelta(minutes=tz_offset)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+
+@app.route("/warmup")
+def warmup():
+    """
+    Call on a new instance before it takes traffic (e.g. as the startup probe), so the first user doesn't pay for
+    connecting to the database and compiling the templates
+    """
+    start_time = datetime.now()
+    controller.warm_up()
+    for template_name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template_name)
+    logger.info(f"Warm-up took {(datetime.now() - start_time).total_seconds()} seconds")
+    return "", 204
+
+
+@app.route("/metrics")
+def metrics():
+    """
+    Counters, gauges and timing histograms since the process started, in Prometheus text format
+    """
+    if not PROMETHEUS_METRICS:
+        return "", 404
+    if PROMETHEUS_METRICS_TOKEN and not hmac.compare_digest(
+            request.headers.get("Authorization", "").encode(), f"Bearer {PROMETHEUS_METRICS_TOKEN}".encode()):
+        return "", 401
+    return Response(GoogleMonitoringClient().prometheus_text(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/stats")
+@profiled("api_stats", get_profile_secret)
+def api_stats():
+    """
+    A compact summary of the user's stats for today: the artists and playcounts for each year.
+    With ?poll=true, only checks on the years still being fetched from Last.fm instead of waiting for them.
+    """
+    lastfm_user_data = session.get("lastfm_user_data")
+    if not lastfm_user_data:
+        return jsonify({"years": []}), 401
+    tz_offset = session.get("tz_offset", 0)
+    stats_page = controller.get_stats_page(lastfm_user_data, tz_offset,
+                                           poll=request.args.get("poll", "false").lower() == "true")
+    summary = controller.get_stats_fragment(
+        stats_page, ("api", None),
+        lambda _stats: json.dumps(summarize_stats(_stats or [], lastfm_user_data, stats_page)),
+        lastfm_user_data, tz_offset
+    )
+    response = app.response_class(summary, mimetype="application/json")
+    response.set_etag(get_stats_etag(lastfm_user_data["username"], tz_offset, stats_page["date_cached"], "api"))
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route("/api/stats/<view>")
+@profiled("api_stats_fragment", get_profile_secret)
+def api_stats_fragment(view: str):
+    """
+    One view of the stats page as HTML, for all years or the year in the "year" query parameter
+    """
+    lastfm_user_data = session.get("lastfm_user_data")
+    if not lastfm_user_data:
+        return "", 401
+    if view not in STATS_FRAGMENT_TEMPLATES:
+        return "", 404
+    year = request.args.get("year", type=int)
+    tz_offset = session.get("tz_offset", 0)
+    stats_page = controller.get_stats_page(lastfm_user_data, tz_offset)
+    fragment = controller.get_stats_fragment(
+        stats_page, (view, year),
+        lambda _stats: render_stats_fragment(_stats, lastfm_user_data, tz_offset, view, year),
+        lastfm_user_data, tz_offset
     )
+    if fragment is None:
+        return "", 404
+    response = make_response(fragment)
+    response.set_etag(get_stats_etag(lastfm_user_data["username"], tz_offset, stats_page["date_cached"], view, year))
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route("/stats/stream")
+def stats_stream():
+    """
+    Server-sent events with the rendered summary of each year as soon as it is available, then the playlist options
+    """
+    lastfm_user_data = session.get("lastfm_user_data")
+    if not lastfm_user_data:
+        return "", 401
+    tz_offset = session.get("tz_offset", 0)
+    today = get_local_today(tz_offset)
+
+    def _generate():
+        stats = []
+        for year_data in controller.iter_stats(lastfm_user_data, tz_offset):
+            stats.append(year_data)
+            html = render_template("partials/stats/_stats_top_artist_year.html", year_data=year_data,
+                                   lastfm_user_data=lastfm_user_data, today=today)
+            yield server_sent_event("year", {"year": year_data["day"].year, "html": html})
+        done = {"years": len(stats)}
+        if stats:
+            done["min_tracks_per_year"], done["max_tracks_per_year"], done["default_tracks_per_year"] = (
+                get_playlist_bounds(stats)
+            )
+        yield server_sent_event("done", done)
+
+    return Response(stream_with_context(_generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route("/playlist/preview", methods=["POST"])
+@profiled("playlist_preview", get_profile_secret)
+def playlist_preview():
+    lastfm_user_data = session.get("lastfm_user_data")
+    if not lastfm_user_data or not session.get("access_token"):
+        return jsonify({"tracks": []}), 401
+    tz_offset = session.get("tz_offset", 0)
+    try:
+        spotify_client = SpotifyClient(
+            session=session,
+            available_market=controller.get_spotify_available_market_from_timezone(session.get("tz")),
+            tz_offset=tz_offset,
+        )
+        tracks = controller.preview_playlist(
+            spotify_client=spotify_client,
+            lastfm_user_data=lastfm_user_data,
+            tz_offset=tz_offset,
+            **get_playlist_options(request.form),
+        )
+    except SpotifyOauthError:
+        session["access_token"] = None
+        session["auth_url"] = None
+        logger.exception(f"SpotifyOauthError Exception occurred previewing playlist for {session.get('username')}")
+        return jsonify({"tracks": [], "error": "Please authorize Spotify to preview a playlist"}), 401
+    except SpotifyForbiddenException:
+        session["access_token"] = None
+        session["auth_url"] = None
+        logger.exception(f"SpotifyForbiddenException Exception occurred previewing playlist for "
+                         f"{session.get('username')}")
+        return jsonify({"tracks": [], "error": "Please authorize Spotify to preview a playlist"}), 403
+    except Exception:
+        logger.exception(f"Unhandled Exception occurred previewing playlist for {session.get('username')}")
+        GoogleMonitoringClient().increment_thread("unhandled-exception")
+        return jsonify({"tracks": [], "error": "Something went wrong :("}), 500
+    return jsonify({"tracks": tracks})
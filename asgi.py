@@ -0,0 +1,189 @@
+"""
+ASGI entry point, as an alternative to serving app:app with gunicorn threads:
+
+    uvicorn asgi:app --workers 1 --port 8080
+
+Requests are still handled by the Flask app, on a pool of ASYNC_WSGI_THREADS threads. Before a request to the index
+flow is handed over, the Last.fm stats and Spotify searches it will need are fetched on the event loop and cached, so a
+request waiting on Last.fm or Spotify doesn't hold one of the threads.
+"""
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import aiohttp
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from flask import request, session
+from werkzeug.test import EnvironBuilder
+
+import controller
+from app import app as flask_app, STREAM_STATS, get_playlist_options
+from clients import run_in_thread
+from clients.async_spotify_client import AsyncSpotifyClient
+from clients.monitoring_client import GoogleMonitoringClient
+
+logger = logging.getLogger(__name__)
+
+ASYNC_WSGI_THREADS = int(os.getenv("ASYNC_WSGI_THREADS") or 20)
+# Playlists aren't prefetched with a Spotify token that expires sooner than this, as a refreshed token can't be saved
+PREFETCH_TOKEN_MIN_SECONDS = 300
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    """
+    WsgiToAsgi that runs requests on a pool of threads. WsgiToAsgi runs every request on one shared thread, so a slow
+    request (e.g. a playlist build or /stats/stream) would hold up all the others.
+    """
+
+    def __init__(self, wsgi_application, max_workers: int):
+        super().__init__(wsgi_application)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="wsgi")
+
+    async def __call__(self, scope, receive, send):
+        await ThreadedWsgiToAsgiInstance(self.wsgi_application, self.executor)(scope, receive, send)
+
+
+class ThreadedWsgiToAsgiInstance(WsgiToAsgiInstance):
+    def __init__(self, wsgi_application, executor: ThreadPoolExecutor):
+        super().__init__(wsgi_application)
+        self.executor = executor
+
+    async def run_wsgi_app(self, body):
+        # The base class's run_wsgi_app is wrapped with the thread sensitive sync_to_async, so run what it wraps
+        run_wsgi_app = WsgiToAsgiInstance.__dict__["run_wsgi_app"].func
+        await sync_to_async(run_wsgi_app, thread_sensitive=False, executor=self.executor)(self, body)
+
+
+class AsyncIndexApp:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.asgi_app = ThreadedWsgiToAsgi(wsgi_app, ASYNC_WSGI_THREADS)
+        self.http_session = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] == "http" and self.is_index_flow(scope["path"]):
+            body = await self.read_body(receive)
+            try:
+                await self.prefetch(scope, body)
+            except Exception:
+                GoogleMonitoringClient().increment_thread("async-prefetch-exception")
+                logger.exception(f"Unhandled exception prefetching {scope['method']} {scope['path']}")
+            receive = self.replay_body(body)
+        await self.asgi_app(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.get_http_session()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.http_session:
+                    await self.http_session.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def get_http_session(self) -> aiohttp.ClientSession:
+        if not self.http_session:
+            self.http_session = aiohttp.ClientSession()
+        return self.http_session
+
+    @staticmethod
+    def is_index_flow(path: str) -> bool:
+        return path in ("/", "/playlist/preview") or path.startswith("/api/stats")
+
+    async def prefetch(self, scope: dict, body: bytes):
+        """
+        Fetch what the Flask app will need for this request: the user's stats, and the playlist's tracks when one is
+        being previewed or made
+        """
+        prefetch_request = await run_in_thread(self.read_request, scope, body)
+        if not prefetch_request:
+            return
+        method, path, form, user_session = prefetch_request
+        lastfm_user_data = user_session.get("lastfm_user_data")
+        tz_offset = user_session.get("tz_offset", 0)
+        tz = user_session.get("tz")
+        if method == "POST" and path == "/":
+            if form.get("tz_offset"):
+                tz_offset = int(form["tz_offset"])
+            if form.get("tz"):
+                tz = form["tz"]
+            if form.get("username"):
+                lastfm_user_data = await run_in_thread(controller.get_lastfm_user_info, form["username"])
+        if not lastfm_user_data or not lastfm_user_data.get("username"):
+            return
+
+        http_session = self.get_http_session()
+        if method == "POST" and (form.get("make_playlist") or path == "/playlist/preview"):
+            if self.has_fresh_spotify_token(user_session):
+                spotify_client = AsyncSpotifyClient(
+                    http_session, session=user_session, tz_offset=tz_offset,
+                    available_market=controller.get_spotify_available_market_from_timezone(tz),
+                )
+                await controller.select_playlist_tracks_async(
+                    http_session, spotify_client, lastfm_user_data, tz_offset=tz_offset,
+                    **get_playlist_options(form),
+                )
+        elif not (STREAM_STATS and path == "/"):
+            await controller.get_stats_page_async(http_session, lastfm_user_data, tz_offset)
+
+    def read_request(self, scope: dict, body: bytes) -> tuple or None:
+        """
+        Read the request and a copy of its session, in a thread as the session may be stored in a file.
+        The session is only read here: the Flask request reads it again and saves its own changes.
+        :return: (method, path, form, session) or None if the request isn't prefetched
+        """
+        with self.wsgi_app.request_context(self.build_environ(scope, body)):
+            if request.args.get("code") or request.args.get("clear"):
+                return None
+            return request.method, request.path, request.form.to_dict(), dict(session)
+
+    @staticmethod
+    def has_fresh_spotify_token(user_session: dict) -> bool:
+        """
+        Whether the session's Spotify token is valid for long enough to prefetch with it. An expired token would be
+        refreshed by the prefetch, and the refreshed token would be lost with the session copy.
+        """
+        token_info = user_session.get("token_info") or {}
+        return bool(user_session.get("access_token")
+                    and token_info.get("expires_at", 0) - time.time() > PREFETCH_TOKEN_MIN_SECONDS)
+
+    @staticmethod
+    def build_environ(scope: dict, body: bytes) -> dict:
+        return EnvironBuilder(
+            path=scope["path"],
+            method=scope["method"],
+            query_string=scope["query_string"].decode("latin1"),
+            headers=[(name.decode("latin1"), value.decode("latin1")) for name, value in scope["headers"]],
+            input_stream=BytesIO(body),
+        ).get_environ()
+
+    @staticmethod
+    async def read_body(receive) -> bytes:
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        return body
+
+    @staticmethod
+    def replay_body(body: bytes):
+        """
+        An ASGI receive callable that returns the already read request body
+        """
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        return receive
+
+
+app = AsyncIndexApp(flask_app)
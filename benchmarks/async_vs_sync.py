@@ -0,0 +1,175 @@
+"""
+Compare how many concurrent new users the sync (gunicorn threads) and async (uvicorn) entry points serve against a
+local mock Last.fm API. Each user enters a username that isn't cached, so every request waits on Last.fm.
+
+While the users wait, --page-views clients keep requesting routes the async entry point doesn't prefetch (static files,
+/warmup). With --stream-stats each user's stats are streamed from /stats/stream, which isn't prefetched either and
+waits on Last.fm in a Flask thread in both modes.
+
+    python benchmarks/async_vs_sync.py --users 20 --latency-ms 300 --page-views 4 --stream-stats
+"""
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mock_api  # noqa: E402
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVER_COMMANDS = {
+    "sync": ["gunicorn", "app:app", "--workers", "1", "--threads", "4", "--timeout", "360", "--bind", "127.0.0.1:{port}"],
+    "async": ["uvicorn", "asgi:app", "--workers", "1", "--host", "127.0.0.1", "--port", "{port}"],
+}
+NON_PREFETCHED_PATHS = ["static/css/styles.css", "warmup", "static/js/scripts.js"]
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(mode: str, port: int, mock_api_port: int, cache_dir: str, stream_stats: bool) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        PYTHONPATH=REPO_DIR,
+        LAST_FM_BASE_URL=f"http://127.0.0.1:{mock_api_port}/2.0",
+        LAST_FM_API_KEY="benchmark",
+        SESSION_SECRET_KEY="benchmark",
+        SESSION_TYPE="cookie",
+        HOST=f"http://127.0.0.1:{port}",
+        SPOTIPY_CLIENT_ID="benchmark",
+        SPOTIPY_CLIENT_SECRET="benchmark",
+        STREAM_STATS=str(stream_stats).lower(),
+    )
+    env.pop("GOOGLE_CLOUD_PROJECT", None)
+    command = [arg.format(port=port) for arg in SERVER_COMMANDS[mode]]
+    # Run from an empty directory so the local file cache starts empty
+    return subprocess.Popen(command, cwd=cache_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_for_server(url: str, timeout: int = 30):
+    start = time.monotonic()
+    async with aiohttp.ClientSession() as http_session:
+        while time.monotonic() - start < timeout:
+            try:
+                async with http_session.get(url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f"Server at {url} didn't start")
+
+
+async def visit(url: str, username: str, stream_stats: bool) -> (float, int):
+    """
+    A new user entering their username, and reading the streamed stats with --stream-stats
+    :return: (seconds taken, status code)
+    """
+    async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True)) as http_session:
+        start = time.monotonic()
+        async with http_session.post(url, data={"username": username, "tz_offset": "0", "tz": "Europe/London"},
+                                     timeout=aiohttp.ClientTimeout(total=600)) as response:
+            await response.read()
+            status = response.status
+        if stream_stats and status == 200:
+            async with http_session.get(f"{url}stats/stream", timeout=aiohttp.ClientTimeout(total=600)) as response:
+                await response.read()
+                status = response.status
+        return time.monotonic() - start, status
+
+
+async def view_pages(url: str, done: asyncio.Event) -> list:
+    """
+    Request routes that aren't prefetched one after the other until the users are done
+    :return: Seconds taken by each request
+    """
+    latencies = []
+    async with aiohttp.ClientSession() as http_session:
+        while not done.is_set():
+            start = time.monotonic()
+            async with http_session.get(f"{url}{NON_PREFETCHED_PATHS[len(latencies) % len(NON_PREFETCHED_PATHS)]}",
+                                        timeout=aiohttp.ClientTimeout(total=600)) as response:
+                await response.read()
+            latencies.append(time.monotonic() - start)
+    return latencies
+
+
+def percentile(latencies: list, share: float) -> float:
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * share))] if latencies else 0
+
+
+async def run_users(url: str, users: int, page_views: int, stream_stats: bool) -> dict:
+    run_id = uuid.uuid4().hex[:6]
+    done = asyncio.Event()
+    viewers = [asyncio.ensure_future(view_pages(url, done)) for _ in range(page_views)]
+    start = time.monotonic()
+    results = await asyncio.gather(*[visit(url, f"bench{run_id}{i}", stream_stats) for i in range(users)])
+    elapsed = time.monotonic() - start
+    done.set()
+    view_latencies = [latency for latencies in await asyncio.gather(*viewers) for latency in latencies]
+    latencies = [latency for latency, _ in results]
+    return {
+        "users": users,
+        "ok": sum(1 for _, status in results if status == 200),
+        "elapsed": elapsed,
+        "throughput": users / elapsed,
+        "p50": percentile(latencies, 0.5),
+        "p95": percentile(latencies, 0.95),
+        "views": len(view_latencies),
+        "view_p50": percentile(view_latencies, 0.5),
+        "view_p95": percentile(view_latencies, 0.95),
+    }
+
+
+def benchmark(mode: str, users: int, mock_api_port: int, page_views: int, stream_stats: bool) -> dict:
+    port = get_free_port()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        server = start_server(mode, port, mock_api_port, cache_dir, stream_stats)
+        try:
+            url = f"http://127.0.0.1:{port}/"
+            asyncio.run(wait_for_server(url))
+            return asyncio.run(run_users(url, users, page_views, stream_stats))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="Concurrent users")
+    parser.add_argument("--latency-ms", type=int, default=300, help="Mock Last.fm latency per request")
+    parser.add_argument("--pages", type=int, default=1, help="Pages of scrobbles per day")
+    parser.add_argument("--modes", nargs="+", default=["sync", "async"], choices=list(SERVER_COMMANDS))
+    parser.add_argument("--page-views", type=int, default=0,
+                        help="Clients requesting routes that aren't prefetched while the users wait")
+    parser.add_argument("--stream-stats", action="store_true", help="Stream the users' stats from /stats/stream")
+    args = parser.parse_args()
+
+    mock_api_port = get_free_port()
+    mock_api.start_in_thread(mock_api_port, latency_ms=args.latency_ms, pages=args.pages)
+
+    print(f"{args.users} concurrent new users, {args.latency_ms} ms Last.fm latency")
+    print(f"{'mode':<6} {'ok':>4} {'elapsed s':>10} {'users/s':>8} {'p50 s':>7} {'p95 s':>7} "
+          f"{'views':>6} {'view p50 s':>10} {'view p95 s':>10}")
+    for mode in args.modes:
+        result = benchmark(mode, args.users, mock_api_port, args.page_views, args.stream_stats)
+        print(f"{mode:<6} {result['ok']:>4} {result['elapsed']:>10.2f} {result['throughput']:>8.2f} "
+              f"{result['p50']:>7.2f} {result['p95']:>7.2f} "
+              f"{result['views']:>6} {result['view_p50']:>10.2f} {result['view_p95']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Report how long importing the app takes on a cold start, and which imports take longest.
+
+    python benchmarks/import_time.py --top 15 --budget-ms 600
+
+Exits with status 1 if the import takes longer than the budget, so it can run in CI.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def profile_import(module: str) -> list:
+    """
+    :return: [(cumulative_us, self_us, depth, module name)] from python -X importtime, in import order
+    """
+    env = dict(os.environ, PYTHONPATH=REPO_DIR, SESSION_SECRET_KEY=os.getenv("SESSION_SECRET_KEY") or "import-time")
+    # Run from an empty directory so the local file cache and sessions are created fresh, as on a new instance
+    with tempfile.TemporaryDirectory() as cwd:
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                cwd=cwd, env=env, capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((int(cumulative_us), int(self_us), depth, name.strip()))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="app", help="Module to import (e.g. app or asgi)")
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest imports to list")
+    parser.add_argument("--repeat", type=int, default=3, help="Imports to run, the fastest is reported")
+    parser.add_argument("--budget-ms", type=int, help="Fail if the import takes longer than this")
+    args = parser.parse_args()
+
+    runs = [profile_import(args.module) for _ in range(args.repeat)]
+    imports = min(runs, key=lambda run: next(cumulative for cumulative, _, _, name in run if name == args.module))
+    total_ms = next(cumulative for cumulative, _, _, name in imports if name == args.module) / 1000
+
+    print(f"import {args.module}: {total_ms:.0f} ms (fastest of {args.repeat})")
+    print(f"{'cumulative ms':>14} {'self ms':>8}  module")
+    for cumulative_us, self_us, depth, name in sorted(imports, reverse=True)[:args.top]:
+        print(f"{cumulative_us / 1000:>14.1f} {self_us / 1000:>8.1f}  {'  ' * depth}{name}")
+
+    if args.budget_ms and total_ms > args.budget_ms:
+        print(f"import {args.module} took {total_ms:.0f} ms, over the {args.budget_ms} ms budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
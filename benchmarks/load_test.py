@@ -0,0 +1,208 @@
+"""
+Load test app.index under gunicorn against the local mock Last.fm and Spotify APIs (benchmarks/mock_api.py), for each
+combination of --workers and --threads.
+
+    python benchmarks/load_test.py --users 20 --duration 60 --workers 1 2 --threads 4 8 --latency-ms 300
+
+Each virtual user repeatedly picks an action:
+- new: enter a username that isn't cached (every year of stats is fetched from Last.fm)
+- view: reload the page for their username (stats cached)
+- playlist: make a playlist with their Spotify session (Spotify searches and playlist creation)
+in the proportions given by --mix. Reports p50/p95/p99 latency and throughput per action.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import aiohttp
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mock_api  # noqa: E402
+from async_vs_sync import REPO_DIR, get_free_port, wait_for_server  # noqa: E402
+
+SESSION_SECRET_KEY = "load-test"
+GUNICORN_TIMEOUT = 360
+ACTIONS = ("new", "view", "playlist")
+# index catches exceptions and shows this message with a 200
+APP_ERROR_MESSAGE = b"Something went wrong"
+
+
+def start_server(workers: int, threads: int, port: int, mock_api_port: int, cache_dir: str) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        PYTHONPATH=REPO_DIR,
+        LAST_FM_BASE_URL=f"http://127.0.0.1:{mock_api_port}/2.0",
+        LAST_FM_API_KEY="load-test",
+        SPOTIFY_API_BASE_URL=f"http://127.0.0.1:{mock_api_port}/v1",
+        SESSION_SECRET_KEY=SESSION_SECRET_KEY,
+        SESSION_TYPE="cookie",
+        HOST=f"http://127.0.0.1:{port}",
+        SPOTIPY_CLIENT_ID="load-test",
+        SPOTIPY_CLIENT_SECRET="load-test",
+    )
+    env.pop("GOOGLE_CLOUD_PROJECT", None)
+    command = ["gunicorn", "app:app", "--workers", str(workers), "--threads", str(threads),
+               "--timeout", str(GUNICORN_TIMEOUT), "--bind", f"127.0.0.1:{port}"]
+    return subprocess.Popen(command, cwd=cache_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def get_spotify_session_cookie() -> str:
+    """
+    A signed Flask session cookie with a Spotify token that won't expire during the test, as if the user had
+    authorized Spotify
+    """
+    app = Flask(__name__)
+    app.secret_key = SESSION_SECRET_KEY
+    token_info = {
+        "access_token": "load-test", "token_type": "Bearer", "expires_in": 3600, "refresh_token": "load-test",
+        "scope": "playlist-modify-private", "expires_at": int(time.time()) + 24 * 60 * 60,
+    }
+    return app.session_interface.get_signing_serializer(app).dumps({
+        "access_token": "load-test", "token_info": token_info,
+    })
+
+
+class VirtualUser:
+    def __init__(self, base_url: str, run_id: str, user_num: int, mix: dict, spotify_cookie: str):
+        self.base_url = base_url
+        self.run_id = run_id
+        self.user_num = user_num
+        self.mix = mix
+        self.visits = 0
+        self.username = None
+        self.http_session = aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True))
+        self.http_session.cookie_jar.update_cookies({"session": spotify_cookie})
+
+    async def run(self, deadline: float, results: list):
+        async with self.http_session:
+            while time.monotonic() < deadline:
+                action = random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+                if action != "new" and not self.username:
+                    action = "new"
+                results.append((action, *await self.request(action)))
+
+    async def request(self, action: str) -> (float, bool):
+        """
+        :return: (seconds taken, whether the page was served without an error)
+        """
+        if action == "new":
+            self.visits += 1
+            self.username = f"load{self.run_id}u{self.user_num}v{self.visits}"
+            method, data = "POST", {"username": self.username, "tz_offset": "0", "tz": "Europe/London"}
+        elif action == "playlist":
+            method, data = "POST", {"make_playlist": "1", "playlist_opt_tracks_per_year": "5",
+                                    "playlist_opt_order_recent_first": "1"}
+        else:
+            method, data = "GET", None
+        timeout = aiohttp.ClientTimeout(total=GUNICORN_TIMEOUT + 10)
+        start = time.monotonic()
+        try:
+            async with self.http_session.request(method, self.base_url, data=data, timeout=timeout) as response:
+                body = await response.read()
+                return time.monotonic() - start, response.status == 200 and APP_ERROR_MESSAGE not in body
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return time.monotonic() - start, False
+
+
+async def run_load(base_url: str, users: int, duration: int, mix: dict) -> list:
+    run_id = uuid.uuid4().hex[:6]
+    spotify_cookie = get_spotify_session_cookie()
+    deadline = time.monotonic() + duration
+    results = []
+    await asyncio.gather(*[
+        VirtualUser(base_url, run_id, i, mix, spotify_cookie).run(deadline, results) for i in range(users)
+    ])
+    return results
+
+
+def percentile(latencies: list, percent: int) -> float:
+    return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+
+def summarize(results: list, elapsed: float) -> dict:
+    """
+    :return: {action: {"requests", "errors", "throughput", "p50", "p95", "p99"}}, with "all" for every action
+    """
+    summary = {}
+    for action in ("all", *ACTIONS):
+        action_results = [(latency, ok) for a, latency, ok in results if action in ("all", a)]
+        if not action_results:
+            continue
+        latencies = sorted(latency for latency, _ in action_results)
+        summary[action] = {
+            "requests": len(action_results),
+            "errors": sum(1 for _, ok in action_results if not ok),
+            "throughput": len(action_results) / elapsed,
+            "p50": statistics.median(latencies),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        }
+    return summary
+
+
+def load_test(workers: int, threads: int, users: int, duration: int, mix: dict, mock_api_port: int) -> dict:
+    port = get_free_port()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        server = start_server(workers, threads, port, mock_api_port, cache_dir)
+        try:
+            base_url = f"http://127.0.0.1:{port}/"
+            asyncio.run(wait_for_server(base_url))
+            start = time.monotonic()
+            results = asyncio.run(run_load(base_url, users, duration, mix))
+            return summarize(results, time.monotonic() - start)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def parse_mix(mix: str) -> dict:
+    """
+    :param mix: e.g. "new=2,view=7,playlist=1"
+    """
+    weights = {action: float(weight) for action, weight in (part.split("=") for part in mix.split(","))}
+    unknown = set(weights) - set(ACTIONS)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown actions {unknown}, expected {ACTIONS}")
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="Concurrent virtual users")
+    parser.add_argument("--duration", type=int, default=60, help="Seconds to run each configuration for")
+    parser.add_argument("--mix", type=parse_mix, default="new=2,view=7,playlist=1", help="Action weights")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1])
+    parser.add_argument("--threads", type=int, nargs="+", default=[4])
+    parser.add_argument("--latency-ms", type=int, default=300, help="Mock API latency per request")
+    parser.add_argument("--pages", type=int, default=1, help="Pages of scrobbles per day")
+    parser.add_argument("--error-rate", type=float, default=0, help="Share of mock API requests that fail")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="Share of mock API requests that get a 429")
+    args = parser.parse_args()
+
+    mock_api_port = get_free_port()
+    mock_api.start_in_thread(mock_api_port, latency_ms=args.latency_ms, pages=args.pages,
+                             error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate)
+
+    print(f"{args.users} users for {args.duration}s, mix {args.mix}, {args.latency_ms} ms mock API latency, "
+          f"{args.error_rate:.0%} errors, {args.rate_limit_rate:.0%} rate limited")
+    print(f"{'workers':>7} {'threads':>7} {'action':<8} {'requests':>8} {'errors':>6} {'req/s':>6} "
+          f"{'p50 s':>6} {'p95 s':>6} {'p99 s':>6}")
+    for workers in args.workers:
+        for threads in args.threads:
+            summary = load_test(workers, threads, args.users, args.duration, args.mix, mock_api_port)
+            for action, result in summary.items():
+                print(f"{workers:>7} {threads:>7} {action:<8} {result['requests']:>8} {result['errors']:>6} "
+                      f"{result['throughput']:>6.2f} {result['p50']:>6.2f} {result['p95']:>6.2f} "
+                      f"{result['p99']:>6.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+A local stand-in for the Last.fm and Spotify APIs with a fixed latency per request, for benchmarks and load tests.
+Point the app at it with LAST_FM_BASE_URL=http://127.0.0.1:<port>/2.0 and SPOTIFY_API_BASE_URL=http://127.0.0.1:<port>/v1
+
+    python benchmarks/mock_api.py --port 8090 --latency-ms 300 --pages 3 --error-rate 0.01 --rate-limit-rate 0.02
+
+--error-rate of requests fail with a 500 and --rate-limit-rate with a 429 and a Retry-After header.
+Every Spotify search for a track the mock Last.fm returned is found.
+"""
+import argparse
+import asyncio
+import random
+import re
+import time
+import uuid
+from datetime import datetime, timedelta
+from threading import Thread
+
+from aiohttp import web
+
+ARTISTS = [f"Artist {i}" for i in range(40)]
+SEARCH_QUERY = re.compile(r"^track:(?P<track_name>.+ Track \d+) (?P<artist>.+)$")
+
+
+def get_user_info(params: dict) -> dict:
+    return {"user": {
+        "name": params.get("user") or params.get("username"),
+        "realname": "",
+        "playcount": "100000",
+        "registered": {"unixtime": str(int((datetime.utcnow() - timedelta(days=365 * 15 + 30)).timestamp()))},
+    }}
+
+
+def get_recent_tracks(params: dict, tracks_per_page: int, pages: int) -> dict:
+    page = int(params.get("page") or 1)
+    start = int(params.get("from") or time.time())
+    tracks = []
+    for i in range(tracks_per_page):
+        artist = ARTISTS[random.randrange(len(ARTISTS)) // random.randint(1, 4)]
+        tracks.append({
+            "artist": {"#text": artist},
+            "name": f"{artist} Track {random.randint(1, 15)}",
+            "date": {"uts": str(start + 60 * 60 * 6 + i * 60)},
+        })
+    return {"recenttracks": {"track": tracks, "@attr": {"page": str(page), "totalPages": str(pages)}}}
+
+
+def get_top_tags(params: dict) -> dict:
+    return {"toptags": {"tag": [{"name": "seen live"}, {"name": "indie"}]}}
+
+
+def search_tracks(params: dict) -> dict:
+    match = SEARCH_QUERY.match(params.get("q", ""))
+    if not match:
+        return {"tracks": {"items": []}}
+    return {"tracks": {"items": [{
+        "name": match["track_name"],
+        "uri": f"spotify:track:{uuid.uuid5(uuid.NAMESPACE_URL, params['q']).hex[:22]}",
+        "artists": [{"name": match["artist"]}],
+    }]}}
+
+
+def make_app(latency_ms: int = 300, tracks_per_page: int = 50, pages: int = 1, error_rate: float = 0,
+             rate_limit_rate: float = 0, spotify_latency_ms: int = None) -> web.Application:
+    if spotify_latency_ms is None:
+        spotify_latency_ms = latency_ms
+
+    async def inject_faults(latency: int) -> web.Response or None:
+        await asyncio.sleep(latency / 1000)
+        fault = random.random()
+        if fault < rate_limit_rate:
+            return web.json_response({"error": 29, "message": "Rate limit exceeded"}, status=429,
+                                     headers={"Retry-After": "1"})
+        if fault < rate_limit_rate + error_rate:
+            return web.json_response({"error": 8, "message": "Operation failed"}, status=500)
+
+    async def lastfm(request: web.Request) -> web.Response:
+        fault = await inject_faults(latency_ms)
+        if fault:
+            return fault
+        params = request.query
+        method = params.get("method")
+        if method == "user.getinfo":
+            return web.json_response(get_user_info(params))
+        if method == "user.getrecenttracks":
+            return web.json_response(get_recent_tracks(params, tracks_per_page, pages))
+        if method == "artist.gettoptags":
+            return web.json_response(get_top_tags(params))
+        return web.json_response({"error": 3, "message": "Invalid Method"}, status=400)
+
+    def spotify(handler):
+        async def _handle(request: web.Request) -> web.Response:
+            return await inject_faults(spotify_latency_ms) or await handler(request)
+
+        return _handle
+
+    async def spotify_search(request: web.Request) -> web.Response:
+        return web.json_response(search_tracks(request.query))
+
+    async def spotify_me(request: web.Request) -> web.Response:
+        return web.json_response({"id": "mock-user", "display_name": "Mock User"})
+
+    async def spotify_create_playlist(request: web.Request) -> web.Response:
+        playlist_id = uuid.uuid4().hex[:22]
+        return web.json_response({"id": playlist_id, "external_urls": {
+            "spotify": f"https://open.spotify.com/playlist/{playlist_id}"
+        }}, status=201)
+
+    async def spotify_add_tracks(request: web.Request) -> web.Response:
+        return web.json_response({"snapshot_id": uuid.uuid4().hex}, status=201)
+
+    app = web.Application()
+    app.router.add_get("/2.0/", lastfm)
+    app.router.add_get("/v1/search", spotify(spotify_search))
+    app.router.add_get("/v1/me/", spotify(spotify_me))
+    app.router.add_get("/v1/me", spotify(spotify_me))
+    app.router.add_post("/v1/users/{user_id}/playlists", spotify(spotify_create_playlist))
+    app.router.add_post("/v1/playlists/{playlist_id}/tracks", spotify(spotify_add_tracks))
+    return app
+
+
+def start_in_thread(port: int, **kwargs) -> Thread:
+    """
+    Serve the mock API from a daemon thread with its own event loop
+    """
+    def _serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(make_app(**kwargs))
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port).start())
+        loop.run_forever()
+
+    thread = Thread(target=_serve, name="mock_api", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=int, default=300)
+    parser.add_argument("--spotify-latency-ms", type=int, help="Defaults to --latency-ms")
+    parser.add_argument("--tracks-per-page", type=int, default=50)
+    parser.add_argument("--pages", type=int, default=1)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0)
+    args = parser.parse_args()
+    web.run_app(make_app(args.latency_ms, args.tracks_per_page, args.pages, args.error_rate, args.rate_limit_rate,
+                         args.spotify_latency_ms), host="127.0.0.1", port=args.port)
@@ -0,0 +1,405 @@
+"""
+Offline benchmarks of the stats and playlist pipelines, with synthetic listening histories and in-process fakes for
+Last.fm, Spotify and the database, so results only depend on this code.
+
+    python benchmarks/pipelines.py --users light heavy power --repeat 5
+    python benchmarks/pipelines.py --save-baseline main
+    python benchmarks/pipelines.py --compare main --threshold 25
+
+Each stage reports the median wall and CPU time of --repeat runs, then the peak memory allocated (tracemalloc) and the
+number of function calls (cProfile) of one more run each. Calls are deterministic for a given --seed, so a change in
+calls is a change in the work done. Only calls on the main thread are counted, so the Last.fm fetch's worker
+threads aren't. Baselines are saved to benchmarks/baselines/<name>.json, and --compare exits with
+status 1 if a stage's wall time regressed by more than --threshold percent.
+"""
+import argparse
+import cProfile
+import json
+import logging
+import math
+import os
+import platform
+import pstats
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from copy import deepcopy
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+sys.path.insert(0, REPO_DIR)
+
+from clients.database import BaseDbClient, LocalFiles  # noqa: E402
+from clients.lastfm_client import LastfmClient  # noqa: E402
+from clients.spotify_client import SpotifyClient, DEFAULT_TRACKS_PER_YEAR  # noqa: E402
+from clients.track_index import TrackIndex  # noqa: E402
+
+# name: (years of history, scrobbles per day, distinct artists)
+USER_PROFILES = {
+    "light": (3, 20, 60),
+    "heavy": (10, 150, 400),
+    "power": (20, 300, 1500),
+}
+LASTFM_PAGE_SIZE = 50
+
+
+class FakeDb:
+    """
+    In-memory documents, with BaseDbClient's interface. Not a singleton, so each run can start empty.
+    Documents are stored encoded as LocalFiles stores them, so writes cost the copy a real database would make.
+    """
+    strip_string = staticmethod(BaseDbClient.strip_string)
+    serialize = LocalFiles.serialize
+    deserialize = staticmethod(LocalFiles.deserialize)
+
+    def __init__(self):
+        self.collections = {}
+
+    def get_document(self, collection_name, document_id):
+        document = self.collections.get(collection_name, {}).get(self.strip_string(document_id))
+        return self.deserialize(json.loads(document)) if document else {}
+
+    def set_document(self, collection_name, document_id, data, merge=True):
+        documents = self.collections.setdefault(collection_name, {})
+        document_id = self.strip_string(document_id)
+        if merge:
+            data = {**self.get_document(collection_name, document_id), **data}
+        documents[document_id] = json.dumps(self.serialize(deepcopy(data)))
+
+    def get_collection(self, collection_name):
+        return {document_id: self.get_document(collection_name, document_id)
+                for document_id in self.collections.get(collection_name, {})}
+
+    def get_top_documents(self, collection_name, order_by, limit):
+        documents = self.get_collection(collection_name).items()
+        return dict(sorted(documents, key=lambda d: d[1].get(order_by) or 0, reverse=True)[:limit])
+
+
+class FakeLastfmClient(LastfmClient):
+    """
+    LastfmClient answering API queries from a generated history
+    """
+
+    def __init__(self, *args, scrobbles_per_day: int, artist_count: int, seed: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scrobbles_per_day = scrobbles_per_day
+        self.artist_count = artist_count
+        self.seed = seed
+
+    def last_fm_api_query(self, api_method: str, **args) -> dict:
+        if api_method == "user.getrecenttracks":
+            return self.get_recent_tracks(int(args["_from"]), int(args["to"]), int(args["page"]))
+        if api_method == "artist.gettoptags":
+            return {"toptags": {"tag": [{"name": "seen live"}, {"name": f"genre {len(args['artist']) % 12}"}]}}
+        return {}
+
+    def get_recent_tracks(self, date_start: int, date_end: int, page: int) -> dict:
+        """
+        The same scrobbles for a day on every call. Artists are Zipf distributed, like real listening.
+        """
+        rng = random.Random(self.seed * 100003 + date_start)
+        tracks = []
+        for _ in range(self.scrobbles_per_day):
+            artist = f"Artist {min(int(rng.paretovariate(1.2)) - 1, self.artist_count - 1)}"
+            tracks.append({
+                "artist": {"#text": artist},
+                "name": f"{artist} Track {rng.randint(1, 20)}",
+                "date": {"uts": str(rng.randrange(date_start, date_end))},
+            })
+        tracks.sort(key=lambda t: t["date"]["uts"], reverse=True)
+        pages = max(1, math.ceil(len(tracks) / LASTFM_PAGE_SIZE))
+        page_tracks = tracks[(page - 1) * LASTFM_PAGE_SIZE:page * LASTFM_PAGE_SIZE]
+        return {"recenttracks": {"track": page_tracks, "@attr": {"page": str(page), "totalPages": str(pages)}}}
+
+
+def full_recent_track(track: dict) -> dict:
+    """
+    A generated track with every field a real user.getrecenttracks page has
+    """
+    image_url = "https://lastfm.freetls.fastly.net/i/u/{size}/2a96cbd8b46e442fc41c2b86b821562f.png"
+    return {
+        "artist": {"mbid": "a74b1b7f-71a5-4011-9441-d0b5e4122711", "#text": track["artist"]["#text"]},
+        "streamable": "0",
+        "image": [{"size": size, "#text": image_url.format(size=size)}
+                  for size in ("small", "medium", "large", "extralarge")],
+        "mbid": "6f1c6b0e-6b0e-4e4e-9e0e-0e0e0e0e0e0e",
+        "album": {"mbid": "", "#text": f"{track['artist']['#text']} Album"},
+        "name": track["name"],
+        "url": f"https://www.last.fm/music/{track['artist']['#text']}/_/{track['name']}".replace(" ", "+"),
+        "date": {"uts": track["date"]["uts"], "#text": "15 Jun 2023, 12:00"},
+    }
+
+
+class FakeSpotify:
+    """
+    Stands in for spotipy.Spotify. Every generated track is found.
+    """
+    QUERY = re.compile(r"^track:(?P<track_name>.+ Track \d+) (?P<artist>.+)$")
+
+    def search(self, q: str, type: str = "track", market: str = None, **kwargs) -> dict:
+        match = self.QUERY.match(q)
+        if not match:
+            return {"tracks": {"items": []}}
+        return {"tracks": {"items": [{
+            "name": match["track_name"],
+            "uri": f"spotify:track:{zlib.crc32(q.encode())}",
+            "artists": [{"name": match["artist"]}],
+        }]}}
+
+
+class Pipelines:
+    """
+    The stages for one synthetic user
+    """
+
+    def __init__(self, profile: str, scrobbles_per_day: int = None, seed: int = 1):
+        self.years, profile_scrobbles_per_day, self.artist_count = USER_PROFILES[profile]
+        self.scrobbles_per_day = scrobbles_per_day or profile_scrobbles_per_day
+        self.seed = seed
+        self.username = f"bench-{profile}"
+        self.day = datetime(2024, 6, 15, 12)
+        self.db = FakeDb()
+        # Fetched once for the stages that start from the user's data
+        self.data = self.new_lastfm_client().get_data_for_days(self.new_lastfm_client().get_list_of_year_dates())
+        self.stats, _ = self.new_lastfm_client().get_stats()
+
+    def new_lastfm_client(self, db: FakeDb = None) -> FakeLastfmClient:
+        client = FakeLastfmClient(
+            self.username, self.day - timedelta(days=365 * self.years), day=self.day,
+            scrobbles_per_day=self.scrobbles_per_day, artist_count=self.artist_count, seed=self.seed,
+        )
+        client.cache._db = db or self.db
+        return client
+
+    def get_recent_tracks_pages(self) -> list:
+        """
+        Every user.getrecenttracks page for the user's stats, encoded as Last.fm sends them
+        """
+        client = self.new_lastfm_client()
+        pages = []
+        for date in client.get_list_of_year_dates():
+            query = client.get_scrobbles_query(date, 1)
+            page_num, total_pages = 1, 1
+            while page_num <= total_pages:
+                page = client.get_recent_tracks(query["_from"], query["to"], page_num)
+                total_pages = int(page["recenttracks"]["@attr"]["totalPages"])
+                page["recenttracks"]["track"] = [full_recent_track(track) for track in page["recenttracks"]["track"]]
+                pages.append(json.dumps(page).encode())
+                page_num += 1
+        return pages
+
+    def new_spotify_client(self, db: FakeDb) -> SpotifyClient:
+        client = SpotifyClient(auth_manager=object(), available_market="GB")
+        client.spotify_client = FakeSpotify()
+        client.cache._db = db
+        track_index = TrackIndex()
+        track_index._db = db
+        track_index.warm_entries = {}
+        track_index.pending_entries.clear()
+        track_index.pending_hits = {}
+        track_index.warm_up_started = True
+        return client
+
+    def stages(self) -> dict:
+        """
+        :return: {name: (setup, run)}. setup returns the arguments for run and isn't timed.
+        """
+        local_files = LocalFiles()
+        recent_tracks_pages = self.get_recent_tracks_pages()
+
+        def _seeded(*args):
+            random.seed(self.seed)
+            return args
+
+        # Search results and track index entries for the same playlist
+        search_db = FakeDb()
+        _seeded()
+        self.new_spotify_client(search_db).search_for_tracks(SpotifyClient.format_track_data(self.stats),
+                                                             DEFAULT_TRACKS_PER_YEAR)
+
+        return {
+            "lastfm_fetch": (
+                lambda: _seeded(self.new_lastfm_client(FakeDb())),
+                lambda client: client.get_data_for_days(client.get_list_of_year_dates()),
+            ),
+            "summarize_and_filter_for_timezone": (
+                lambda: _seeded(self.new_lastfm_client()),
+                lambda client: client.summarize_and_filter_for_timezone(self.data, {}),
+            ),
+            "get_stats_uncached": (
+                lambda: _seeded(self.new_lastfm_client(FakeDb())),
+                lambda client: client.get_stats(),
+            ),
+            "get_stats_streaming_uncached": (
+                lambda: _seeded(self.new_lastfm_client(FakeDb())),
+                lambda client: client.get_stats_streaming(),
+            ),
+            "get_stats_cached": (
+                lambda: _seeded(self.new_lastfm_client()),
+                lambda client: client.get_stats(),
+            ),
+            "format_track_data": (
+                lambda: _seeded(),
+                lambda: SpotifyClient.format_track_data(self.stats),
+            ),
+            "search_for_tracks_uncached": (
+                lambda: _seeded(self.new_spotify_client(FakeDb()), SpotifyClient.format_track_data(self.stats)),
+                lambda client, track_data: client.search_for_tracks(track_data, DEFAULT_TRACKS_PER_YEAR),
+            ),
+            "search_for_tracks_cached": (
+                lambda: _seeded(self.new_spotify_client(search_db), SpotifyClient.format_track_data(self.stats)),
+                lambda client, track_data: client.search_for_tracks(track_data, DEFAULT_TRACKS_PER_YEAR),
+            ),
+            # All of the user's pages held at once, as in the Last.fm fan-out
+            "recenttracks_pages_json": (
+                lambda: _seeded(),
+                lambda: [json.loads(page) for page in recent_tracks_pages],
+            ),
+            "recenttracks_pages_decode": (
+                lambda: _seeded(),
+                lambda: [LastfmClient.decode_recent_tracks_page(page) for page in recent_tracks_pages],
+            ),
+            "localfiles_roundtrip": (
+                lambda: _seeded(),
+                lambda: (
+                    local_files.set_document("users", self.username, {"data": self.data, "date_cached": self.day}),
+                    local_files.get_document("users", self.username),
+                ),
+            ),
+        }
+
+
+def measure(setup, run, repeat: int) -> dict:
+    walls, cpus = [], []
+    for _ in range(repeat):
+        args = setup()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        run(*args)
+        walls.append(time.perf_counter() - wall_start)
+        cpus.append(time.process_time() - cpu_start)
+
+    args = setup()
+    tracemalloc.start()
+    try:
+        run(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    args = setup()
+    profiler = cProfile.Profile()
+    profiler.runcall(run, *args)
+    return {
+        "wall_ms": round(statistics.median(walls) * 1000, 2),
+        "cpu_ms": round(statistics.median(cpus) * 1000, 2),
+        "peak_kib": round(peak / 1024, 1),
+        "calls": pstats.Stats(profiler).total_calls,
+    }
+
+
+def run_benchmarks(profiles: list, repeat: int, scrobbles_per_day: int, seed: int, stage_names: list) -> dict:
+    results = {}
+    for profile in profiles:
+        pipelines = Pipelines(profile, scrobbles_per_day, seed)
+        results[profile] = {}
+        for name, (setup, run) in pipelines.stages().items():
+            if stage_names and name not in stage_names:
+                continue
+            results[profile][name] = measure(setup, run, repeat)
+    return results
+
+
+def get_commit() -> str or None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results: dict, baseline: dict = None):
+    print(f"{'user':<6} {'stage':<34} {'wall ms':>9} {'cpu ms':>9} {'peak KiB':>9} {'calls':>9}"
+          + (f" {'wall vs base':>13} {'calls vs base':>14}" if baseline else ""))
+    for profile, stages in results.items():
+        for name, result in stages.items():
+            line = (f"{profile:<6} {name:<34} {result['wall_ms']:>9.2f} {result['cpu_ms']:>9.2f} "
+                    f"{result['peak_kib']:>9.1f} {result['calls']:>9}")
+            base = (baseline or {}).get(profile, {}).get(name)
+            if base:
+                line += f" {get_change(base['wall_ms'], result['wall_ms']):>+12.1f}% " \
+                        f"{get_change(base['calls'], result['calls']):>+13.1f}%"
+            print(line)
+
+
+def get_change(before: float, after: float) -> float:
+    return (after - before) / before * 100 if before else 0
+
+
+def get_regressions(results: dict, baseline: dict, threshold: float) -> list:
+    return [
+        (profile, name, get_change(baseline[profile][name]["wall_ms"], result["wall_ms"]))
+        for profile, stages in results.items()
+        for name, result in stages.items()
+        if name in baseline.get(profile, {})
+        and get_change(baseline[profile][name]["wall_ms"], result["wall_ms"]) > threshold
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", nargs="+", default=list(USER_PROFILES), choices=list(USER_PROFILES))
+    parser.add_argument("--stages", nargs="+", help="Only run these stages")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per stage, the median is reported")
+    parser.add_argument("--scrobbles-per-day", type=int, help="Override the user profiles' scrobbles per day")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save-baseline", metavar="NAME", help="Save the results as a baseline")
+    parser.add_argument("--compare", metavar="NAME", help="Compare the results with a saved baseline")
+    parser.add_argument("--threshold", type=float, default=25, help="Wall time regression %% that fails --compare")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # LocalFiles writes under the working directory
+    with tempfile.TemporaryDirectory() as cwd:
+        os.chdir(cwd)
+        results = run_benchmarks(args.users, args.repeat, args.scrobbles_per_day, args.seed, args.stages)
+    os.chdir(REPO_DIR)
+
+    baseline = None
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f"{args.compare}.json")) as f:
+            saved = json.load(f)
+        baseline = saved["results"]
+        print(f"Compared with baseline '{args.compare}' (commit {saved.get('commit')}, python {saved.get('python')})")
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f"{args.save_baseline}.json")
+        with open(path, "w") as f:
+            json.dump({
+                "commit": get_commit(),
+                "python": platform.python_version(),
+                "date": datetime.utcnow().isoformat(),
+                "seed": args.seed,
+                "scrobbles_per_day": args.scrobbles_per_day,
+                "results": results,
+            }, f, indent=2)
+        print(f"Saved baseline to {path}")
+
+    if baseline:
+        regressions = get_regressions(results, baseline, args.threshold)
+        for profile, name, change in regressions:
+            print(f"REGRESSION {profile} {name}: wall time {change:+.1f}% (threshold {args.threshold}%)")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
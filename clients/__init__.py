@@ -1,6 +1,13 @@
+import asyncio
+import contextvars
 import random
 import time
-from functools import wraps
+from functools import partial, wraps
+
+from dotenv import load_dotenv
+
+# Loaded once, before any module reads its settings from the environment
+load_dotenv()
 
 
 class RetryException(Exception):
@@ -36,3 +43,20 @@ def retry(exception_to_check, tries=4, delay=0, backoff=0, _logger=None, randomi
         return f_retry
 
     return deco_retry
+
+
+def submit_in_context(executor, func, *args, **kwargs):
+    """
+    executor.submit, running func with a copy of the current context so it's traced with the request
+    """
+    return executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+async def run_in_thread(func, *args, **kwargs):
+    """
+    Run a blocking function in the event loop's default executor with the current context (asyncio.to_thread is
+    Python 3.9+)
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, partial(context.run, func, *args, **kwargs))
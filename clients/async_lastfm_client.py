@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+import random
+from datetime import datetime, timedelta
+
+import aiohttp
+import pytz
+
+from clients import RetryException, run_in_thread
+from clients.lastfm_client import LastfmClient, HEADERS
+from clients.monitoring_client import GoogleMonitoringClient
+from clients.tracing import span
+
+logger = logging.getLogger(__name__)
+
+ASYNC_LASTFM_CONCURRENCY = int(os.getenv("ASYNC_LASTFM_CONCURRENCY") or 20)
+LASTFM_QUERY_TRIES = 3
+
+
+class AsyncLastfmClient(LastfmClient):
+    """
+    LastfmClient with the Last.fm requests made on an asyncio event loop, so that waiting on Last.fm doesn't hold a
+    thread. Summarizing and caching the data is shared with LastfmClient.
+    """
+
+    def __init__(self, http_session: aiohttp.ClientSession, *args, **kwargs):
+        """
+        :param http_session: Session shared by all requests on the event loop
+        """
+        super().__init__(*args, **kwargs)
+        self.http_session = http_session
+        self.semaphore = asyncio.Semaphore(ASYNC_LASTFM_CONCURRENCY)
+        # Artist tags fetched ahead of summarizing, None to look them up while summarizing like LastfmClient
+        self.top_tags = None
+
+    async def last_fm_api_query_async(self, api_method: str, **args) -> dict:
+        """
+        A GET request to Last.fm API, retried with backoff like last_fm_api_query
+        """
+        api_url = self.get_api_url(api_method, **args)
+        wait = 1
+        for remaining_tries in range(LASTFM_QUERY_TRIES, 0, -1):
+            try:
+                async with self.semaphore:
+                    GoogleMonitoringClient().increment_thread("lastfm-request")
+                    with span("lastfm", self.get_span_detail(api_method, args)):
+                        async with self.http_session.get(api_url, headers=HEADERS) as response:
+                            if response.status in RetryException.retry_codes:
+                                raise RetryException(
+                                    f"WARNING:  {response.status} status code for {api_method}. "
+                                    f"{await response.text()}"
+                                )
+                            if api_method == "user.getrecenttracks":
+                                return self.decode_recent_tracks_page(await response.read())
+                            return await response.json(content_type=None)
+            except RetryException:
+                GoogleMonitoringClient().increment_thread("retry-exception")
+                if remaining_tries == 1:
+                    raise
+                wait += random.random()
+                logger.exception(f"Retrying {api_method} in {wait} seconds...")
+                await asyncio.sleep(wait)
+                wait *= 3
+            except Exception:
+                GoogleMonitoringClient().increment_thread("lastfm-exception")
+                logger.exception(f"Unhandled exception for Last.fm {api_method}")
+                return {}
+
+    async def get_stats_async(self) -> (list, datetime):
+        """
+        get_stats, fetching every year at once on the event loop. STATS_DEADLINE_SECONDS, FETCH_PLANNER and
+        STREAM_RECENT_TRACKS don't apply: the prefetch waits for every year, and the years are cached together.
+        """
+        data, artist_tags, date_cached = await run_in_thread(self.get_cached_data)
+        if not data:
+            data = await self.get_data_for_days_async(self.get_list_of_year_dates())
+            date_cached = datetime.utcnow()
+            await run_in_thread(self.cache_data, data, date_cached)
+        summary = await self.summarize_and_filter_for_timezone_async(data, artist_tags)
+        return summary, date_cached.replace(tzinfo=pytz.UTC) - timedelta(minutes=self.tz_offset)
+
+    async def summarize_and_filter_for_timezone_async(self, data: list, artist_tags: dict = None) -> list:
+        """
+        Summarize the user's last.fm stats, looking up the tags of each year's top artist at once.
+        The first pass only finds which artists need a tag.
+        """
+        self.top_tags = {}
+        await run_in_thread(self.summarize_and_filter_for_timezone, data, dict(artist_tags or {}))
+        artists = list(self.top_tags)
+        top_tags = await asyncio.gather(*[self.get_top_tag_for_artist_async(artist) for artist in artists])
+        self.top_tags = dict(zip(artists, top_tags))
+        try:
+            return await run_in_thread(self.summarize_and_filter_for_timezone, data, artist_tags)
+        finally:
+            self.top_tags = None
+
+    def get_top_tag_for_artist(self, artist: str) -> str:
+        if self.top_tags is None:
+            return super().get_top_tag_for_artist(artist)
+        return self.top_tags.setdefault(artist, None)
+
+    async def get_top_tag_for_artist_async(self, artist: str) -> str:
+        with span("lastfm.top_tag", artist):
+            return await self._get_top_tag_for_artist_async(artist)
+
+    async def _get_top_tag_for_artist_async(self, artist: str) -> str:
+        top_tag = await run_in_thread(self.cache.get_artist_tag, artist)
+        if not top_tag:
+            api_response = await self.last_fm_api_query_async(api_method="artist.gettoptags", artist=artist)
+            top_tag = self.top_tag_from_response(api_response)
+            if top_tag:
+                await run_in_thread(self.cache.set_artist_tag, artist, top_tag)
+        return top_tag.lower() if top_tag else None
+
+    async def get_data_for_days_async(self, list_of_dates: [datetime]) -> list:
+        """
+        Query last.fm for the user's scrobbles for each year
+        """
+        logger.info(f"Getting data from Last.fm for {self.username}...")
+        return list(await asyncio.gather(*[self.get_data_for_day_async(day) for day in list_of_dates]))
+
+    async def get_data_for_day_async(self, day: datetime) -> dict:
+        raw_data = await self.get_lastfm_tracks_for_day_async(day)
+        return {"day": day, "data": self.recenttracks_response_summary(raw_data)}
+
+    async def get_lastfm_tracks_for_day_async(self, date: datetime) -> list:
+        """
+        The user's scrobbles on a given day, requesting every page after the first at once
+        """
+        lastfm_response = await self.last_fm_api_query_async(**self.get_scrobbles_query(date, 1))
+        lastfm_tracks = self.get_page_tracks(lastfm_response)
+        num_pages = self.get_total_pages(lastfm_response)
+        if num_pages > 1:
+            page_responses = await asyncio.gather(*[
+                self.last_fm_api_query_async(**self.get_scrobbles_query(date, page_num))
+                for page_num in range(2, num_pages + 1)
+            ])
+            for page_response in page_responses:
+                lastfm_tracks.extend(self.get_page_tracks(page_response))
+        return self.remove_now_playing(lastfm_tracks, date)
+
+    async def get_scrobble_hashes_since_async(self, start_date: datetime) -> set:
+        """
+        Get a set of hashes of scrobbles since start_date
+        """
+        date_start_epoch = int(start_date.timestamp())
+        query = {"api_method": "user.getrecenttracks", "username": self.username, "_from": date_start_epoch}
+        track_hashes, num_pages = self.recent_track_hashes(await self.last_fm_api_query_async(page=1, **query))
+        page_responses = await asyncio.gather(*[
+            self.last_fm_api_query_async(page=page_num, **query) for page_num in range(2, num_pages + 1)
+        ])
+        for page_response in page_responses:
+            track_hashes.update(self.recent_track_hashes(page_response)[0])
+        return track_hashes
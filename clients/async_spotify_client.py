@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import os
+
+import aiohttp
+
+from clients import RetryException, run_in_thread
+from clients.monitoring_client import GoogleMonitoringClient
+from clients.spotify_client import SpotifyClient, DEFAULT_TRACKS_PER_YEAR, SPOTIFY_API_BASE_URL
+from clients.tracing import span
+
+logger = logging.getLogger(__name__)
+
+ASYNC_SPOTIFY_SEARCH_CONCURRENCY = int(os.getenv("ASYNC_SPOTIFY_SEARCH_CONCURRENCY") or 10)
+
+
+class AsyncSpotifyClient(SpotifyClient):
+    """
+    SpotifyClient that resolves playlist tracks with concurrent searches on an asyncio event loop.
+    Matching search results, the track index and the search cache are shared with SpotifyClient.
+    """
+
+    def __init__(self, http_session: aiohttp.ClientSession, *args, **kwargs):
+        """
+        :param http_session: Session shared by all requests on the event loop
+        """
+        super().__init__(*args, **kwargs)
+        self.http_session = http_session
+        self.semaphore = asyncio.Semaphore(ASYNC_SPOTIFY_SEARCH_CONCURRENCY)
+        self.access_token = None
+
+    async def select_playlist_tracks_async(
+            self,
+            data: list,
+            playlist_tracks_per_year: int = None,
+            playlist_order_recent_first: bool = True,
+            playlist_repeat_artists: bool = False,
+            recently_played_tracks: set = None,
+    ) -> list:
+        """
+        Choose the tracks for a playlist, searching for the likeliest tracks at once before choosing them in order
+        :return: Track URIs in playlist order
+        """
+        year_track_limit = playlist_tracks_per_year or DEFAULT_TRACKS_PER_YEAR
+        track_data = self.format_track_data(data, playlist_order_recent_first)
+        await self.prefetch_tracks_async(track_data, year_track_limit, recently_played_tracks)
+        # Anything not prefetched (e.g. when a top artist has no matching tracks) is searched for synchronously
+        return await run_in_thread(lambda: list(self.iter_tracks_for_playlist(
+            track_data, year_track_limit, playlist_repeat_artists, recently_played_tracks
+        )))
+
+    async def prefetch_tracks_async(self, artist_tracks: dict, year_track_limit: int,
+                                    recently_played_tracks: set = None):
+        """
+        Resolve the track iter_tracks_for_playlist will try first for each of the top artists of each year,
+        shuffling each artist's tracks the same way it does
+        :param artist_tracks: Formatted last.fm stats
+        :param year_track_limit: Max number of tracks to add per year
+        :param recently_played_tracks: Recently played tracks to skip
+        """
+        searches = []
+        for year, artist_track_data in artist_tracks.items():
+            for artist_dict in artist_track_data[:year_track_limit]:
+                tracks = self.shuffle_tracks(year, artist_dict["artist"], artist_dict["tracks"])
+                for track_name in dict.fromkeys(tracks):
+                    hash_key = hash(f"{artist_dict['artist']}{track_name}".lower())
+                    if not recently_played_tracks or hash_key not in recently_played_tracks:
+                        searches.append(self.resolve_track_async(artist_dict["artist"], track_name))
+                        break
+        logger.info(f"Prefetching {len(searches)} Spotify searches")
+        await asyncio.gather(*searches)
+
+    async def resolve_track_async(self, artist: str, track_name: str) -> dict:
+        """
+        resolve_track, searching Spotify on the event loop
+        :return: {"uri", "artist", "track_name"} of the matching Spotify track if found
+        """
+        return await self._resolve_track_async(artist, track_name) or None
+
+    async def _resolve_track_async(self, artist: str, track_name: str) -> dict or None:
+        """
+        :return: The matching Spotify track, None if not found or False if the search (or its retry) failed
+        """
+        key = (artist, track_name)
+        if key not in self.resolved_tracks:
+            resolved_track = await run_in_thread(self.track_index.get, self.available_market, artist, track_name)
+            if resolved_track:
+                self.track_index_hits += 1
+            else:
+                resolved_track = await self._search_track_async(artist, track_name)
+                if resolved_track is False:
+                    return False
+                if resolved_track:
+                    await run_in_thread(self.track_index.set, self.available_market, artist, track_name,
+                                        resolved_track)
+            self.resolved_tracks[key] = resolved_track
+        return self.resolved_tracks[key]
+
+    async def _search_track_async(self, artist: str, track_name: str) -> dict or None:
+        """
+        :return: The matching Spotify track, None if not found or False if the search failed
+        """
+        logger.info(f"SEARCH   :'{track_name}' by '{artist}'")
+        search_query = f"{track_name} {artist}"
+        cached_result = await run_in_thread(self.cache.get_cached_spotify_search_result,
+                                            search_query=search_query, available_market=self.available_market)
+        if cached_result:
+            self.search_cache_hits += 1
+            search_result = cached_result.get("search_result")
+        else:
+            self.search_cache_misses += 1
+            search_result = await self.spotify_search_request_async(search_query)
+            if search_result is None:
+                return False
+            await run_in_thread(self.cache.cache_spotify_search_result, search_query=search_query,
+                                available_market=self.available_market, search_result=search_result)
+        found_track, retry_search = self.match_search_result(artist, track_name, search_result)
+        if retry_search:
+            return await self._resolve_track_async(*retry_search)
+        return found_track
+
+    async def spotify_search_request_async(self, search_query: str) -> dict or None:
+        """
+        A Spotify track search
+        :return: The search result, or None if the request failed
+        """
+        if not self.access_token:
+            self.access_token = await run_in_thread(self.auth_manager.get_access_token, as_dict=False)
+        try:
+            async with self.semaphore:
+                GoogleMonitoringClient().increment_thread("spotify-search-request")
+                with span("spotify.search", search_query):
+                    async with self.http_session.get(
+                            f"{SPOTIFY_API_BASE_URL}/search", params=self.get_search_params(search_query),
+                            headers={"Authorization": f"Bearer {self.access_token}"}
+                    ) as response:
+                        if response.status in RetryException.retry_codes:
+                            GoogleMonitoringClient().increment_thread("spotify-retry-exception")
+                            logger.warning(f"{response.status} status code for Spotify search '{search_query}'")
+                            return None
+                        response.raise_for_status()
+                        return await response.json()
+        except Exception:
+            GoogleMonitoringClient().increment_thread("spotify-exception")
+            logger.exception(f"Unhandled Spotify search error for '{search_query}'")
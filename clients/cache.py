@@ -6,6 +6,7 @@ from datetime import datetime
 import pytz
 
 from clients.database import get_db_client
+from clients.log_events import log_event
 from clients.monitoring_client import stats_profile, GoogleMonitoringClient
 
 logger = logging.getLogger(__name__)
@@ -14,16 +15,30 @@ SHOPIFY_SEARCH_MAX_CACHE_AGE_HOURS = int(os.getenv("SHOPIFY_SEARCH_MAX_CACHE_AGE
 
 class Cache:
     def __init__(self):
-        self.db = get_db_client()
+        self._db = None
+
+    @property
+    def db(self):
+        """
+        The database client, connected on first use rather than at import
+        """
+        if self._db is None:
+            self._db = get_db_client()
+        return self._db
 
     def get_user(self, username):
         return self.db.get_document("users", username)
 
     def create_user(self, username, user_info):
-        self.db.set_document("users", username, {"user_info": user_info,  "days_visited": 0})
+        self.db.set_document("users", username, {"user_info": user_info, "user_info_updated": datetime.utcnow(),
+                                                 "days_visited": 0})
         self.get_user_count()
         return self.get_user(username)
 
+    def update_user_info(self, username, user_info):
+        self.db.set_document("users", username, {"user_info": user_info, "user_info_updated": datetime.utcnow()},
+                             merge=True)
+
     @stats_profile
     def get_user_data(self, username):
         return self.db.get_document("users", username)
@@ -32,23 +47,47 @@ class Cache:
         users = self.db.get_collection("users")
         user_count = len(users)
         if user_count:
-            GoogleMonitoringClient().increment_thread("user-count", user_count)
+            GoogleMonitoringClient().set_gauge("user-count", user_count)
         return user_count
 
     def update_user_artist_tags(self, username, artist_tags):
         self.db.set_document("users", username, {"artist_tags": artist_tags}, merge=True)
 
-    def set_user_data(self, username, data, date_cached=None, tz_offset=0):
-        self.db.set_document("users", username, {"data": data, "date_cached": date_cached, "tz_offset": tz_offset})
+    def set_user_data(self, username, data, date_cached=None, tz_offset=0, data_years=None):
+        """
+        :param data_years: The years cached separately with set_user_year_data, instead of in data
+        """
+        self.db.set_document("users", username, {"data": data, "date_cached": date_cached, "tz_offset": tz_offset,
+                                                 "data_years": data_years or []})
+
+    def set_user_year_data(self, username, day, data):
+        self.db.set_document("user_years", f"{username}-{day.year}", {"day": day, "data": data}, merge=False)
+
+    def get_user_year_data(self, username, year):
+        return self.db.get_document("user_years", f"{username}-{year}")
 
     @stats_profile
     def increment_user_days_visited(self, username):
         user = self.get_user(username)
         days_visited = user.get("days_visited", 1)
         days_visited += 1
-        self.db.set_document("users", username, {"days_visited": days_visited}, merge=True)
+        self.db.set_document("users", username, {"days_visited": days_visited, "last_visited": datetime.utcnow()},
+                             merge=True)
         logger.info(f"{username} has visited {days_visited} times!")
-        GoogleMonitoringClient().increment_thread("user-visits", days_visited)
+        GoogleMonitoringClient().time_series_thread("user-visits", days_visited)
+
+    def update_user_playlist_market(self, username, available_market):
+        self.db.set_document("users", username, {"playlist_market": available_market or ""}, merge=True)
+
+    def get_usernames_visited_since(self, since: datetime) -> list:
+        """
+        Users who visited (or, before last_visited was recorded, had their stats cached) since the UTC time
+        """
+        since = since.replace(tzinfo=pytz.utc)
+        usernames = set()
+        for field in ("last_visited", "date_cached"):
+            usernames.update(self.db.get_document_ids_since("users", field, since))
+        return sorted(usernames)
 
     def clear_user_data(self, username):
         self.db.set_document("users", username, {"data": None, "date_cached": None})
@@ -72,14 +111,14 @@ class Cache:
     def get_cached_spotify_search_result(self, search_query: str, available_market: str,
                                          max_age_hours: int = SHOPIFY_SEARCH_MAX_CACHE_AGE_HOURS):
         hash_key = hashlib.md5(f"{available_market}-{search_query}".encode()).hexdigest()
-        doc = self.db.get_document("spotify_search_cache", hash_key).get("search_result")
-        if doc:
+        doc = self.db.get_document("spotify_search_cache", hash_key)
+        if doc.get("search_result"):
             date_cached = doc.get("date_cached")
             cached_available_market = doc.get("available_market")
             cached_search_query = doc.get("search_query")
             if date_cached:
-                cache_age_seconds = (datetime.utcnow().replace(tzinfo=pytz.utc) - date_cached.replace(
-                    tzinfo=pytz.utc)).seconds
+                cache_age_seconds = int((datetime.utcnow().replace(tzinfo=pytz.utc) - date_cached.replace(
+                    tzinfo=pytz.utc)).total_seconds())
                 if cache_age_seconds / 3600 <= max_age_hours:
                     if not cached_available_market == available_market:
                         logger.info(f"CACHE ERROR cached_available_market != available_market! "
@@ -90,17 +129,18 @@ class Cache:
                                     f"{cached_search_query} != {search_query}")
                         GoogleMonitoringClient().increment_thread("spotify-search-cache-error")
                     else:
-                        logger.debug(
-                            f"Returning cached Spotify search result for '{available_market} - {search_query}'...")
+                        log_event(logger, "spotify.search_cache", logging.DEBUG, result="hit",
+                                  market=available_market, query=search_query)
                         GoogleMonitoringClient().increment_thread("spotify-search-cache-hit")
                         return doc
                 else:
-                    logger.info(
-                        f"Cache for '{available_market} - {search_query}' expired ({cache_age_seconds} seconds)")
+                    log_event(logger, "spotify.search_cache", result="expired", market=available_market,
+                              query=search_query, age_seconds=cache_age_seconds)
                     GoogleMonitoringClient().increment_thread("spotify-search-cache-expired")
             else:
-                logger.info(f"Cache for '{available_market} - {search_query}' has no date_cached")
+                log_event(logger, "spotify.search_cache", result="no-date", market=available_market,
+                          query=search_query)
                 GoogleMonitoringClient().increment_thread("spotify-search-cache-no-date")
         else:
-            logger.info(f"No cache for '{available_market} - {search_query}'")
+            log_event(logger, "spotify.search_cache", result="miss", market=available_market, query=search_query)
             GoogleMonitoringClient().increment_thread("spotify-search-cache-miss")
@@ -0,0 +1,128 @@
+"""
+Record Last.fm and Spotify responses to local cassettes and replay them without the network.
+
+    CASSETTE_MODE=record  python app.py   # real requests, responses saved to CASSETTE_DIR
+    CASSETTE_MODE=replay  python app.py   # responses served from CASSETTE_DIR, a missing one is a ConnectionError
+
+Requests are keyed by method, host, path, body and query params, leaving out CASSETTE_IGNORE_PARAMS (the API key by
+default). Repeated requests for the same key (e.g. retries) are replayed in the order they were recorded.
+CASSETTE_REPLAY_TIMING=original waits as long as the recorded response took, "fast" replays immediately.
+Only the requests made with the requests library are covered, not the aiohttp clients of the ASGI app.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from threading import Lock
+from urllib.parse import urlsplit, parse_qsl
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "").lower()
+CASSETTE_DIR = os.getenv("CASSETTE_DIR") or os.path.join(os.getcwd(), "local_cache", "cassettes")
+CASSETTE_REPLAY_TIMING = os.getenv("CASSETTE_REPLAY_TIMING", "original").lower()
+CASSETTE_IGNORE_PARAMS = set((os.getenv("CASSETTE_IGNORE_PARAMS") or "api_key").split(","))
+
+
+class CassetteMissError(requests.exceptions.ConnectionError):
+    pass
+
+
+class CassetteAdapter(HTTPAdapter):
+    def __init__(self, mode: str = CASSETTE_MODE, cassette_dir: str = CASSETTE_DIR,
+                 replay_timing: str = CASSETTE_REPLAY_TIMING, ignore_params: set = None, **kwargs):
+        super().__init__(**kwargs)
+        self.mode = mode
+        self.cassette_dir = cassette_dir
+        self.replay_timing = replay_timing
+        self.ignore_params = CASSETTE_IGNORE_PARAMS if ignore_params is None else ignore_params
+        self.replay_counts = {}
+        self.lock = Lock()
+
+    def get_key(self, request: requests.PreparedRequest) -> dict:
+        url = urlsplit(request.url)
+        params = sorted((k, v) for k, v in parse_qsl(url.query, keep_blank_values=True) if k not in self.ignore_params)
+        body = request.body.decode() if isinstance(request.body, bytes) else request.body
+        return {"method": request.method, "host": url.netloc, "path": url.path, "params": params, "body": body}
+
+    def get_path(self, key: dict) -> str:
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:20]
+        return os.path.join(self.cassette_dir, key["host"].replace(":", "_"), f"{digest}.json")
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        key = self.get_key(request)
+        path = self.get_path(key)
+        if self.mode == "replay":
+            return self.replay(request, key, path)
+        start = time.perf_counter()
+        response = super().send(request, **kwargs)
+        if self.mode == "record":
+            self.record(key, path, response, time.perf_counter() - start)
+        return response
+
+    def record(self, key: dict, path: str, response: requests.Response, seconds: float):
+        recording = {
+            "status_code": response.status_code,
+            "reason": response.reason,
+            "headers": {k: v for k, v in response.headers.items() if k.lower() in ("content-type", "retry-after")},
+            "body": response.content.decode("utf-8", errors="replace"),
+            "seconds": round(seconds, 4),
+        }
+        with self.lock:
+            cassette = self.load(path) or {"request": key, "responses": []}
+            cassette["responses"].append(recording)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(cassette, f)
+            os.replace(f"{path}.tmp", path)
+
+    def replay(self, request: requests.PreparedRequest, key: dict, path: str) -> requests.Response:
+        cassette = self.load(path)
+        if not cassette:
+            raise CassetteMissError(f"No recording for {key['method']} {key['host']}{key['path']} {key['params']}",
+                                    request=request)
+        with self.lock:
+            count = self.replay_counts.get(path, 0)
+            self.replay_counts[path] = count + 1
+        recording = cassette["responses"][count % len(cassette["responses"])]
+        if self.replay_timing == "original":
+            time.sleep(recording["seconds"])
+
+        response = requests.Response()
+        response.status_code = recording["status_code"]
+        response.reason = recording["reason"]
+        response.headers = CaseInsensitiveDict(recording["headers"])
+        response._content = recording["body"].encode()
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    @staticmethod
+    def load(path: str) -> dict or None:
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+
+def get_requests_session() -> requests.Session or None:
+    """
+    A requests session that records or replays its requests, or None if CASSETTE_MODE isn't set
+    """
+    if CASSETTE_MODE not in ("record", "replay"):
+        return None
+    session = requests.Session()
+    adapter = CassetteAdapter()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    logger.info(f"Cassette {CASSETTE_MODE} mode, cassettes in {CASSETTE_DIR}")
+    return session
+
+
+REQUESTS_SESSION = get_requests_session()
@@ -1,16 +1,20 @@
 import json
 import logging
 import os
+import re
 from copy import deepcopy
 from datetime import datetime, date
+from threading import RLock
 
 from dateutil.parser import parse
 
-import google
-from google.cloud import firestore_v1 as firestore
+from clients.tracing import traced
 
 logger = logging.getLogger(__name__)
 
+# Dates are stored as isoformat strings. Other strings (e.g. a track called "1999") are left alone.
+ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}(:\d{2}(\.\d+)?)?([+-]\d{2}:\d{2})?)?$")
+
 
 class Singleton(type):
     _instances = {}
@@ -31,6 +35,15 @@ class BaseDbClient(metaclass=Singleton):
     def get_collection(self, collection_name):
         raise NotImplementedError
 
+    def get_top_documents(self, collection_name, order_by, limit):
+        raise NotImplementedError
+
+    def get_document_ids_since(self, collection_name, field, since):
+        raise NotImplementedError
+
+    def increment_field(self, collection_name, document_id, field, amount):
+        raise NotImplementedError
+
     @staticmethod
     def strip_string(string):
         return str(string).strip().replace("/", "_").lower()
@@ -39,6 +52,9 @@ class BaseDbClient(metaclass=Singleton):
 class FirestoreClient(BaseDbClient):
 
     def __init__(self):
+        # Imported here so that starting without Firestore doesn't pay for the Google Cloud libraries
+        from google.cloud import firestore_v1 as firestore
+
         logger.info("Initializing FirestoreClient")
         creds, project, database_name = self._get_credentials_and_project()
         self.client = firestore.Client(
@@ -48,10 +64,13 @@ class FirestoreClient(BaseDbClient):
     @staticmethod
     def _get_credentials_and_project():
 
+        import google.auth
+
         database_name = os.getenv("FIRESTORE_DB",  "(default)")
         creds, project = google.auth.default()
         return creds, project, database_name
 
+    @traced("db.get_document")
     def get_document(self, collection_name: str, document_id: str):
         doc_ref = self.client.collection(collection_name).document(
             self.strip_string(document_id)
@@ -59,20 +78,57 @@ class FirestoreClient(BaseDbClient):
         doc = doc_ref.get()
         return doc.to_dict() or {}
 
+    @traced("db.get_collection")
     def get_collection(self, collection_name: str):
         return {doc.id: doc.to_dict() for doc in self.client.collection(collection_name).stream()}
 
+    @traced("db.get_top_documents")
+    def get_top_documents(self, collection_name: str, order_by: str, limit: int):
+        from google.cloud import firestore_v1 as firestore
+
+        query = self.client.collection(collection_name).order_by(
+            order_by, direction=firestore.Query.DESCENDING
+        ).limit(limit)
+        return {doc.id: doc.to_dict() for doc in query.stream()}
+
+    @traced("db.get_document_ids_since")
+    def get_document_ids_since(self, collection_name: str, field: str, since: datetime) -> list:
+        """
+        IDs of the documents whose field is a date on or after since, without reading the documents' other fields
+        """
+        from google.cloud.firestore_v1.base_query import FieldFilter
+        from google.cloud.firestore_v1.field_path import FieldPath
+
+        query = self.client.collection(collection_name).where(
+            filter=FieldFilter(field, ">=", since)
+        ).select([FieldPath.document_id()])
+        return [doc.id for doc in query.stream()]
+
+    @traced("db.set_document")
     def set_document(self, collection_name: str, document_id: str, data: dict, merge: bool=True):
         doc_ref = self.client.collection(collection_name).document(
             self.strip_string(document_id)
         )
         doc_ref.set(data, merge=merge)
 
+    @traced("db.increment_field")
+    def increment_field(self, collection_name: str, document_id: str, field: str, amount: int):
+        """
+        Add to a number field on the server, so that increments from other instances aren't overwritten
+        """
+        from google.cloud import firestore_v1 as firestore
+
+        doc_ref = self.client.collection(collection_name).document(
+            self.strip_string(document_id)
+        )
+        doc_ref.set({field: firestore.Increment(amount)}, merge=True)
+
 
 class LocalFiles(BaseDbClient):
     def __init__(self):
         logger.info("Initializing LocalUserClient")
         self.local_dir = self.get_or_create_local_dir()
+        self.lock = RLock()
 
     @staticmethod
     def get_or_create_local_dir():
@@ -82,8 +138,10 @@ class LocalFiles(BaseDbClient):
         return local_dir
 
     def _get_local_path(self, collection_name: str, doc_id: str):
-        return os.path.join(self.local_dir, f'{collection_name}/{doc_id}.json')
+        # Document IDs are normalized the same way as in Firestore, so "NickyReid" and "nickyreid" are one document
+        return os.path.join(self.local_dir, f'{collection_name}/{self.strip_string(doc_id)}.json')
 
+    @traced("db.get_document")
     def get_document(self, collection_name: str, document_id: str):
         logger.debug(f"Getting document {document_id} from collection {collection_name}")
         local_path = self._get_local_path(collection_name, document_id)
@@ -104,7 +162,7 @@ class LocalFiles(BaseDbClient):
                     data[key] = LocalFiles.deserialize(value)
                 elif isinstance(value, list):
                     data[key] = [LocalFiles.deserialize(item) for item in value]
-                else:
+                elif isinstance(value, str) and ISO_DATE.match(value):
                     try:
                         data[key] = parse(value)
                     except (TypeError, ValueError):
@@ -113,20 +171,28 @@ class LocalFiles(BaseDbClient):
             data = [LocalFiles.deserialize(item) for item in data]
         return data
 
+    @traced("db.set_document")
     def set_document(self, collection_name: str, document_id: str, new_data: dict, merge: bool=True):
         logger.debug(f"Setting document {document_id} in collection {collection_name} {new_data}")
         local_path = self._get_local_path(collection_name, document_id)
         if not os.path.exists(local_path):
             os.makedirs(os.path.dirname(local_path), exist_ok=True)
-        if not os.path.exists(local_path):
-            with open(local_path, 'w') as f:
-                json.dump({}, f)
 
-        data = self.get_document(collection_name, document_id) or {}
-        data.update({k: v for k, v in new_data.items() if v is not None})
-        data = self.serialize(deepcopy(data))
-        with open(local_path, 'w') as f:
-            json.dump(data, f)
+        # Concurrent requests write the same documents (e.g. artist tags), so the read-modify-write is locked and
+        # the file is replaced whole so readers never see it half written
+        with self.lock:
+            data = self.get_document(collection_name, document_id) or {}
+            data.update({k: v for k, v in new_data.items() if v is not None})
+            data = self.serialize(deepcopy(data))
+            with open(f"{local_path}.tmp", 'w') as f:
+                json.dump(data, f)
+            os.replace(f"{local_path}.tmp", local_path)
+
+    @traced("db.increment_field")
+    def increment_field(self, collection_name: str, document_id: str, field: str, amount: int):
+        with self.lock:
+            value = self.get_document(collection_name, document_id).get(field) or 0
+            self.set_document(collection_name, document_id, {field: value + amount})
 
     def serialize(self, data:dict):
         if isinstance(data, dict):
@@ -139,6 +205,7 @@ class LocalFiles(BaseDbClient):
                     data[key] = value.isoformat()
         return data
 
+    @traced("db.get_collection")
     def get_collection(self, collection_name: str):
         logger.debug(f"Getting collection {collection_name}")
         collection_dir = os.path.join(self.local_dir, collection_name)
@@ -146,10 +213,28 @@ class LocalFiles(BaseDbClient):
             return []
         docs = {}
         for doc in os.listdir(collection_dir):
+            if not doc.endswith(".json"):
+                continue
             with open(os.path.join(collection_dir, doc)) as json_file:
                 docs[doc.replace(".json", "")] = json.load(json_file)
         return docs
 
+    @traced("db.get_top_documents")
+    def get_top_documents(self, collection_name: str, order_by: str, limit: int):
+        docs = self.get_collection(collection_name) or {}
+        top_doc_ids = sorted(docs, key=lambda doc_id: docs[doc_id].get(order_by) or 0, reverse=True)[:limit]
+        return {doc_id: self.deserialize(docs[doc_id]) for doc_id in top_doc_ids}
+
+    @traced("db.get_document_ids_since")
+    def get_document_ids_since(self, collection_name: str, field: str, since: datetime) -> list:
+        docs = self.get_collection(collection_name) or {}
+        doc_ids = []
+        for doc_id, doc in docs.items():
+            value = self.deserialize({field: doc.get(field)})[field]
+            if isinstance(value, datetime) and value.replace(tzinfo=None) >= since.replace(tzinfo=None):
+                doc_ids.append(doc_id)
+        return doc_ids
+
 
 def get_db_client():
     if 'GOOGLE_CLOUD_PROJECT' in os.environ:
@@ -0,0 +1,81 @@
+"""
+Plans how to fetch the user's scrobbles for each year of their stats, from their total playcount and account age.
+
+- years: a worker per year, each fetching its year's pages in order (the default, and the plan without a playcount)
+- pages: the first page of every year at once, then the remaining pages of every year spread over the workers
+- history: one range query over all the years, split into years locally. Cheaper when the history is so sparse that
+  most years' queries would come back with a page or less.
+
+A plan predicts the requests it will make and the rounds of requests (requests that have to wait for an earlier one),
+and the actual requests and seconds are logged next to the prediction, so FETCH_PLANNER_PAGE_SECONDS and
+FETCH_PLANNER_HISTORY_SHARE can be tuned.
+"""
+import logging
+import math
+import os
+from datetime import datetime
+
+from clients.monitoring_client import GoogleMonitoringClient
+
+logger = logging.getLogger(__name__)
+
+FETCH_PLANNER = os.getenv("FETCH_PLANNER", "false").lower() == "true"
+FETCH_PLANNER_PAGE_SECONDS = float(os.getenv("FETCH_PLANNER_PAGE_SECONDS") or 0.5)
+# Fetch the whole history when it takes at most this share of the requests of fetching each year
+FETCH_PLANNER_HISTORY_SHARE = float(os.getenv("FETCH_PLANNER_HISTORY_SHARE") or 0.5)
+LASTFM_PAGE_SIZE = 200  # The limit get_api_url asks for
+
+
+class FetchPlan:
+    def __init__(self, strategy: str, workers: int, requests: int, rounds: int, pages_per_year: int = 1):
+        self.strategy = strategy
+        self.workers = workers
+        self.requests = requests
+        self.rounds = rounds
+        self.pages_per_year = pages_per_year
+
+    @property
+    def seconds(self) -> float:
+        return self.rounds * FETCH_PLANNER_PAGE_SECONDS
+
+    def __repr__(self):
+        return (f"FetchPlan({self.strategy}, workers={self.workers}, requests={self.requests}, rounds={self.rounds}, "
+                f"pages_per_year={self.pages_per_year})")
+
+    def log_result(self, username: str, requests: int, seconds: float):
+        logger.info(f"Fetch plan {self.strategy} for {username}: predicted {self.requests} requests in "
+                    f"{self.seconds:.2f} seconds, actual {requests} requests in {seconds:.2f} seconds")
+        GoogleMonitoringClient().increment_thread(f"fetch-plan-{self.strategy}")
+
+
+def plan_fetch(years: int, max_workers: int, total_tracks: int = None, join_date: datetime = None,
+               now: datetime = None) -> FetchPlan:
+    """
+    :param years: The number of years to fetch a day of scrobbles for
+    :param max_workers: The most requests to make at once for the pages and history plans
+    :param total_tracks: The user's playcount
+    :param join_date: When the user joined Last.fm
+    """
+    years_plan = FetchPlan("years", years, years, 1)
+    if not years or not total_tracks or not join_date:
+        return years_plan
+
+    account_days = max(1, ((now or datetime.utcnow()) - join_date.replace(tzinfo=None)).days)
+    scrobbles_per_day = total_tracks / account_days
+    pages_per_year = max(1, math.ceil(scrobbles_per_day / LASTFM_PAGE_SIZE))
+    year_requests = years * pages_per_year
+    years_plan = FetchPlan("years", years, year_requests, pages_per_year, pages_per_year)
+
+    history_pages = max(1, math.ceil(total_tracks / LASTFM_PAGE_SIZE))
+    if history_pages <= year_requests * FETCH_PLANNER_HISTORY_SHARE:
+        workers = max(1, min(max_workers, history_pages - 1))
+        return FetchPlan("history", workers, history_pages, 1 + math.ceil((history_pages - 1) / workers))
+
+    if pages_per_year > 1:
+        workers = min(max_workers, max(years, year_requests - years))
+        pages_plan = FetchPlan("pages", workers, year_requests,
+                               math.ceil(years / workers) + math.ceil((year_requests - years) / workers),
+                               pages_per_year)
+        if pages_plan.rounds < years_plan.rounds:
+            return pages_plan
+    return years_plan
@@ -1,37 +1,144 @@
+import json
 import logging
 import os
-from concurrent.futures import ThreadPoolExecutor
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from datetime import datetime, timedelta
+from threading import Lock, Thread
 
 import pytz
 import requests
 from dateutil.relativedelta import relativedelta
-from dotenv import load_dotenv
 
-from clients import RetryException, retry
+from clients import RetryException, retry, submit_in_context
 from clients.cache import Cache
+from clients.cassette import REQUESTS_SESSION
+from clients.fetch_planner import FETCH_PLANNER, FetchPlan, plan_fetch
+from clients.lastfm_scheduler import LastfmScheduler
+from clients.log_events import log_event
 from clients.monitoring_client import GoogleMonitoringClient, stats_profile
+from clients.tracing import span, traced
 
 logger = logging.getLogger(__name__)
 
-
-load_dotenv()
 LAST_FM_API_KEY = os.getenv("LAST_FM_API_KEY")
-LAST_FM_BASE_URL = "http://ws.audioscrobbler.com/2.0"
+LAST_FM_BASE_URL = os.getenv("LAST_FM_BASE_URL") or "http://ws.audioscrobbler.com/2.0"
 HEADERS = {"User-Agent": "LasthopWeb/1.0"}
 ADD_ARTIST_TAGS = True
 INCLUDE_THIS_YEAR = False
+LASTFM_USER_NOT_FOUND_ERROR = 6
+LASTFM_LOGIN_REQUIRED_ERROR = 17
+# Errors that mean the user's scrobbles can't be seen (e.g. a private profile), so there are none to show
+LASTFM_NO_SCROBBLES_ERRORS = (LASTFM_USER_NOT_FOUND_ERROR, LASTFM_LOGIN_REQUIRED_ERROR)
 MAX_WORKERS = int(os.getenv("RECENT_TRACKS_WORKERS") or 20)
+STREAM_RECENT_TRACKS = os.getenv("STREAM_RECENT_TRACKS", "false").lower() == "true"
+
+
+class LastfmResponseError(Exception):
+    """
+    A Last.fm response without the expected data, e.g. an "Operation failed" error for one page of a user's scrobbles
+    """
+    pass
+
+
+# (username, tz_offset, local date): the futures for each year, for fetches still running after a deadline
+pending_fetches = {}
+pending_fetches_lock = Lock()
+
+
+def slim_recent_track(obj: dict) -> dict:
+    """
+    json object_hook for user.getrecenttracks: replaces each track with the fields recenttracks_response_summary,
+    remove_now_playing and recent_track_hashes read
+    """
+    if "artist" not in obj or "name" not in obj:
+        return obj
+    track = {"artist": {"#text": obj["artist"].get("#text")}, "name": obj["name"]}
+    if "date" in obj:
+        track["date"] = {"uts": obj["date"].get("uts")}
+    if "@attr" in obj:
+        track["@attr"] = obj["@attr"]
+    return track
+
+
+class YearSummary:
+    """
+    The scrobbles for one year, grouped by artist as pages of them arrive from Last.fm
+    """
+    def __init__(self, day: datetime, day_start: datetime, tz_offset: int):
+        """
+        :param day: The day of the year being summarized
+        :param day_start: The start of today in the user's timezone, in UTC
+        """
+        self.day = day
+        self.tz_offset = tz_offset
+        year_diff = abs(day_start.year - day.year)
+        self.start_time = day_start - relativedelta(years=year_diff)
+        self.end_time = self.start_time + timedelta(hours=23, minutes=59, seconds=59, microseconds=999999)
+        self.artist_scrobble_dict = {}
+        self.scrobble_list = []
+
+    def add(self, scrobbles: list):
+        """
+        :param scrobbles: [{"artist", "track_name", "timestamp"}], scrobbles outside the day are skipped
+        """
+        for scrobble in scrobbles:
+            timestamp = scrobble["timestamp"]
+            if not timestamp:
+                continue
+
+            scrobbled_date = datetime.fromtimestamp(int(timestamp), tz=pytz.UTC)
+            if not (self.start_time <= scrobbled_date <= self.end_time):
+                continue
+
+            artist = scrobble["artist"]
+            track_name = scrobble["track_name"]
+
+            track_date_dict = {
+                "track_name": track_name,
+                "date": scrobbled_date - timedelta(minutes=self.tz_offset),
+                "artist": artist,
+            }
+            if not self.artist_scrobble_dict.get(artist):
+                self.artist_scrobble_dict[artist] = {
+                    "playcount": 1,
+                    "tracks": [track_date_dict],
+                }
+            else:
+                self.artist_scrobble_dict[artist]["playcount"] += 1
+                self.artist_scrobble_dict[artist]["tracks"].append(track_date_dict)
+            self.scrobble_list.append(track_date_dict)
+
+    def get_scrobbles(self) -> list:
+        """
+        The scrobbles kept, in the format add takes, to cache
+        """
+        return [{
+            "artist": scrobble["artist"],
+            "track_name": scrobble["track_name"],
+            "timestamp": str(int((scrobble["date"] + timedelta(minutes=self.tz_offset)).timestamp())),
+        } for scrobble in self.scrobble_list]
 
 
 class LastfmClient:
-    def __init__(self, lastfm_username: str, lastfm_join_date: datetime, tz_offset: int = 0):
+    def __init__(self, lastfm_username: str, lastfm_join_date: datetime, tz_offset: int = 0, day: datetime = None,
+                 total_tracks: int = None):
+        """
+        :param day: The local day to get stats for (defaults to today)
+        :param total_tracks: The user's playcount, to plan how to fetch their scrobbles
+        """
         self.username = lastfm_username
         self.join_date = lastfm_join_date.replace(tzinfo=pytz.UTC)
         self.tz_offset = tz_offset
+        self.total_tracks = total_tracks
+        self.scrobble_requests = 0
+        self.scrobble_requests_lock = Lock()
+        self.partial = False
+        self.failed = False
         self.api_key = LAST_FM_API_KEY
         self.cache = Cache()
-        today = datetime.utcnow() - timedelta(minutes=tz_offset)
+        self.today = day or datetime.utcnow() - timedelta(minutes=tz_offset)
+        today = self.today
         if INCLUDE_THIS_YEAR:
             self.stats_start_date = today
         else:
@@ -47,21 +154,22 @@ class LastfmClient:
         """
         A GET request to Last.fm API
         """
-        params = [f"&{k.replace('_', '')}={v}" for k, v in args.items()]
-        api_url = (
-            f"{LAST_FM_BASE_URL}/?method={api_method}"
-            f"&api_key={LAST_FM_API_KEY}"
-            f"&format=json"
-            f"&limit=200"
-            f"{''.join(params)}"
-        )
+        api_url = cls.get_api_url(api_method, **args)
 
         try:
-            response = requests.get(api_url, headers=HEADERS)
+            GoogleMonitoringClient().increment_thread("lastfm-request")
+            with LastfmScheduler().slot((args.get("username") or "").lower()):
+                with span("lastfm", cls.get_span_detail(api_method, args)):
+                    start = time.perf_counter()
+                    response = (REQUESTS_SESSION or requests).get(api_url, headers=HEADERS)
+            log_event(logger, "lastfm.request", method=api_method, status=response.status_code,
+                      seconds=round(time.perf_counter() - start, 4))
             if response.status_code in RetryException.retry_codes:
                 raise RetryException(
                     f"WARNING:  {response.status_code} status code for {api_method}. {response.content}"
                 )
+            if api_method == "user.getrecenttracks":
+                return cls.decode_recent_tracks_page(response.content)
             return response.json()
 
         except RetryException:
@@ -71,7 +179,37 @@ class LastfmClient:
             GoogleMonitoringClient().increment_thread("lastfm-exception")
             logger.exception(f"Unhandled exception for Last.fm {api_method}")
 
-    def get_stats(self) -> (list, datetime):
+    @staticmethod
+    def decode_recent_tracks_page(content: bytes) -> dict:
+        """
+        Parse a page of user.getrecenttracks keeping only each track's artist, name, date and now playing flag.
+        Each track's images, album, MBIDs and URLs are dropped as soon as the track is parsed, so a page holds about a
+        quarter of the memory of the full response.
+        """
+        return json.loads(content, object_hook=slim_recent_track)
+
+    @staticmethod
+    def get_span_detail(api_method: str, args: dict) -> str:
+        return " ".join([api_method, *[f"{k}={v}" for k, v in args.items() if k in ("page", "artist", "_from")]])
+
+    @staticmethod
+    def get_api_url(api_method: str, **args) -> str:
+        params = [f"&{k.replace('_', '')}={v}" for k, v in args.items()]
+        return (
+            f"{LAST_FM_BASE_URL}/?method={api_method}"
+            f"&api_key={LAST_FM_API_KEY}"
+            f"&format=json"
+            f"&limit=200"
+            f"{''.join(params)}"
+        )
+
+    def get_cached_data(self, lazy: bool = False) -> (list, dict, datetime):
+        """
+        The user's cached scrobbles, if they were cached today for this timezone
+        :param lazy: Return the years cached separately by the streaming pipeline as a generator that reads one at a
+        time, rather than a list
+        :return: (data, artist_tags, date_cached)
+        """
         data = None
         date_cached = None
         artist_tags = None
@@ -86,34 +224,153 @@ class LastfmClient:
                 if date_cached_localized.date() == now_localized.date():
                     if self.tz_offset == tz_offset_cached:
                         logger.info(f"Data cached for {self.username} at {date_cached_localized} -> Data is for today")
-                        data = cached_data["data"]
+                        data_years = cached_data.get("data_years")
+                        if data_years:
+                            data = self.iter_cached_years(data_years)
+                            if not lazy:
+                                data = list(data)
+                        else:
+                            data = cached_data["data"]
                         artist_tags = cached_data.get("artist_tags")
                     else:
                         logger.info(
                             f"Data cached for {self.username} at {date_cached} -> Data is not for this timezone")
                 else:
                     logger.info(f"Data cached for {self.username} at {date_cached} -> Data is not for today")
+        return data, artist_tags, date_cached
 
+    def iter_cached_years(self, years: list):
+        for year in years:
+            year_data = self.cache.get_user_year_data(self.username, year)
+            if year_data:
+                yield {"day": year_data["day"], "data": year_data["data"]}
+
+    def get_stats(self, deadline: float = None) -> (list, datetime):
+        """
+        :param deadline: Seconds to wait for Last.fm, 0 to only check on a fetch already running. The years fetched
+        by then are summarized and self.partial is set, and the other years keep fetching in the background.
+        See get_data_for_days_before_deadline.
+        With STREAM_RECENT_TRACKS the deadline is ignored and every year is waited for.
+        """
+        if STREAM_RECENT_TRACKS:
+            return self.get_stats_streaming()
+        data, artist_tags, date_cached = self.get_cached_data()
         if not data:
             dates = self.get_list_of_year_dates()
-            data = self.get_data_for_days(dates)
             date_cached = datetime.utcnow()
-            self.cache.set_user_data(self.username, data, datetime.utcnow(), self.tz_offset)
-            self.cache.increment_user_days_visited(self.username)
+            if deadline is not None:
+                data = self.get_data_for_days_before_deadline(dates, deadline)
+            else:
+                data = self.get_data_for_days(dates)
+                self.cache_data(data, date_cached)
         summary = self.summarize_and_filter_for_timezone(data, artist_tags)
         return summary, date_cached.replace(tzinfo=pytz.UTC) - timedelta(minutes=self.tz_offset)
 
+    @stats_profile
+    def get_stats_streaming(self) -> (list, datetime):
+        """
+        get_stats without holding every year's scrobbles at once. See iter_summaries_streaming.
+        """
+        data, artist_tags, date_cached = self.get_cached_data(lazy=True)
+        if data:
+            summary = self.summarize_and_filter_for_timezone(data, artist_tags)
+        else:
+            date_cached = datetime.utcnow()
+            summary = sorted(self.iter_summaries_streaming(date_cached), key=lambda d: d["day"], reverse=True)
+        return summary, date_cached.replace(tzinfo=pytz.UTC) - timedelta(minutes=self.tz_offset)
+
+    def iter_summaries_streaming(self, date_cached: datetime):
+        """
+        Yield the summary for each year as its last page arrives from Last.fm.
+        Each worker summarizes its year page by page and caches it in its own document as soon as it's done, so only
+        one page per worker and the summaries are held, rather than every year's scrobbles, the summaries and the
+        document written to the cache.
+        """
+        dates = self.get_list_of_year_dates()
+        day_start = self.get_day_start()
+        artist_tags = {}
+        years = []
+        if dates:
+            logger.info(f"Streaming pages from Last.fm for {self.username}...")
+            with ThreadPoolExecutor(max_workers=len(dates)) as executor:
+                futures = [submit_in_context(executor, self.summarize_day_streaming, day, day_start) for day in dates]
+                for future in as_completed(futures):
+                    year_summary = future.result()
+                    years.append(year_summary.day.year)
+                    summary = self.get_year_summary_result(year_summary, artist_tags)
+                    if summary:
+                        yield summary
+        self.cache.set_user_data(self.username, [], date_cached, self.tz_offset,
+                                 data_years=sorted(years, reverse=True))
+        self.cache.increment_user_days_visited(self.username)
+        if artist_tags:
+            self.cache.update_user_artist_tags(self.username, artist_tags)
+
+    def summarize_day_streaming(self, day: datetime, day_start: datetime) -> YearSummary:
+        """
+        Summarize a year's scrobbles a page at a time and cache them
+        """
+        year_summary = YearSummary(day, day_start, self.tz_offset)
+        for lastfm_tracks in self.iter_lastfm_pages_for_day(day):
+            year_summary.add(self.recenttracks_response_summary(lastfm_tracks))
+        self.cache.set_user_year_data(self.username, day, year_summary.get_scrobbles())
+        return year_summary
+
+    def iter_stats(self):
+        """
+        Yield the summary for each year as soon as Last.fm returns its data, then cache the data for all years
+        """
+        data, artist_tags, _ = self.get_cached_data(lazy=STREAM_RECENT_TRACKS)
+        if data:
+            yield from self.summarize_and_filter_for_timezone(data, artist_tags)
+            return
+        if STREAM_RECENT_TRACKS:
+            yield from self.iter_summaries_streaming(datetime.utcnow())
+            return
+
+        dates = self.get_list_of_year_dates()
+        data = []
+        artist_tags = {}
+        day_start = self.get_day_start()
+        if dates:
+            logger.info(f"Streaming data from Last.fm for {self.username}...")
+            with ThreadPoolExecutor(max_workers=len(dates)) as executor:
+                futures = [submit_in_context(executor, self.get_data_for_day, day) for day in dates]
+                for future in as_completed(futures):
+                    day_data = future.result()
+                    data.append(day_data)
+                    summary = self.summarize_day(day_data, day_start, artist_tags)
+                    if summary:
+                        yield summary
+        data.sort(key=lambda d: d["day"], reverse=True)
+        self.cache_data(data, datetime.utcnow())
+        if artist_tags:
+            self.cache.update_user_artist_tags(self.username, artist_tags)
+
+    def cache_data(self, data: list, date_cached: datetime):
+        """
+        Cache the user's scrobbles for today and count the visit
+        """
+        self.cache.set_user_data(self.username, data, date_cached, self.tz_offset)
+        self.cache.increment_user_days_visited(self.username)
+
     @classmethod
-    def get_lastfm_user_data(cls, username: str) -> dict:
+    def get_lastfm_user_data(cls, username: str) -> dict or None:
         """
         Get the User's Last.fm profile information
+        :return: {} if Last.fm doesn't know the user, None if Last.fm couldn't be queried
         """
         logger.info(f"Getting last.fm user data for {username}")
         api_response = cls.last_fm_api_query(
             api_method="user.getinfo", username=username
         )
+        if not api_response:
+            return None
         if not api_response.get("user"):
-            return {}
+            if api_response.get("error") == LASTFM_USER_NOT_FOUND_ERROR:
+                return {}
+            logger.info(f"Unexpected Last.fm user.getinfo response for {username}: {api_response}")
+            return None
         return {
             "username": api_response["user"]["name"],
             "join_date": datetime.fromtimestamp(
@@ -130,81 +387,78 @@ class LastfmClient:
         """
         logger.info(f"Summarizing data for {self.username} timezone offset = {self.tz_offset}...")
         result = []
-        today = (datetime.utcnow()).replace(tzinfo=pytz.UTC) - timedelta(minutes=self.tz_offset)
-        o_start_time = today.replace(hour=0).replace(minute=0).replace(
+        day_start = self.get_day_start()
+        if artist_tags is None:
+            artist_tags = {}
+        known_tag_count = len(artist_tags)
+        for line in data:
+            summary = self.summarize_day(line, day_start, artist_tags)
+            if summary:
+                result.append(summary)
+        if len(artist_tags) > known_tag_count:
+            self.cache.update_user_artist_tags(self.username, artist_tags)
+        sorted_result = sorted(result, key=lambda d: d["day"], reverse=True)
+        return sorted_result
+
+    def get_day_start(self) -> datetime:
+        """
+        The start of today in the user's timezone, in UTC
+        """
+        today = self.today.replace(tzinfo=pytz.UTC)
+        return today.replace(hour=0).replace(minute=0).replace(
             second=0).replace(
             microsecond=0
         ) + timedelta(minutes=self.tz_offset)
-        for line in data:
-            start_time = o_start_time
-            data = line["data"]
-            artist_scrobble_dict = {}
-            scrobble_list = []
-            year_diff = abs(o_start_time.year - line["day"].year)
-            try:
-                start_time = o_start_time - relativedelta(years=year_diff)
-                end_time = start_time + timedelta(hours=23, minutes=59, seconds=59, microseconds=999999)
-            except ValueError:
-                logger.exception(start_time)
-                continue
-            for scrobble in data:
-                timestamp = scrobble["timestamp"]
-                if not timestamp:
-                    continue
-
-                scrobbled_date = datetime.fromtimestamp(int(timestamp), tz=pytz.UTC)
-                if not (start_time <= scrobbled_date <= end_time):
-                    continue
 
-                artist = scrobble["artist"]
-                track_name = scrobble["track_name"]
-
-                track_date_dict = {
-                    "track_name": track_name,
-                    "date": scrobbled_date - timedelta(minutes=self.tz_offset),
-                    "artist": artist,
-                }
-                if not artist_scrobble_dict.get(artist):
-                    artist_scrobble_dict[artist] = {
-                        "playcount": 1,
-                        "tracks": [track_date_dict],
-                    }
-                else:
-                    artist_scrobble_dict[artist]["playcount"] += 1
-                    artist_scrobble_dict[artist]["tracks"].append(track_date_dict)
-                scrobble_list.append(track_date_dict)
-            if artist_scrobble_dict:
-                artist_scrobble_list = []
-                for artist, track_data in artist_scrobble_dict.items():
-                    artist_scrobble_list.append(
-                        {"artist": artist, "track_data": track_data}
-                    )
-                artist_scrobble_list = sorted(
-                    artist_scrobble_list,
-                    key=lambda d: d["track_data"]["playcount"],
-                    reverse=True,
-                )
-                if ADD_ARTIST_TAGS:
-                    top_artist_d = artist_scrobble_list[0]["artist"].lower()
-                    if not artist_tags:
-                        artist_tags = {}
-                    if artist_tags.get(top_artist_d):
-                        artist_scrobble_list[0]["tag"] = artist_tags[top_artist_d]
-                    else:
-                        top_tag = self.get_top_tag_for_artist(top_artist_d)
-                        if top_tag:
-                            artist_tags.update({top_artist_d: top_tag})
-                            self.cache.update_user_artist_tags(self.username, artist_tags)
-                            artist_scrobble_list[0]["tag"] = top_tag
-                result.append(
-                    {
-                        "day": start_time - timedelta(minutes=self.tz_offset),
-                        "data": artist_scrobble_list,
-                        "scrobble_list": scrobble_list,
-                    }
-                )
-        sorted_result = sorted(result, key=lambda d: d["day"], reverse=True)
-        return sorted_result
+    def summarize_day(self, line: dict, day_start: datetime, artist_tags: dict) -> dict or None:
+        """
+        Summarize the user's scrobbles for one year
+        :param line: {"day", "data"} for the year
+        :param day_start: The start of today in the user's timezone, in UTC
+        :param artist_tags: Known artist tags, updated with any new tags for the caller to cache
+        :return: {"day", "data", "scrobble_list"} or None if there were no scrobbles
+        """
+        try:
+            year_summary = YearSummary(line["day"], day_start, self.tz_offset)
+        except ValueError:
+            logger.exception(day_start)
+            return None
+        year_summary.add(line["data"])
+        return self.get_year_summary_result(year_summary, artist_tags)
+
+    def get_year_summary_result(self, year_summary: YearSummary, artist_tags: dict) -> dict or None:
+        """
+        :param artist_tags: Known artist tags, updated with any new tags for the caller to cache
+        :return: {"day", "data", "scrobble_list"} or None if there were no scrobbles
+        """
+        artist_scrobble_dict = year_summary.artist_scrobble_dict
+        if not artist_scrobble_dict:
+            return None
+
+        artist_scrobble_list = []
+        for artist, track_data in artist_scrobble_dict.items():
+            artist_scrobble_list.append(
+                {"artist": artist, "track_data": track_data}
+            )
+        artist_scrobble_list = sorted(
+            artist_scrobble_list,
+            key=lambda d: d["track_data"]["playcount"],
+            reverse=True,
+        )
+        if ADD_ARTIST_TAGS:
+            top_artist_d = artist_scrobble_list[0]["artist"].lower()
+            if artist_tags.get(top_artist_d):
+                artist_scrobble_list[0]["tag"] = artist_tags[top_artist_d]
+            else:
+                top_tag = self.get_top_tag_for_artist(top_artist_d)
+                if top_tag:
+                    artist_tags.update({top_artist_d: top_tag})
+                    artist_scrobble_list[0]["tag"] = top_tag
+        return {
+            "day": year_summary.start_time - timedelta(minutes=self.tz_offset),
+            "data": artist_scrobble_list,
+            "scrobble_list": year_summary.scrobble_list,
+        }
 
     @stats_profile
     def get_data_for_days(self, list_of_dates: [datetime]) -> list:
@@ -213,17 +467,128 @@ class LastfmClient:
         """
         result = []
         if list_of_dates:
-            logger.info(f"Getting data from Last.fm for {self.username}...")
-            with ThreadPoolExecutor(max_workers=len(list_of_dates)) as executor:
-                futures = []
-                for day in list_of_dates:
-                    futures.append(executor.submit(self.get_data_for_day, day))
+            plan = self.get_fetch_plan(list_of_dates)
+            logger.info(f"Getting data from Last.fm for {self.username} with {plan}...")
+            scrobble_requests = self.scrobble_requests
+            start = time.perf_counter()
+            if plan.strategy == "history":
+                result = self.get_data_for_days_from_history(list_of_dates, plan.workers)
+            elif plan.strategy == "pages":
+                result = self.get_data_for_days_by_page(list_of_dates, plan.workers)
+            else:
+                with ThreadPoolExecutor(max_workers=plan.workers) as executor:
+                    futures = []
+                    for day in list_of_dates:
+                        futures.append(submit_in_context(executor, self.get_data_for_day, day))
+
+                    for future in futures:
+                        result.append(future.result())
+            if FETCH_PLANNER:
+                plan.log_result(self.username, self.scrobble_requests - scrobble_requests,
+                                time.perf_counter() - start)
+
+        return result
+
+    def get_data_for_days_before_deadline(self, list_of_dates: [datetime], deadline: float) -> list:
+        """
+        Query last.fm for the user's scrobbles for each year, returning the years fetched within deadline seconds.
+        The fetch carries on in the background and caches every year once they're all fetched, so partial data is
+        never cached. Requests for the same user while it runs wait on the same fetch rather than starting another.
+        If a year couldn't be fetched, self.failed is set instead of self.partial and the other years are returned.
+        Years are always fetched by a worker each, whatever FETCH_PLANNER would plan: the "pages" and "history" plans
+        only finish their years once every page is in, so they have no years to return at the deadline.
+        """
+        if not list_of_dates:
+            return []
+        key = (self.username, self.tz_offset, self.today.date())
+        with pending_fetches_lock:
+            futures = pending_fetches.get(key)
+            if futures is None:
+                executor = ThreadPoolExecutor(max_workers=len(list_of_dates))
+                futures = [submit_in_context(executor, self.get_data_for_day, day) for day in list_of_dates]
+                executor.shutdown(wait=False)
+                pending_fetches[key] = futures
+                Thread(target=self.cache_when_fetched, args=(key, futures), name=f"cache_when_fetched_{self.username}",
+                       daemon=True).start()
+
+        done, not_done = wait(futures, timeout=deadline)
+        fetched = [future for future in futures if future in done and not future.exception()]
+        if len(fetched) < len(done):
+            self.failed = True
+            logger.info(f"{len(done) - len(fetched)} of {len(futures)} years for {self.username} couldn't be fetched, "
+                        f"returning the years fetched")
+            GoogleMonitoringClient().increment_thread("stats-failed")
+        elif not_done:
+            self.partial = True
+            logger.info(f"{len(not_done)} of {len(futures)} years for {self.username} not fetched in {deadline} "
+                        f"seconds, returning partial stats")
+            GoogleMonitoringClient().increment_thread("stats-partial")
+        return [future.result() for future in fetched]
+
+    def cache_when_fetched(self, key: tuple, futures: list):
+        try:
+            data = [future.result() for future in futures]
+            self.cache_data(data, datetime.utcnow())
+        except Exception:
+            logger.exception(f"Not caching data for {self.username}, couldn't fetch every year")
+        finally:
+            with pending_fetches_lock:
+                pending_fetches.pop(key, None)
 
-                for future in futures:
-                    result.append(future.result())
+    def get_fetch_plan(self, list_of_dates: [datetime]) -> FetchPlan:
+        if not FETCH_PLANNER:
+            return FetchPlan("years", len(list_of_dates), len(list_of_dates), 1)
+        return plan_fetch(len(list_of_dates), MAX_WORKERS, self.total_tracks, self.join_date)
 
+    def get_data_for_days_by_page(self, list_of_dates: [datetime], workers: int) -> list:
+        """
+        Query last.fm for the first page of every year at once, then the remaining pages of every year
+        """
+        futures = {day: [] for day in list_of_dates}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            first_pages = {submit_in_context(executor, self.lastfm_api_get_scrobbles, day, 1): day
+                           for day in list_of_dates}
+            for future in as_completed(first_pages):
+                day = first_pages[future]
+                futures[day].append(future)
+                for page_num in range(2, self.get_total_pages(future.result()) + 1):
+                    futures[day].append(submit_in_context(executor, self.lastfm_api_get_scrobbles, day, page_num))
+
+            result = []
+            for day in list_of_dates:
+                lastfm_tracks = self.remove_now_playing(self.get_page_tracks(futures[day][0].result()), day)
+                for future in futures[day][1:]:
+                    lastfm_tracks.extend(self.get_page_tracks(future.result()))
+                result.append({"day": day, "data": self.recenttracks_response_summary(lastfm_tracks)})
         return result
 
+    def get_data_for_days_from_history(self, list_of_dates: [datetime], workers: int) -> list:
+        """
+        Query last.fm once for all the user's scrobbles from the first day to the last, and keep each day's
+        """
+        queries = [self.get_scrobbles_query(day, 1) for day in list_of_dates]
+        date_from = min(query["_from"] for query in queries)
+        date_to = max(query["to"] for query in queries)
+        pages = [self.lastfm_api_get_scrobbles_between(date_from, date_to, 1)]
+        num_pages = self.get_total_pages(pages[0])
+        if num_pages > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [submit_in_context(executor, self.lastfm_api_get_scrobbles_between, date_from, date_to,
+                                             page_num) for page_num in range(2, num_pages + 1)]
+                pages.extend(future.result() for future in futures)
+
+        data = {day: [] for day in list_of_dates}
+        for page in pages:
+            for scrobble in self.recenttracks_response_summary(self.get_page_tracks(page)):
+                if not scrobble["timestamp"]:  # Currently playing
+                    continue
+                timestamp = int(scrobble["timestamp"])
+                for day, query in zip(list_of_dates, queries):
+                    if query["_from"] <= timestamp <= query["to"]:
+                        data[day].append(scrobble)
+                        break
+        return [{"day": day, "data": data[day]} for day in list_of_dates]
+
     def get_list_of_year_dates(self) -> [datetime]:
         """
         A list of dates for each year since the user's last.fm  join date
@@ -262,21 +627,55 @@ class LastfmClient:
         return result
 
     def get_lastfm_tracks_for_day(self, date: datetime) -> list:
+        lastfm_tracks = []
+        for page in self.iter_lastfm_pages_for_day(date):
+            lastfm_tracks.extend(page)
+        return lastfm_tracks
+
+    def iter_lastfm_pages_for_day(self, date: datetime):
+        """
+        Yield each page of the user's scrobbles on a given day as it's fetched, without the currently playing track.
+        The number of pages is taken from the first page.
+        :raises LastfmResponseError: If a page doesn't have the scrobbles, so a year is never cut short silently
+        """
         logger.debug(f"Getting data from Last.fm for {self.username} date:{date}...")
         lastfm_response = self.lastfm_api_get_scrobbles(date, 1)
-        lastfm_tracks = lastfm_response.get("recenttracks", {}).get("track")
-        num_pages = int(
-            lastfm_response.get("recenttracks", {})
-            .get("@attr", {})
-            .get("totalPages", 0)
-        )
-        if num_pages > 1:
-            for page_num in range(2, num_pages + 1):
-                lastfm_response = self.lastfm_api_get_scrobbles(date, page_num)
-                lastfm_tracks.extend(
-                    lastfm_response.get("recenttracks", {}).get("track")
-                )
+        num_pages = self.get_total_pages(lastfm_response)
+        yield self.remove_now_playing(self.get_page_tracks(lastfm_response), date)
+        for page_num in range(2, num_pages + 1):
+            yield self.get_page_tracks(self.lastfm_api_get_scrobbles(date, page_num))
+
+    @staticmethod
+    def get_recenttracks(lastfm_response: dict) -> dict:
+        """
+        :return: The page, or {} if Last.fm won't show the user's scrobbles (LASTFM_NO_SCROBBLES_ERRORS)
+        :raises LastfmResponseError: If the response isn't a page of user.getrecenttracks or one of those errors
+        """
+        lastfm_response = lastfm_response or {}
+        recent_tracks = lastfm_response.get("recenttracks")
+        if recent_tracks is None:
+            if lastfm_response.get("error") in LASTFM_NO_SCROBBLES_ERRORS:
+                logger.info(f"No scrobbles from Last.fm: {lastfm_response.get('message')}")
+                return {}
+            raise LastfmResponseError(f"Last.fm response without recenttracks: {str(lastfm_response)[:200]}")
+        return recent_tracks
+
+    @classmethod
+    def get_total_pages(cls, lastfm_response: dict) -> int:
+        return int(cls.get_recenttracks(lastfm_response).get("@attr", {}).get("totalPages", 0))
 
+    @classmethod
+    def get_page_tracks(cls, lastfm_response: dict) -> list:
+        lastfm_tracks = cls.get_recenttracks(lastfm_response).get("track") or []
+        if isinstance(lastfm_tracks, dict):
+            lastfm_tracks = [lastfm_tracks]
+        return lastfm_tracks
+
+    @staticmethod
+    def remove_now_playing(lastfm_tracks: list or dict, date: datetime) -> list:
+        """
+        Remove the currently playing track, which Last.fm includes in every response
+        """
         if lastfm_tracks:
             if isinstance(lastfm_tracks, dict):
                 lastfm_tracks = [lastfm_tracks]
@@ -299,6 +698,7 @@ class LastfmClient:
         return lastfm_tracks or []
 
     @stats_profile
+    @traced("lastfm.top_tag")
     def get_top_tag_for_artist(self, artist: str) -> str:
         top_tag = self.cache.get_artist_tag(artist)
         if not top_tag:
@@ -306,16 +706,19 @@ class LastfmClient:
             api_response = self.last_fm_api_query(
                 api_method="artist.gettoptags", artist=artist
             )
-            tag_list = api_response.get("toptags", {}).get("tag", [])
-            for tag in tag_list:
-                tag_name = tag.get("name")
-                if "seen live" not in tag_name:
-                    top_tag = tag_name
-                    break
+            top_tag = self.top_tag_from_response(api_response)
             if top_tag:
                 self.cache.set_artist_tag(artist, top_tag)
         return top_tag.lower() if top_tag else None
 
+    @staticmethod
+    def top_tag_from_response(api_response: dict) -> str or None:
+        tag_list = api_response.get("toptags", {}).get("tag", [])
+        for tag in tag_list:
+            tag_name = tag.get("name")
+            if "seen live" not in tag_name:
+                return tag_name
+
     def lastfm_api_get_scrobbles(self, date: datetime, page_num: int) -> dict:
         """
         Get data from Last.fm api
@@ -323,24 +726,46 @@ class LastfmClient:
         :param page_num: Page number.
         :return: JSON response from API.
         """
+        self.count_scrobble_request()
+        return self.last_fm_api_query(**self.get_scrobbles_query(date, page_num))
+
+    def lastfm_api_get_scrobbles_between(self, date_from: int, date_to: int, page_num: int) -> dict:
+        """
+        A page of the user's scrobbles between two epoch timestamps
+        """
+        self.count_scrobble_request()
+        return self.last_fm_api_query(
+            api_method="user.getrecenttracks",
+            username=self.username,
+            _from=date_from,
+            to=date_to,
+            page=page_num,
+        )
+
+    def count_scrobble_request(self):
+        with self.scrobble_requests_lock:
+            self.scrobble_requests += 1
+
+    def get_scrobbles_query(self, date: datetime, page_num: int) -> dict:
+        """
+        The Last.fm query for a page of the user's scrobbles on a given day in their timezone
+        """
         date = (date.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=pytz.UTC)) + timedelta(minutes=self.tz_offset)
         date_start = date
         date_end = date + timedelta(hours=24)
 
         date_start_epoch = int(date_start.timestamp())
         date_end_epoch = int(date_end.timestamp())
-        logger.info(f"Last.fm query date: {date}")
-        logger.info(f"Last.fm query start date: {date_start}")
-        logger.info(f"Last.fm query end date: {date_end}")
+        log_event(logger, "lastfm.scrobbles_query", username=self.username, start=date_start, end=date_end,
+                  page=page_num)
 
-        api_response = self.last_fm_api_query(
-            api_method="user.getrecenttracks",
-            username=self.username,
-            _from=date_start_epoch,
-            to=date_end_epoch,
-            page=page_num,
-        )
-        return api_response
+        return {
+            "api_method": "user.getrecenttracks",
+            "username": self.username,
+            "_from": date_start_epoch,
+            "to": date_end_epoch,
+            "page": page_num,
+        }
 
     @stats_profile
     def get_scrobble_hashes_since(self, start_date: datetime):
@@ -356,8 +781,8 @@ class LastfmClient:
             while num_pages > page_num:
                 logger.debug(f"get_scrobble_hashes_since getting page {page_num} of {num_pages}")
                 page_num = page_num + 1
-                futures.append(executor.submit(self.get_recent_track_hashes_by_page,
-                                               **{"date_start_epoch": date_start_epoch, "page_num": page_num}))
+                futures.append(submit_in_context(executor, self.get_recent_track_hashes_by_page,
+                                                 **{"date_start_epoch": date_start_epoch, "page_num": page_num}))
 
             for future in futures:
                 track_hashes.update(future.result()[0])
@@ -370,6 +795,13 @@ class LastfmClient:
             _from=date_start_epoch,
             page=page_num,
         )
+        return self.recent_track_hashes(api_response)
+
+    @staticmethod
+    def recent_track_hashes(api_response: dict) -> (set, int):
+        """
+        :return: (hashes of the scrobbles in a page of user.getrecenttracks, total number of pages)
+        """
         num_pages = int(
             api_response.get("recenttracks", {}).get("@attr", {}).get("totalPages", 0)
         )
@@ -0,0 +1,107 @@
+"""
+Shares the process's Last.fm request slots fairly between users and kinds of work.
+
+Every Last.fm request made with LastfmClient.last_fm_api_query waits for one of LASTFM_MAX_CONCURRENT_REQUESTS slots.
+When a slot frees up it goes to the highest priority class with requests waiting:
+
+- interactive: loading the page or the stats API (the default)
+- recently_played: the playlist's scan of recently played tracks
+- background: pre-warming, refreshing profiles and other work nobody is waiting for
+
+and within the class, to the user with the fewest requests in flight, so one user's 20-year fan-out can't keep a new
+user's single year waiting. The class of the current work is set with lastfm_priority and carries over to threads
+started with submit_in_context. The time each request waits for a slot is recorded per class as
+lastfm-slot-wait-ms-<class>.
+"""
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Event, Lock
+
+from clients.database import Singleton
+from clients.monitoring_client import GoogleMonitoringClient
+
+logger = logging.getLogger(__name__)
+
+LASTFM_MAX_CONCURRENT_REQUESTS = int(os.getenv("LASTFM_MAX_CONCURRENT_REQUESTS") or 20)
+PRIORITIES = ("interactive", "recently_played", "background")
+
+current_priority = ContextVar("lastfm_priority", default=PRIORITIES[0])
+
+
+@contextmanager
+def lastfm_priority(priority: str):
+    """
+    Make the Last.fm requests in the block, and in the threads it starts with submit_in_context, of this class
+    """
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown Last.fm priority {priority}, expected one of {PRIORITIES}")
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class LastfmScheduler(metaclass=Singleton):
+    def __init__(self, max_concurrent: int = LASTFM_MAX_CONCURRENT_REQUESTS):
+        self.available = max_concurrent
+        self.lock = Lock()
+        # priority: {user: [waiting requests]}, users in the order they started waiting
+        self.waiting = {priority: OrderedDict() for priority in PRIORITIES}
+        self.in_flight = {}
+
+    @contextmanager
+    def slot(self, user: str = ""):
+        """
+        Wait for a request slot for the user, at the current priority, and hold it for the block
+        """
+        priority = current_priority.get()
+        start = time.perf_counter()
+        self.acquire(priority, user)
+        GoogleMonitoringClient().time_series_thread(f"lastfm-slot-wait-ms-{priority}",
+                                                    (time.perf_counter() - start) * 1000)
+        try:
+            yield
+        finally:
+            self.release(user)
+
+    def acquire(self, priority: str, user: str):
+        with self.lock:
+            if self.available > 0 and not any(self.waiting.values()):
+                self.available -= 1
+                self.in_flight[user] = self.in_flight.get(user, 0) + 1
+                return
+            granted = Event()
+            self.waiting[priority].setdefault(user, deque()).append(granted)
+        granted.wait()
+
+    def release(self, user: str):
+        with self.lock:
+            self.in_flight[user] -= 1
+            if not self.in_flight[user]:
+                del self.in_flight[user]
+            next_waiting = self.get_next_waiting()
+            if next_waiting:
+                next_user, granted = next_waiting
+                self.in_flight[next_user] = self.in_flight.get(next_user, 0) + 1
+                granted.set()
+            else:
+                self.available += 1
+
+    def get_next_waiting(self) -> (str, Event) or None:
+        """
+        The first request of the user with the fewest requests in flight, in the highest priority class waiting
+        """
+        for priority in PRIORITIES:
+            users = self.waiting[priority]
+            if users:
+                user = min(users, key=lambda u: self.in_flight.get(u, 0))
+                granted = users[user].popleft()
+                if not users[user]:
+                    del users[user]
+                return user, granted
+        return None
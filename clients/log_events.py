@@ -0,0 +1,132 @@
+"""
+Structured log events for hot paths, formatted only when they're emitted.
+
+    log_event(logger, "spotify.search", artist=artist, track_name=track_name, cached=True, seconds=0.004)
+
+is logged as `spotify.search {"artist": ..., "track_name": ..., ...}`, with the fields also passed as the record's
+json_fields for handlers that write structured logs (e.g. Cloud Logging's StructuredLogHandler).
+
+Below WARNING, an event is dropped when:
+- its level isn't enabled, before anything is formatted
+- it's sampled out by its rate in LOG_SAMPLE_RATES (e.g. "lastfm.request=0.1,spotify.search=0.05")
+- the request has already emitted LOG_REQUEST_BUDGET events
+
+Every event is still counted, and its "seconds" field added up, in the request's summary, which is logged as one
+request.summary event when the request ends.
+"""
+import json
+import logging
+import os
+import random
+import time
+from contextvars import ContextVar
+from threading import Lock
+
+LOG_REQUEST_BUDGET = int(os.getenv("LOG_REQUEST_BUDGET") or 50)
+LOG_SAMPLE_RATES = {
+    event: float(rate)
+    for event, rate in (
+        part.split("=") for part in (
+            os.getenv("LOG_SAMPLE_RATES")
+            or "lastfm.scrobbles_query=0.1,lastfm.request=0.1,spotify.search=0.1,spotify.search_cache=0.1"
+        ).split(",") if part
+    )
+}
+
+current_request_log = ContextVar("request_log", default=None)
+
+
+class JsonFields:
+    """
+    Formats the fields as JSON when the record is formatted, not when it's logged
+    """
+    def __init__(self, fields: dict):
+        self.fields = fields
+
+    def __str__(self):
+        return json.dumps(self.fields, default=str)
+
+
+class RequestLog:
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.fields = {}
+        self.counts = {}
+        self.seconds = {}
+        self.emitted = 0
+        self.dropped = 0
+        self.lock = Lock()
+
+    def count(self, event: str, seconds: float = None):
+        with self.lock:
+            self.counts[event] = self.counts.get(event, 0) + 1
+            if seconds is not None:
+                self.seconds[event] = self.seconds.get(event, 0) + seconds
+
+    def take_budget(self) -> bool:
+        with self.lock:
+            if self.emitted >= LOG_REQUEST_BUDGET:
+                self.dropped += 1
+                return False
+            self.emitted += 1
+            return True
+
+    def summary(self, **fields) -> dict:
+        with self.lock:
+            return {
+                "request": self.name,
+                "seconds": round(time.perf_counter() - self.start, 4),
+                **self.fields,
+                **fields,
+                "events": dict(self.counts),
+                "event_seconds": {event: round(seconds, 4) for event, seconds in self.seconds.items()},
+                "logs_emitted": self.emitted,
+                "logs_dropped": self.dropped,
+            }
+
+
+def start_request_log(name: str):
+    return current_request_log.set(RequestLog(name))
+
+
+def end_request_log(token) -> RequestLog:
+    request_log = current_request_log.get()
+    try:
+        current_request_log.reset(token)
+    except ValueError:
+        # The token was created in another context, e.g. a streamed response closed on another thread
+        current_request_log.set(None)
+    return request_log
+
+
+def set_request_fields(**fields):
+    """
+    Add fields to the current request's summary event
+    """
+    request_log = current_request_log.get()
+    if request_log:
+        request_log.fields.update(fields)
+
+
+def log_event(logger: logging.Logger, event: str, level: int = logging.INFO, **fields):
+    request_log = current_request_log.get()
+    if request_log:
+        request_log.count(event, fields.get("seconds"))
+    if not logger.isEnabledFor(level):
+        return
+    if level < logging.WARNING:
+        sample_rate = LOG_SAMPLE_RATES.get(event, 1)
+        if sample_rate < 1:
+            if random.random() >= sample_rate:
+                return
+            fields["sample_rate"] = sample_rate
+        if request_log and not request_log.take_budget():
+            return
+    logger.log(level, "%s %s", event, JsonFields(fields), extra={"json_fields": {"event": event, **fields}})
+
+
+def log_request_summary(logger: logging.Logger, request_log: RequestLog, **fields):
+    summary = request_log.summary(**fields)
+    logger.info("%s %s", "request.summary", JsonFields(summary),
+                extra={"json_fields": {"event": "request.summary", **summary}})
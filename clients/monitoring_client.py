@@ -1,10 +1,32 @@
+import atexit
 import logging
+import math
 import os
+import socket
+import struct
 import time
 import uuid
 
-from threading import Thread
-from google.cloud import monitoring_v3
+from collections import OrderedDict
+from threading import Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+METRICS_FLUSH_INTERVAL_SECONDS = int(os.getenv("METRICS_FLUSH_INTERVAL_SECONDS") or 60)
+METRICS_MAX_SERIES = int(os.getenv("METRICS_MAX_SERIES") or 500)
+# Serve metrics at /metrics in Prometheus text format
+PROMETHEUS_METRICS = os.getenv("PROMETHEUS_METRICS", "false").lower() == "true"
+# If set, /metrics requires an "Authorization: Bearer <token>" header
+PROMETHEUS_METRICS_TOKEN = os.getenv("PROMETHEUS_METRICS_TOKEN")
+PROMETHEUS_PREFIX = "lasthop_"
+CACHE_LOOKUP_RESULTS = ("hit", "miss", "expired", "no-date", "error")
+METRICS_SEND_TIMEOUT_SECONDS = 10
+CREATE_TIME_SERIES_BATCH_LIMIT = 200
+# Distribution buckets: < 1, then [2^(i-1), 2^i) for i in 1..24, then >= 2^24
+DISTRIBUTION_BUCKETS = 24
+DISTRIBUTION_GROWTH_FACTOR = 2
+DISTRIBUTION_SCALE = 1
+
 
 def stats_profile(func):
     def timed(*args, **kwargs):
@@ -12,10 +34,8 @@ def stats_profile(func):
         result = func(*args, **kwargs)
         te = time.time()
         time_taken = int(round((te - ts) * 1000, 1))
-        if time_taken:
-            GoogleMonitoringClient().time_series_thread(func.__name__, time_taken)
-        print("Function", func.__name__, "time:", time_taken, "ms")
-        print()
+        GoogleMonitoringClient().time_series_thread(func.__name__, time_taken)
+        logger.debug(f"Function {func.__name__} time: {time_taken} ms")
         return result
 
     return timed
@@ -30,73 +50,295 @@ class Singleton(type):
         return cls._instances[cls]
 
 
+class Distribution:
+    """
+    Count, mean, sum of squared deviation and exponential bucket counts of recorded values
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.mean = 0.0
+        self.sum_of_squared_deviation = 0.0
+        self.bucket_counts = [0] * (DISTRIBUTION_BUCKETS + 2)
+
+    def add(self, value: float):
+        self.count += 1
+        self.sum += value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.sum_of_squared_deviation += delta * (value - self.mean)
+        self.bucket_counts[self.get_bucket(value)] += 1
+
+    @staticmethod
+    def get_bucket(value: float) -> int:
+        if value < DISTRIBUTION_SCALE:
+            return 0
+        bucket = int(math.log(value / DISTRIBUTION_SCALE, DISTRIBUTION_GROWTH_FACTOR)) + 1
+        return min(bucket, DISTRIBUTION_BUCKETS + 1)
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and distributions recorded since the last flush.
+    Holds at most max_series metrics; points for new metrics beyond that are dropped, or with evict, replace the
+    metric that was updated longest ago.
+    """
+
+    def __init__(self, max_series: int = METRICS_MAX_SERIES, evict: bool = False):
+        self.max_series = max_series
+        self.evict = evict
+        # Tells this registry's series apart from other processes' (instances and gunicorn workers)
+        self.instance_id = uuid.uuid4().hex[:8]
+        self.lock = Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.distributions = {}
+        # metric_type: the dict it's in, least recently updated first
+        self.series = OrderedDict()
+        self.dropped = 0
+        self.evicted = 0
+
+    def increment(self, metric_type: str, value: int = 1):
+        with self.lock:
+            if self._has_room(metric_type, self.counters):
+                self.counters[metric_type] = self.counters.get(metric_type, 0) + value
+
+    def set_gauge(self, metric_type: str, value: int):
+        with self.lock:
+            if self._has_room(metric_type, self.gauges):
+                self.gauges[metric_type] = value
+
+    def record(self, metric_type: str, value: float):
+        with self.lock:
+            if self._has_room(metric_type, self.distributions):
+                self.distributions.setdefault(metric_type, Distribution()).add(value)
+
+    def _has_room(self, metric_type: str, series: dict) -> bool:
+        if metric_type in series:
+            self.series.move_to_end(metric_type)
+            return True
+        if len(self.series) >= self.max_series:
+            if not self.evict:
+                self.dropped += 1
+                return False
+            oldest, oldest_series = self.series.popitem(last=False)
+            del oldest_series[oldest]
+            self.evicted += 1
+        self.series[metric_type] = series
+        return True
+
+    def swap(self) -> (dict, dict, dict, int):
+        """
+        Take everything recorded so far and start again
+        :return: (counters, gauges, distributions, dropped)
+        """
+        with self.lock:
+            result = self.counters, self.gauges, self.distributions, self.dropped
+            self.counters, self.gauges, self.distributions, self.dropped = {}, {}, {}, 0
+            self.series = OrderedDict()
+        return result
+
+    def get_instance_label(self) -> str:
+        """
+        A label value that's the same for every flush of this process, so each process writes its own time series.
+        Cloud Monitoring rejects points written to the same series more often than every few seconds.
+        """
+        return f"{socket.gethostname()}-{os.getpid()}-{self.instance_id}"
+
+
 class GoogleMonitoringClient(metaclass=Singleton):
+    """
+    Metrics are aggregated in memory and sent by a single background thread every METRICS_FLUSH_INTERVAL_SECONDS,
+    so recording a metric never waits on Cloud Monitoring.
+    With PROMETHEUS_METRICS they are also totalled in memory for /metrics.
+    """
 
     def __init__(self):
         google_cloud_project = os.getenv("GOOGLE_CLOUD_PROJECT")
         if google_cloud_project:
-            self.client = monitoring_v3.MetricServiceClient()
             self.project_name = f"projects/{google_cloud_project}"
             self.send_metrics = "prod" in os.getenv("ENVIRONMENT", "").lower()
         else:
             self.send_metrics = False
+        self.registry = MetricsRegistry()
+        # Totals since the process started, for /metrics. A metric not updated for the longest time makes room for
+        # a new one, and starts again from zero if it's recorded again, which Prometheus reads as a counter reset
+        self.local_registry = MetricsRegistry(evict=True) if PROMETHEUS_METRICS else None
+        self._client = None
+        self.flusher = None
+        self.flusher_lock = Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            from google.cloud import monitoring_v3
+
+            self._client = monitoring_v3.MetricServiceClient()
+        return self._client
 
     def increment_thread(self, metric_type, value=1):
+        """
+        Count an event. Sent as the total for each flush interval.
+        """
+        if self.local_registry:
+            self.local_registry.increment(metric_type, value)
         if self.send_metrics:
-            t = Thread(
-                target=self._increment,
-                name="increment",
-                args=(
-                    metric_type,
-                    value,
-                ),
-            )
-            t.start()
+            self.registry.increment(metric_type, value)
+            self._start_flusher()
 
     def time_series_thread(self, metric_type, time_taken):
+        """
+        Record a value, e.g. a latency in ms. Sent as a distribution for each flush interval.
+        """
+        if self.local_registry:
+            self.local_registry.record(metric_type, time_taken)
         if self.send_metrics:
-            t = Thread(
-                target=self._time_series,
-                name="time_series",
-                args=(metric_type, time_taken),
-            )
-            t.start()
-
-    def _time_series(self, metric_type, time_taken):
-        try:
-            client = monitoring_v3.MetricServiceClient()
+            self.registry.record(metric_type, time_taken)
+            self._start_flusher()
+
+    def set_gauge(self, metric_type, value):
+        """
+        Record the current value of something, e.g. the number of users. The latest value is sent.
+        """
+        if self.local_registry:
+            self.local_registry.set_gauge(metric_type, value)
+        if self.send_metrics:
+            self.registry.set_gauge(metric_type, value)
+            self._start_flusher()
+
+    def prometheus_text(self) -> str:
+        """
+        Everything recorded since the process started, in Prometheus text format
+        """
+        if not self.local_registry:
+            return ""
+        with self.local_registry.lock:
+            counters = dict(self.local_registry.counters)
+            gauges = dict(self.local_registry.gauges)
+            distributions = {metric_type: (distribution.count, distribution.sum, list(distribution.bucket_counts))
+                             for metric_type, distribution in self.local_registry.distributions.items()}
+            evicted = self.local_registry.evicted
+        return render_prometheus_text(counters, gauges, distributions, evicted=evicted)
+
+    def _start_flusher(self):
+        if self.flusher is None:
+            with self.flusher_lock:
+                if self.flusher is None:
+                    self.flusher = Thread(target=self._flush_forever, name="metrics_flusher", daemon=True)
+                    self.flusher.start()
+                    atexit.register(self.flush)
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL_SECONDS)
+            self.flush()
+
+    def flush(self):
+        """
+        Send everything recorded since the last flush in batched create_time_series calls
+        """
+        counters, gauges, distributions, dropped = self.registry.swap()
+        if dropped:
+            logger.warning(f"Dropped {dropped} metric points over the {self.registry.max_series} series limit")
+            counters["metrics-dropped"] = dropped
+        time_series = self.build_time_series(counters, gauges, distributions, self.registry.get_instance_label())
+        for start in range(0, len(time_series), CREATE_TIME_SERIES_BATCH_LIMIT):
+            batch = time_series[start:start + CREATE_TIME_SERIES_BATCH_LIMIT]
+            try:
+                self.client.create_time_series(name=self.project_name, time_series=batch,
+                                               timeout=METRICS_SEND_TIMEOUT_SECONDS)
+            except Exception:
+                logger.exception(f"Error sending {len(batch)} metrics")
+
+    @staticmethod
+    def build_time_series(counters: dict, gauges: dict, distributions: dict, instance: str) -> list:
+        """
+        Counters and gauges keep their existing int64 metric types. Distributions can't be written to those, so they
+        are sent as custom.googleapis.com/distribution/<metric>.
+        :param instance: Label value for this process, see MetricsRegistry.get_instance_label
+        """
+        from google.cloud import monitoring_v3
+
+        now = time.time()
+        seconds = int(now)
+        interval = monitoring_v3.TimeInterval({"end_time": {"seconds": seconds, "nanos": int((now - seconds) * 10**9)}})
+
+        def _series(metric_type: str, value: dict):
             series = monitoring_v3.TimeSeries()
             series.metric.type = f"custom.googleapis.com/{metric_type}"
+            series.metric.labels["instance"] = instance
             series.resource.type = "global"
-            series.metric.labels["TestLabel"] = f"My Label Data{str(uuid.uuid4())}"
-            end_time = time.time()
-            end_time_seconds = int(end_time)
-            end_time_nanos = int((end_time - end_time_seconds) * 10**9)
-            interval = monitoring_v3.TimeInterval(
-                {"end_time": {"seconds": end_time_seconds, "nanos": end_time_nanos}}
-            )
-            point = monitoring_v3.Point(
-                {"interval": interval, "value": {"int64_value": time_taken}}
-            )
-            series.points = [point]
-            client.create_time_series(name=self.project_name, time_series=[series])
-        except:
-            logging.exception(f"Error sending stats")
-
-    def _increment(self, metric_type: str, value=1):
-        client = monitoring_v3.MetricServiceClient()
-        series = monitoring_v3.TimeSeries()
-        series.metric.type = f"custom.googleapis.com/{metric_type}"
-        series.resource.type = "global"
-        series.metric.labels["TestLabel"] = f"My Label Data{str(uuid.uuid4())}"
-        now = time.time()
-        seconds = int(now)
-        nanos = int((now - seconds) * 10**9)
-        interval = monitoring_v3.TimeInterval(
-            {"end_time": {"seconds": seconds, "nanos": nanos}}
-        )
-        point = monitoring_v3.Point(
-            {"interval": interval, "value": {"int64_value": value}}
-        )
-        series.points = [point]
-        client.create_time_series(name=self.project_name, time_series=[series])
+            series.points = [monitoring_v3.Point({"interval": interval, "value": value})]
+            return series
+
+        time_series = [_series(metric_type, {"int64_value": value})
+                       for metric_type, value in {**counters, **gauges}.items()]
+        for metric_type, distribution in distributions.items():
+            time_series.append(_series(f"distribution/{metric_type}", {"distribution_value": {
+                "count": distribution.count,
+                "mean": distribution.mean,
+                "sum_of_squared_deviation": distribution.sum_of_squared_deviation,
+                "bucket_options": {"exponential_buckets": {
+                    "num_finite_buckets": DISTRIBUTION_BUCKETS,
+                    "growth_factor": DISTRIBUTION_GROWTH_FACTOR,
+                    "scale": DISTRIBUTION_SCALE,
+                }},
+                "bucket_counts": distribution.bucket_counts,
+            }}))
+        return time_series
+
+
+def prometheus_name(metric_type: str) -> str:
+    return PROMETHEUS_PREFIX + "".join(c if c.isalnum() else "_" for c in metric_type).lower()
+
+
+def get_cache_hit_ratios(counters: dict) -> dict:
+    """
+    Hit ratios for caches counted as <cache>-hit, <cache>-miss, <cache>-expired etc.
+    :return: {cache: hits / lookups}
+    """
+    hit_ratios = {}
+    for metric_type, hits in counters.items():
+        if metric_type.endswith("-hit"):
+            cache = metric_type[:-len("-hit")]
+            lookups = sum(counters.get(f"{cache}-{result}", 0) for result in CACHE_LOOKUP_RESULTS)
+            hit_ratios[cache] = hits / lookups
+    return hit_ratios
+
+
+def float_below(value: float) -> float:
+    """
+    The largest float less than a positive value, math.nextafter(value, 0) on Python 3.9+
+    """
+    bits = struct.unpack("<q", struct.pack("<d", value))[0]
+    return struct.unpack("<d", struct.pack("<q", bits - 1))[0]
+
+
+def render_prometheus_text(counters: dict, gauges: dict, distributions: dict, evicted: int = 0) -> str:
+    """
+    :param distributions: {metric_type: (count, sum, bucket_counts)}, with bucket_counts as in Distribution
+    """
+    lines = []
+    for metric_type, value in sorted({**counters, "metrics-evicted": evicted}.items()):
+        name = f"{prometheus_name(metric_type)}_total"
+        lines += [f"# TYPE {name} counter", f"{name} {value}"]
+    for metric_type, value in sorted(gauges.items()):
+        name = prometheus_name(metric_type)
+        lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+    hit_ratios = get_cache_hit_ratios(counters)
+    if hit_ratios:
+        name = f"{PROMETHEUS_PREFIX}cache_hit_ratio"
+        lines.append(f"# TYPE {name} gauge")
+        lines += [f'{name}{{cache="{cache}"}} {hit_ratio:.4f}' for cache, hit_ratio in sorted(hit_ratios.items())]
+    for metric_type, (count, total, bucket_counts) in sorted(distributions.items()):
+        name = prometheus_name(metric_type)
+        lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bucket, bucket_count in enumerate(bucket_counts[:-1]):
+            cumulative += bucket_count
+            # Distribution buckets exclude their upper bound, Prometheus buckets include it
+            upper_bound = float_below(DISTRIBUTION_SCALE * DISTRIBUTION_GROWTH_FACTOR ** bucket)
+            lines.append(f'{name}_bucket{{le="{upper_bound}"}} {cumulative}')
+        lines += [f'{name}_bucket{{le="+Inf"}} {count}', f"{name}_sum {total}", f"{name}_count {count}"]
+    return "\n".join(lines) + "\n"
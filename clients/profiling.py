@@ -0,0 +1,88 @@
+"""
+Opt-in cProfile of real requests.
+
+A request is profiled when its X-Profile header matches PROFILE_SECRET, or at random with PROFILE_SAMPLE_RATE.
+Profiles are written to PROFILE_DIR, keeping the newest PROFILE_MAX_FILES, and can be read with pstats or snakeviz.
+With neither set, profiled() returns the function undecorated.
+
+Only the thread handling the request is profiled, and only one request at a time.
+"""
+import cProfile
+import hmac
+import logging
+import os
+import random
+import time
+from functools import wraps
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SECRET = os.getenv("PROFILE_SECRET")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE") or 0)
+PROFILE_DIR = os.getenv("PROFILE_DIR") or os.path.join(os.getcwd(), "local_cache", "profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES") or 50)
+PROFILE_HEADER = "X-Profile"
+
+profile_lock = Lock()
+
+
+def is_enabled() -> bool:
+    return bool(PROFILE_SECRET or PROFILE_SAMPLE_RATE)
+
+
+def should_profile(secret: str = None) -> bool:
+    if PROFILE_SECRET and secret and hmac.compare_digest(secret.encode(), PROFILE_SECRET.encode()):
+        return True
+    return bool(PROFILE_SAMPLE_RATE) and random.random() < PROFILE_SAMPLE_RATE
+
+
+def profiled(name: str, get_secret=None):
+    """
+    Profile calls of the decorated function when should_profile
+    :param name: Included in the profile's file name
+    :param get_secret: Returns the secret sent with the current request, e.g. from the X-Profile header
+    """
+    def decorator(func):
+        if not is_enabled():
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not should_profile(get_secret() if get_secret else None):
+                return func(*args, **kwargs)
+            if not profile_lock.acquire(blocking=False):
+                logger.info(f"Not profiling {name}, already profiling another request")
+                return func(*args, **kwargs)
+            profiler = cProfile.Profile()
+            start = time.perf_counter()
+            try:
+                return profiler.runcall(func, *args, **kwargs)
+            finally:
+                profile_lock.release()
+                write_profile(name, profiler, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def write_profile(name: str, profiler: cProfile.Profile, seconds: float):
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{int(time.time() * 1000) % 1000:03d}-"
+                                         f"{name}.prof")
+        profiler.dump_stats(path)
+        logger.info(f"Profiled {name} ({seconds:.3f} seconds) to {path}")
+        rotate_profiles()
+    except OSError:
+        logger.exception(f"Couldn't write profile for {name}")
+
+
+def rotate_profiles():
+    """
+    Delete the oldest profiles over PROFILE_MAX_FILES
+    """
+    profiles = sorted(file_name for file_name in os.listdir(PROFILE_DIR) if file_name.endswith(".prof"))
+    for file_name in profiles[:-PROFILE_MAX_FILES]:
+        os.remove(os.path.join(PROFILE_DIR, file_name))
@@ -1,17 +1,24 @@
+import heapq
 import logging
 import os
 import random
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import spotipy
-from dotenv import load_dotenv
 
+from clients import submit_in_context
 from clients.cache import Cache
+from clients.cassette import REQUESTS_SESSION
 from clients.lastfm_client import LastfmClient
+from clients.lastfm_scheduler import lastfm_priority
+from clients.log_events import log_event
 from clients.monitoring_client import GoogleMonitoringClient
+from clients.track_index import TrackIndex
+from clients.tracing import span
 
-load_dotenv()
 logger = logging.getLogger(__name__)
 
 HOST = os.getenv("HOST")
@@ -19,7 +26,9 @@ AUTH_SCOPE = ["playlist-modify-private"]
 ADD_TO_PLAYLIST_BATCH_LIMIT = 100
 DEFAULT_PLAYLIST_LENGTH = 50
 DEFAULT_TRACKS_PER_YEAR = 5
-MAX_PLAYLIST_LENGTH = int(os.getenv("MAX_PLAYLIST_LENGTH")) or 120
+MAX_PLAYLIST_LENGTH = int(os.getenv("MAX_PLAYLIST_LENGTH") or 120)
+SPOTIFY_API_BASE_URL = os.getenv("SPOTIFY_API_BASE_URL") or "https://api.spotify.com/v1"
+PIPELINE_PLAYLIST_BUILD = os.getenv("PIPELINE_PLAYLIST_BUILD", "false").lower() == "true"
 
 
 class SpotifyForbiddenException(Exception):
@@ -33,10 +42,16 @@ class SpotifyClient:
         if not auth_manager:
             auth_manager = self.get_auth_manager(session)
         self.auth_manager = auth_manager
-        self.spotify_client = spotipy.Spotify(auth_manager=auth_manager)
+        self.spotify_client = spotipy.Spotify(auth_manager=auth_manager, requests_session=REQUESTS_SESSION or True)
+        self.spotify_client.prefix = f"{SPOTIFY_API_BASE_URL}/"
         self.available_market = available_market
         self.tz_offset = tz_offset or 0
         self.cache = Cache()
+        self.track_index = TrackIndex()
+        self.search_cache_hits = 0
+        self.search_cache_misses = 0
+        self.track_index_hits = 0
+        self.resolved_tracks = {}
 
     @staticmethod
     def get_auth_manager(session):
@@ -62,7 +77,10 @@ class SpotifyClient:
             playlist_tracks_per_year: int = None,
             playlist_order_recent_first: bool = True,
             playlist_repeat_artists: bool = False,
-            skip_recently_played_start_date: datetime = None
+            skip_recently_played_start_date: datetime = None,
+            pipelined: bool = PIPELINE_PLAYLIST_BUILD,
+            recently_played_tracks: set = None,
+            track_uris: list = None,
     ) -> (str, str):
         """
         Make a Spotify playlist, search for tracks and add them to the playlist
@@ -72,6 +90,9 @@ class SpotifyClient:
         :param playlist_order_recent_first: Order by most recent year or not
         :param playlist_repeat_artists: Allow artists to appear more than once in the playlist
         :param skip_recently_played_start_date: Don't add tracks that have been played since this date
+        :param pipelined: Create the playlist and add tracks while the search is still running
+        :param recently_played_tracks: Hashes of recently played tracks, if already fetched
+        :param track_uris: An already selected tracklist (e.g. from a preview), skips the search
         :return: (playlist_id, playlist_url): Spotify playlist ID and URL
         """
         logger.info(f"Playlist options: user:{lastfm_user_data['username']}; "
@@ -87,46 +108,86 @@ class SpotifyClient:
         start_time = datetime.now()
         logger.info(f"Making playlist for {lastfm_user_data['username']}")
 
-        recently_played_tracks = []
-        if skip_recently_played_start_date:
-            recently_played_tracks = LastfmClient(lastfm_user_data['username'],
-                                                  lastfm_user_data['join_date']).get_scrobble_hashes_since(
-                skip_recently_played_start_date)
-            logger.info(f"Skipping {len(recently_played_tracks)} recently played tracks")
-
-        track_data = self.format_track_data(data, playlist_order_recent_first)
-        if not track_data:
-            return None, None
+        if track_uris is None:
+            if recently_played_tracks is None:
+                recently_played_tracks = self.get_recently_played_tracks(lastfm_user_data,
+                                                                         skip_recently_played_start_date)
+            track_data = self.format_track_data(data, playlist_order_recent_first, lazy=True)
+            if not track_data:
+                return None, None
         try:
+            if track_uris is None and pipelined:
+                playlist_id, playlist_url, track_count = self.build_playlist_pipelined(
+                    track_data, lastfm_user_data, playlist_tracks_per_year, playlist_repeat_artists,
+                    recently_played_tracks
+                )
+                if not track_count:
+                    logger.info("No tracks to add to this playlist")
+                    return None, None
+            else:
+                if track_uris is None:
+                    track_uris = self.search_for_tracks(track_data, playlist_tracks_per_year,
+                                                        playlist_repeat_artists, recently_played_tracks)
 
-            tracks_to_add_to_playlist = self.search_for_tracks(track_data, playlist_tracks_per_year,
-                                                               playlist_repeat_artists, recently_played_tracks)
-
-            if not tracks_to_add_to_playlist:
-                logger.info(f"No tracks to add to this playlist")
-                return None, None
+                if not track_uris:
+                    logger.info(f"No tracks to add to this playlist")
+                    return None, None
 
-            playlist_id, playlist_url = self.create_playlist(
-                lastfm_user_data
-            )
-            track_count = len(tracks_to_add_to_playlist)
+                playlist_id, playlist_url = self.create_playlist(
+                    lastfm_user_data
+                )
+                track_count = len(track_uris)
 
-            self.batch_add_tracks_to_playlist(playlist_id=playlist_id, track_data=tracks_to_add_to_playlist)
+                self.batch_add_tracks_to_playlist(playlist_id=playlist_id, track_data=track_uris)
 
             if playlist_url:
                 logger.info(
                     f"Playlist for {lastfm_user_data['username']} created with {track_count} tracks {playlist_url} "
                     f"(took {(datetime.now() - start_time).seconds} seconds)"
                 )
-                GoogleMonitoringClient().increment_thread(
-                    "playlist-length", track_count
-                )
+                GoogleMonitoringClient().time_series_thread("playlist-length", track_count)
         except spotipy.exceptions.SpotifyException:
             GoogleMonitoringClient().increment_thread("spotify-forbidden-exception")
             logger.exception(f"Spotify exception")
             raise SpotifyForbiddenException
         return playlist_id, playlist_url
 
+    @staticmethod
+    def get_recently_played_tracks(lastfm_user_data: dict, start_date: datetime = None) -> set:
+        """
+        Hashes of the tracks the user has played since start_date
+        """
+        recently_played_tracks = set()
+        if start_date:
+            lfm_client = LastfmClient(lastfm_user_data['username'], lastfm_user_data['join_date'])
+            with lastfm_priority("recently_played"):
+                recently_played_tracks = lfm_client.get_scrobble_hashes_since(start_date)
+            logger.info(f"Skipping {len(recently_played_tracks)} recently played tracks")
+        return recently_played_tracks
+
+    def select_playlist_tracks(
+            self,
+            data: list,
+            playlist_tracks_per_year: int = None,
+            playlist_order_recent_first: bool = True,
+            playlist_repeat_artists: bool = False,
+            recently_played_tracks: set = None,
+    ) -> list:
+        """
+        Choose the tracks for a playlist without creating it
+        :return: Track URIs in playlist order
+        """
+        track_data = self.format_track_data(data, playlist_order_recent_first, lazy=True)
+        return self.search_for_tracks(track_data, playlist_tracks_per_year or DEFAULT_TRACKS_PER_YEAR,
+                                      playlist_repeat_artists, recently_played_tracks)
+
+    def describe_tracks(self, track_uris: list) -> list:
+        """
+        The resolved artist and track name for each track URI
+        """
+        resolved_by_uri = {track["uri"]: track for track in self.resolved_tracks.values() if track}
+        return [resolved_by_uri.get(uri, {"uri": uri}) for uri in track_uris]
+
     def create_playlist(self, lastfm_user_data: dict = None) -> (str, str):
         """
         :param lastfm_user_data: The user's last.fm user info
@@ -156,45 +217,53 @@ class SpotifyClient:
         playlist_id = playlist.get("id")
         return playlist_id, playlist_url
 
-    @staticmethod
-    def format_track_data(data: list, playlist_order_recent_first: bool = True) -> dict:
+    @classmethod
+    def format_track_data(cls, data: list, playlist_order_recent_first: bool = True, lazy: bool = False) -> dict:
         """
         Format the user's last.fm stats so a playlist can be created
         :param data: The user's last.fm stats
         :param playlist_order_recent_first: Order by most recent year or not
-        :return:
+        :param lazy: Return a generator of artist candidates for each year instead of a list
+        :return: {day: [{"artist", "tracks", "playcount"}]} with each year's artists ordered by playcount
         """
         result = {}
-        if not playlist_order_recent_first:
-            data.reverse()
-        for year_data in data:
-            day = year_data["day"]
-            result[day] = []
-            data = year_data["data"]
-            for artist_data in data:
-                artist_tracks_dict = {}
-                artist = artist_data["artist"]
-                tracks = artist_data["track_data"]["tracks"]
-                for track_data in tracks:
-                    track_name = track_data["track_name"]
-                    if artist_tracks_dict.get(artist):
-                        artist_tracks_dict[artist].append(track_name)
-                    else:
-                        artist_tracks_dict[artist] = [track_name]
-                if artist_tracks_dict:
-                    artist_tracks_dict["playcount"] = len(artist_tracks_dict[artist])
-                    result[day].append(
-                        {
-                            "artist": artist,
-                            "tracks": artist_tracks_dict[artist],
-                            "playcount": artist_tracks_dict["playcount"],
-                        }
-                    )
-                    result[day] = sorted(
-                        result[day], key=lambda d: d["playcount"], reverse=True
-                    )
+        for year_data in data if playlist_order_recent_first else reversed(data):
+            candidates = cls.iter_year_candidates(year_data["data"])
+            result[year_data["day"]] = candidates if lazy else list(candidates)
         return result
 
+    @staticmethod
+    def iter_year_candidates(artist_data_list: list):
+        """
+        Yield a year's artists by playcount, ties keeping their original order.
+        Candidates are popped off a heap so only the ones a playlist uses are built.
+        """
+        heap = [
+            (-len(artist_data["track_data"]["tracks"]), i)
+            for i, artist_data in enumerate(artist_data_list)
+            if artist_data["track_data"]["tracks"]
+        ]
+        heapq.heapify(heap)
+        while heap:
+            playcount, i = heapq.heappop(heap)
+            artist_data = artist_data_list[i]
+            yield {
+                "artist": artist_data["artist"],
+                "tracks": [track_data["track_name"] for track_data in artist_data["track_data"]["tracks"]],
+                "playcount": -playcount,
+            }
+
+    @staticmethod
+    def shuffle_tracks(day: datetime, artist: str, tracks: list) -> list:
+        """
+        The artist's tracks in a random order that's the same for every playlist built for the day, whatever the
+        playlist options, so prewarm.py can search for the same tracks the day before
+        :param day: The year's day, seeded on its date so cached and freshly fetched stats shuffle the same
+        """
+        tracks = list(tracks)
+        random.Random(f"{str(day)[:10]}-{artist}").shuffle(tracks)
+        return tracks
+
     def search_for_tracks(
             self, artist_tracks: dict, year_track_limit: int = None,
             playlist_repeat_artists: bool = False, recently_played_tracks: set = None
@@ -207,8 +276,24 @@ class SpotifyClient:
         :param recently_played_tracks: Recently played tracks to skip
         :return: Tracks to be added to playlist
         """
+        return list(self.iter_tracks_for_playlist(artist_tracks, year_track_limit, playlist_repeat_artists,
+                                                  recently_played_tracks))
 
-        tracks_to_add_to_playlist = []
+    def iter_tracks_for_playlist(
+            self, artist_tracks: dict, year_track_limit: int = None,
+            playlist_repeat_artists: bool = False, recently_played_tracks: set = None, shuffle: bool = True
+    ):
+        """
+        Search for tracks, yielding each track URI in playlist order as soon as it is found
+        :param artist_tracks: Formatted last.fm stats
+        :param year_track_limit: Max number of tracks to add per year
+        :param playlist_repeat_artists: Allow artists to appear more than once in the playlist
+        :param recently_played_tracks: Recently played tracks to skip
+        :param shuffle: Shuffle each artist's tracks, False if they have already been shuffled
+        :return: Generator of track URIs
+        """
+
+        added_track_uris = set()
         added_artist_tracks = {}
         track_count = 0
 
@@ -222,12 +307,9 @@ class SpotifyClient:
                     _artist, selected_track, recently_played_tracks
                 )
                 if _found_track_uri:
-                    if _found_track_uri not in tracks_to_add_to_playlist:
-                        tracks_to_add_to_playlist.append(_found_track_uri)
-                        if added_artist_tracks.get(_artist):
-                            added_artist_tracks[_artist].append(selected_track)
-                        else:
-                            added_artist_tracks[_artist] = [selected_track]
+                    if _found_track_uri not in added_track_uris:
+                        added_track_uris.add(_found_track_uri)
+                        added_artist_tracks.setdefault(_artist, set()).add(selected_track)
                         return _found_track_uri
                     else:
                         logger.info(f"Skipping track already added: '{selected_track}' by {_artist}")
@@ -238,20 +320,23 @@ class SpotifyClient:
 
         for year, artist_track_data in artist_tracks.items():
             tracks_added_this_year = 0
+            artists_considered = 0
 
             for artist_dict in artist_track_data:
                 if tracks_added_this_year >= year_track_limit:
                     break
+                artists_considered += 1
 
                 artist = artist_dict["artist"]
-                if not playlist_repeat_artists and added_artist_tracks.get(artist):
+                if not playlist_repeat_artists and artist in added_artist_tracks:
                     logger.debug(f"Already added artist {artist}, skipping")
                     continue
 
                 tracks = artist_dict["tracks"]
-                random.shuffle(tracks)
-                tracks = list(set(tracks)) if len(tracks) > 1 else tracks
-                tracks = [i for i in tracks if i not in added_artist_tracks.get(artist, [])]
+                if shuffle:
+                    tracks = self.shuffle_tracks(year, artist, tracks)
+                artist_added_tracks = added_artist_tracks.get(artist, ())
+                tracks = [i for i in dict.fromkeys(tracks) if i not in artist_added_tracks]
 
                 if recently_played_tracks:
                     unique_tracks = []
@@ -266,33 +351,180 @@ class SpotifyClient:
                 found_track_uri = _choose_track_for_artist(artist, tracks)
                 if found_track_uri:
                     tracks_added_this_year += 1
+                    yield found_track_uri
+                    if tracks_added_this_year >= year_track_limit:
+                        break
                 else:
                     logger.info(f"NO TRACKS FOUND FOR ARTIST: {artist}\n")
 
-            logger.info(f"Tracks added for {year.year}: {tracks_added_this_year}/{len(artist_track_data)}\n")
+            logger.info(f"Tracks added for {year.year}: {tracks_added_this_year}/{artists_considered}\n")
             track_count += tracks_added_this_year
-        logger.info(f"Total tracks to add to playlist: {len(tracks_to_add_to_playlist)} track_count: {track_count}")
-        return tracks_to_add_to_playlist
+        logger.info(f"Total tracks to add to playlist: {track_count}")
 
-    def batch_add_tracks_to_playlist(self, playlist_id: str, track_data: list):
-        if len(track_data) > ADD_TO_PLAYLIST_BATCH_LIMIT:
-            batch = track_data[:ADD_TO_PLAYLIST_BATCH_LIMIT]
-            queue = track_data[ADD_TO_PLAYLIST_BATCH_LIMIT:]
-        else:
-            batch = track_data
-            queue = None
+    def build_playlist_pipelined(
+            self, artist_tracks: dict, lastfm_user_data: dict = None, year_track_limit: int = None,
+            playlist_repeat_artists: bool = False, recently_played_tracks: set = None
+    ) -> (str, str, int):
+        """
+        Create the playlist as soon as the first track is found and add tracks in batches while the search continues.
+        The playlist calls are made on a single worker thread so batches are added in the order they were found.
+        The worker runs in the request's context, so the Spotify token can be read from the Flask session.
+        The search stops as soon as a playlist call fails, and if the search or a batch fails after the playlist was
+        created, the half-built playlist is deleted before the error is raised.
+        :return: (playlist_id, playlist_url, track_count)
+        """
+        playlist_future = None
+        add_futures = []
+        batch = []
+        track_count = 0
+        search_error = None
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            try:
+                for track_uri in self.iter_tracks_for_playlist(artist_tracks, year_track_limit,
+                                                               playlist_repeat_artists, recently_played_tracks):
+                    if not playlist_future:
+                        playlist_future = submit_in_context(executor, self.create_playlist, lastfm_user_data)
+                    elif (playlist_future.done() and playlist_future.exception()) or self.any_failed(add_futures):
+                        break
+                    batch.append(track_uri)
+                    track_count += 1
+                    if len(batch) >= ADD_TO_PLAYLIST_BATCH_LIMIT:
+                        add_futures.append(
+                            submit_in_context(executor, self._add_batch_to_playlist, playlist_future, batch)
+                        )
+                        batch = []
+                if batch:
+                    add_futures.append(submit_in_context(executor, self._add_batch_to_playlist, playlist_future, batch))
+            except Exception as e:
+                search_error = e
+
+        if not playlist_future:
+            if search_error:
+                raise search_error
+            return None, None, 0
+        playlist_id, playlist_url = playlist_future.result()
+        try:
+            if search_error:
+                raise search_error
+            for future in add_futures:
+                future.result()
+        except Exception:
+            self.delete_playlist(playlist_id)
+            raise
+        return playlist_id, playlist_url, track_count
 
+    @staticmethod
+    def any_failed(futures: list) -> bool:
+        """
+        Whether any of the futures has failed. The ones that have succeeded are removed from the list.
+        """
+        futures[:] = [future for future in futures if not future.done() or future.exception()]
+        return any(future.done() for future in futures)
+
+    def delete_playlist(self, playlist_id: str):
+        """
+        Delete (unfollow) a playlist that couldn't be finished
+        """
+        logger.warning(f"Deleting unfinished playlist {playlist_id}")
+        try:
+            self.spotify_client.current_user_unfollow_playlist(playlist_id)
+            GoogleMonitoringClient().increment_thread("spotify-playlist-deleted")
+        except Exception:
+            logger.exception(f"Couldn't delete unfinished playlist {playlist_id}")
+
+    def _add_batch_to_playlist(self, playlist_future, batch: list):
+        playlist_id, _ = playlist_future.result()
         logger.info(f"Adding {len(batch)} tracks to playlist")
         self.spotify_client.playlist_add_items(playlist_id, batch)
 
-        if queue:
-            self.batch_add_tracks_to_playlist(playlist_id, track_data[ADD_TO_PLAYLIST_BATCH_LIMIT:])
+    def batch_add_tracks_to_playlist(self, playlist_id: str, track_data: list):
+        for start in range(0, len(track_data), ADD_TO_PLAYLIST_BATCH_LIMIT):
+            batch = track_data[start:start + ADD_TO_PLAYLIST_BATCH_LIMIT]
+            logger.info(f"Adding {len(batch)} tracks to playlist")
+            self.spotify_client.playlist_add_items(playlist_id, batch)
 
     def spotify_search(self, artist: str, track_name: str, recently_played_tracks: set = None) -> str:
         """
         Search Spotify for the track
         :return: Track URI if track is found
         """
+        resolved_track = self.resolve_track(artist, track_name)
+        if not resolved_track:
+            return None
+        if recently_played_tracks:
+            hash_key = hash(f"{resolved_track['artist']}{resolved_track['track_name']}".lower())
+            if hash_key in recently_played_tracks:
+                logger.info(f"Skipping recently played track '{resolved_track['track_name']}'"
+                            f" by '{resolved_track['artist']}'")
+                return None
+        return resolved_track["uri"]
+
+    def resolve_track(self, artist: str, track_name: str) -> dict:
+        """
+        Find the track in the shared track index or search Spotify for it, remembering the result for this client
+        :return: {"uri", "artist", "track_name"} of the matching Spotify track if found
+        """
+        return self._resolve_track(artist, track_name) or None
+
+    def _resolve_track(self, artist: str, track_name: str) -> dict or None:
+        """
+        :return: The matching Spotify track, None if not found or False if the search (or its retry) failed.
+        Failed searches aren't remembered, so they're tried again.
+        """
+        key = (artist, track_name)
+        if key not in self.resolved_tracks:
+            resolved_track = self.track_index.get(self.available_market, artist, track_name)
+            if resolved_track:
+                self.track_index_hits += 1
+            else:
+                resolved_track = self._search_track(artist, track_name)
+                if resolved_track is False:
+                    return False
+                if resolved_track:
+                    self.track_index.set(self.available_market, artist, track_name, resolved_track)
+            self.resolved_tracks[key] = resolved_track
+        return self.resolved_tracks[key]
+
+    def _search_track(self, artist: str, track_name: str) -> dict or None:
+        """
+        :return: The matching Spotify track, None if not found or False if the search failed
+        """
+        start = time.perf_counter()
+        search_query = f"{track_name} {artist}"
+        cached_result = self.cache.get_cached_spotify_search_result(search_query=search_query,
+                                                                   available_market=self.available_market)
+        if cached_result:
+            self.search_cache_hits += 1
+            search_result = cached_result.get("search_result")
+        else:
+            self.search_cache_misses += 1
+            GoogleMonitoringClient().increment_thread("spotify-search-request")
+            with span("spotify.search", search_query):
+                search_result = self.spotify_client.search(**self.get_search_params(search_query))
+            self.cache.cache_spotify_search_result(search_query=search_query,
+                                                   available_market=self.available_market,
+                                                   search_result=search_result)
+        found_track, retry_search = self.match_search_result(artist, track_name, search_result)
+        log_event(logger, "spotify.search", artist=artist, track_name=track_name, cached=bool(cached_result),
+                  found=bool(found_track), seconds=round(time.perf_counter() - start, 4))
+        if retry_search:
+            return self._resolve_track(*retry_search)
+        return found_track
+
+    def get_search_params(self, search_query: str) -> dict:
+        search_params = {"q": "track:" + search_query, "type": "track"}
+        if self.available_market:
+            logger.debug("Spotify available_market:%s", self.available_market)
+            search_params.update({"market": self.available_market})
+        return search_params
+
+    @staticmethod
+    def match_search_result(artist: str, track_name: str, search_result: dict) -> (dict, tuple):
+        """
+        Find the track in a Spotify search result
+        :return: (found_track, retry_search): The matching Spotify track, None if not found or False if the result
+        couldn't be read, and the (artist, track_name) to search for instead if the track wasn't found
+        """
 
         def _strip_search_term(search_term):
             if len(search_term) > 75:
@@ -311,9 +543,7 @@ class SpotifyClient:
         def _match_artist(_search_artist, _result_artist):
             _search_artist = _strip_search_term(_search_artist).replace(" and ", " ")
             _result_artist = _strip_search_term(_result_artist).replace(" and ", " ")
-            logger.debug(f"_search_artist = {_search_artist}")
-            logger.debug(f"_result_artist = {_result_artist}")
-            logger.debug(f"= {_search_artist == _result_artist}")
+            logger.debug("_search_artist = %s, _result_artist = %s", _search_artist, _result_artist)
             if _search_artist == _result_artist or _search_artist in _result_artist.split(","):
                 return True
             return False
@@ -324,29 +554,11 @@ class SpotifyClient:
             return False
 
         track_name_search = track_name
-        artist_search = artist
-        logger.info(f"SEARCH   :'{track_name}' by '{artist}'")
-        search_query = f"{track_name_search} {artist_search}"
-        logger.debug(f"SEARCH QUERY: {search_query}")
-        cached_result = self.cache.get_cached_spotify_search_result(search_query=search_query,
-                                                                               available_market=self.available_market)
-        if cached_result:
-            search_result = cached_result.get("search_result")
-        else:
-            search_params = {"q": "track:" + search_query, "type": "track"}
-            if self.available_market:
-                logger.debug(f"Spotify available_market:{self.available_market}")
-                search_params.update({"market": self.available_market})
-            search_result = self.spotify_client.search(**search_params)
-            self.cache.cache_spotify_search_result(search_query=search_query,
-                                                              available_market=self.available_market,
-                                                              search_result=search_result)
-        logger.debug(f"Spotify search_result = {search_result}")
+        logger.debug("Spotify search_result = %s", search_result)
         try:
             found_item = None
             found_track_name = None
             search_artist_name = None
-            track_played_recently = False
             if search_result.get("tracks"):
                 search_result = search_result["tracks"]
                 if search_result.get("items"):
@@ -359,41 +571,32 @@ class SpotifyClient:
                             search_artist_name = search_artist.get("name")
                             if _match_artist(search_artist_name, artist) \
                                     and not _incorrect_live_version(track_name_search, found_track_name):
-                                if recently_played_tracks:
-                                    hash_key = hash(f"{search_artist_name}{found_track_name}".lower())
-                                    if hash_key in recently_played_tracks:
-                                        track_played_recently = True
-                                        break
                                 found_item = item
                                 break
                         else:
                             continue
                         break
 
-            if track_played_recently:
-                logger.info(f"Skipping recently played track '{found_track_name}'"
-                            f" by '{search_artist_name}'")
-            elif found_item:
-                logger.info(f"FOUND    :'{found_track_name}' by '{search_artist_name}'")
-                return found_item.get("uri")
+            if found_item:
+                logger.debug("FOUND    :'%s' by '%s'", found_track_name, search_artist_name)
+                return {"uri": found_item.get("uri"), "artist": search_artist_name,
+                        "track_name": found_track_name}, None
             else:
                 if "[" in track_name and "]" in track_name:
                     track_name_without_brackets = re.sub("[\[].*?[\]]", "", track_name)
                     if track_name_without_brackets:
-                        logger.debug(f"Searching for {track_name} without square brackets")
-                        return self.spotify_search(
-                            artist, track_name_without_brackets, recently_played_tracks
-                        )
+                        logger.debug("Searching for %s without square brackets", track_name)
+                        return None, (artist, track_name_without_brackets)
                 else:
                     stripped_track_name = _strip_search_term(track_name)
                     stripped_artist = _strip_search_term(artist)
                     if stripped_track_name != track_name.lower() or stripped_artist != artist.lower():
-                        return self.spotify_search(
-                            stripped_artist, stripped_track_name, recently_played_tracks
-                        )
+                        return None, (stripped_artist, stripped_track_name)
                     else:
-                        logger.info(f"NOT FOUND:'{track_name}' by '{artist}'\n")
+                        logger.debug("NOT FOUND:'%s' by '%s'", track_name, artist)
+            return None, None
 
         except Exception:
             GoogleMonitoringClient().increment_thread("spotify-exception")
             logger.exception(f"Unhandled Spotify search error: {search_result}")
+            return False, None
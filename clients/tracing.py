@@ -0,0 +1,163 @@
+"""
+Per-request timing of outbound calls and cache lookups.
+
+A Trace is started for a request and held in a context variable, so spans recorded anywhere while handling the
+request (including in threads started with clients.submit_in_context or clients.run_in_thread) are added to it.
+When no trace is active, span() and traced() do nothing but look up the context variable.
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+# Fraction of requests to trace and write to TRACE_DIR
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE") or 0)
+# Trace every request and return a summary in the Server-Timing response header. For debugging only
+TRACE_HEADER = os.getenv("TRACE_HEADER", "false").lower() == "true"
+TRACE_DIR = os.getenv("TRACE_DIR") or os.path.join(os.getcwd(), "local_cache", "traces")
+MAX_SPANS = 2000
+MAX_DETAIL_LENGTH = 120
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    def __init__(self, name: str):
+        self.name = name
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration_ms = None
+        self.spans = []
+        self.dropped_spans = 0
+        self.lock = threading.Lock()
+
+    def add_span(self, name: str, detail: str, start: float, end: float):
+        with self.lock:
+            if len(self.spans) >= MAX_SPANS:
+                self.dropped_spans += 1
+                return
+            self.spans.append({
+                "name": name,
+                "detail": detail[:MAX_DETAIL_LENGTH],
+                "start_ms": round((start - self.start) * 1000, 1),
+                "duration_ms": round((end - start) * 1000, 1),
+                "thread": threading.current_thread().name,
+            })
+
+    def finish(self):
+        self.duration_ms = round((time.perf_counter() - self.start) * 1000, 1)
+
+    def summary(self) -> dict:
+        """
+        :return: {span name: (count, total ms)}
+        """
+        summary = {}
+        with self.lock:
+            for span in self.spans:
+                count, total = summary.get(span["name"], (0, 0))
+                summary[span["name"]] = (count + 1, total + span["duration_ms"])
+        return summary
+
+    def server_timing(self) -> str:
+        """
+        The trace summarised for a Server-Timing header
+        """
+        timings = [f'{name};dur={total:.1f};desc="{count} calls"' for name, (count, total) in self.summary().items()]
+        timings.append(f"total;dur={self.duration_ms or 0:.1f}")
+        return ", ".join(timings)
+
+    def waterfall(self) -> str:
+        """
+        One line per span in start order, with a bar showing when it ran during the request
+        """
+        width = 40
+        total = max(self.duration_ms or 0, 1)
+        lines = [f"{self.name} {self.duration_ms} ms"]
+        for span in sorted(self.spans, key=lambda s: s["start_ms"]):
+            offset = int(span["start_ms"] / total * width)
+            length = max(1, int(span["duration_ms"] / total * width))
+            bar = " " * offset + "#" * length
+            lines.append(f"{span['start_ms']:>9.1f} {span['duration_ms']:>9.1f} ms |{bar:<{width}}| "
+                         f"{span['name']} {span['detail']} [{span['thread']}]")
+        if self.dropped_spans:
+            lines.append(f"... {self.dropped_spans} more spans")
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "spans": self.spans,
+            "dropped_spans": self.dropped_spans,
+        }
+
+
+def should_trace() -> bool:
+    return TRACE_HEADER or (TRACE_SAMPLE_RATE and random.random() < TRACE_SAMPLE_RATE)
+
+
+def start_trace(name: str) -> contextvars.Token:
+    return current_trace.set(Trace(name))
+
+
+def end_trace(token: contextvars.Token) -> "Trace":
+    trace = current_trace.get()
+    try:
+        current_trace.reset(token)
+    except ValueError:
+        # The token was created in another context, e.g. a streamed response closed on another thread
+        current_trace.set(None)
+    if trace:
+        trace.finish()
+    return trace
+
+
+def write_trace(trace: Trace):
+    """
+    Append the trace as a line of JSON to today's file in TRACE_DIR
+    """
+    try:
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        with open(os.path.join(TRACE_DIR, f"{time.strftime('%Y-%m-%d')}.jsonl"), "a") as f:
+            f.write(json.dumps(trace.to_dict()) + "\n")
+    except OSError:
+        logger.exception(f"Couldn't write trace for {trace.name}")
+
+
+@contextmanager
+def span(name: str, detail: str = ""):
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, detail, start, time.perf_counter())
+
+
+def traced(name: str):
+    """
+    Record each call of the decorated function as a span, with its string arguments as the detail
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if current_trace.get() is None:
+                return func(*args, **kwargs)
+            detail = " ".join(str(arg) for arg in [*args, *kwargs.values()] if isinstance(arg, str))
+            with span(name, detail):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,159 @@
+import hashlib
+import logging
+import os
+import re
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+
+import pytz
+
+from clients.database import Singleton, get_db_client
+from clients.monitoring_client import GoogleMonitoringClient, stats_profile
+
+logger = logging.getLogger(__name__)
+
+TRACK_INDEX_WARM_SIZE = int(os.getenv("TRACK_INDEX_WARM_SIZE") or 5000)
+TRACK_INDEX_MAX_AGE_DAYS = int(os.getenv("TRACK_INDEX_MAX_AGE_DAYS") or 30)
+TRACK_INDEX_HIT_FLUSH = 10
+# Entries outside the warm set whose hits haven't been written yet
+TRACK_INDEX_PENDING_SIZE = 1000
+# Part of every key, so changing how names are canonicalized doesn't return the old keys' resolutions
+TRACK_INDEX_KEY_VERSION = 2
+# Parentheticals and " - " suffixes that don't change the recording. Remixes, live, acoustic, instrumental, demo,
+# edit, reprise etc. are kept because they're a different recording.
+NOISE_PATTERN = re.compile(
+    r"(?:\d{4}\s+)?(?:digital(?:ly)?\s+)?remaster(?:ed)?(?:\s+(?:version|\d{4}))*"
+    r"|(?:album|single|lp)\s+version"
+    r"|explicit|bonus\s+track"
+    r"|(?:feat\.?|ft\.|featuring)\s.*"
+)
+
+
+def canonicalize(text: str) -> str:
+    """
+    Normalize an artist or track name so that e.g. "Song (Album Version)", "Song - 2011 Remaster" and "song" match,
+    but "Song (Remix)" and "Song - Acoustic" don't.
+    Names that are only punctuation, e.g. "!!!", are kept lowercased rather than all normalized to "".
+    """
+    raw = " ".join(str(text).lower().split())
+    text = str(text).lower()
+    text = re.split(r"\s(?:feat\.|ft\.|featuring)\s", text)[0]
+    text = re.sub(r"[(\[]([^)\]]*)[)\]]",
+                  lambda m: " " if NOISE_PATTERN.fullmatch(m.group(1).strip()) else m.group(0), text)
+    text = re.sub(r"\s-\s(.*)$", lambda m: "" if NOISE_PATTERN.fullmatch(m.group(1).strip()) else m.group(0), text)
+    text = re.sub(r"[^\w\s]", "", text)
+    return " ".join(text.split()) or raw
+
+
+class TrackIndex(metaclass=Singleton):
+    """
+    Spotify track resolutions shared by all users, keyed on the canonical (artist, track name) per market.
+    The most requested entries are kept in memory, loaded by /warmup or in the background on first use.
+    """
+
+    def __init__(self):
+        self._db = None
+        self.warm_entries = {}
+        # key: entry for entries outside warm_entries with hits not written yet, least recently hit first
+        self.pending_entries = OrderedDict()
+        self.pending_hits = {}
+        self.warm_up_started = False
+        self.lock = Lock()
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = get_db_client()
+        return self._db
+
+    @staticmethod
+    def get_key(available_market: str, artist: str, track_name: str) -> str:
+        return hashlib.md5(
+            f"{TRACK_INDEX_KEY_VERSION}-{available_market}-{canonicalize(artist)}-{canonicalize(track_name)}".encode()
+        ).hexdigest()
+
+    def start_warm_up(self):
+        """
+        Load the most requested resolutions on a background thread, unless they're already loading
+        """
+        with self.lock:
+            if self.warm_up_started:
+                return
+            self.warm_up_started = True
+        Thread(target=self.warm_up, name="track_index_warm_up", daemon=True).start()
+
+    @stats_profile
+    def warm_up(self, size: int = TRACK_INDEX_WARM_SIZE):
+        """
+        Load the most requested resolutions into memory
+        """
+        self.warm_up_started = True
+        entries = self.db.get_top_documents("track_index", "hits", size)
+        with self.lock:
+            self.warm_entries.update(entries)
+        logger.info(f"Loaded {len(entries)} track resolutions into memory")
+
+    def get(self, available_market: str, artist: str, track_name: str) -> dict or None:
+        if not self.warm_up_started:
+            self.start_warm_up()
+        key = self.get_key(available_market, artist, track_name)
+        entry = self.warm_entries.get(key) or self.pending_entries.get(key)
+        if not entry:
+            entry = self.db.get_document("track_index", key)
+            if not entry.get("uri"):
+                GoogleMonitoringClient().increment_thread("track-index-miss")
+                return None
+        date_cached = entry.get("date_cached")
+        if not date_cached or datetime.utcnow().replace(tzinfo=pytz.utc) - date_cached.replace(
+                tzinfo=pytz.utc) > timedelta(days=TRACK_INDEX_MAX_AGE_DAYS):
+            with self.lock:
+                self.warm_entries.pop(key, None)
+                self.pending_entries.pop(key, None)
+            GoogleMonitoringClient().increment_thread("track-index-expired")
+            return None
+        self._record_hit(key, entry)
+        GoogleMonitoringClient().increment_thread("track-index-hit")
+        return {"uri": entry["uri"], "artist": entry["resolved_artist"], "track_name": entry["resolved_track_name"]}
+
+    def set(self, available_market: str, artist: str, track_name: str, resolved_track: dict):
+        key = self.get_key(available_market, artist, track_name)
+        entry = {
+            "available_market": available_market or "",
+            "artist": canonicalize(artist),
+            "track_name": canonicalize(track_name),
+            "uri": resolved_track["uri"],
+            "resolved_artist": resolved_track["artist"],
+            "resolved_track_name": resolved_track["track_name"],
+            "hits": (self.warm_entries.get(key) or self.pending_entries.get(key) or {}).get("hits", 0),
+            "date_cached": datetime.utcnow(),
+        }
+        self.db.set_document("track_index", key, entry)
+
+    def _record_hit(self, key: str, entry: dict):
+        """
+        Count the hit in memory and add the unwritten hits to the stored count every TRACK_INDEX_HIT_FLUSH hits.
+        Entries that don't fit in warm_entries are kept in pending_entries until their hits are written, and the
+        least recently hit are written early to keep it to TRACK_INDEX_PENDING_SIZE.
+        """
+        flush = []
+        with self.lock:
+            entry["hits"] = entry.get("hits", 0) + 1
+            if key not in self.warm_entries:
+                if len(self.warm_entries) < TRACK_INDEX_WARM_SIZE:
+                    self.warm_entries[key] = self.pending_entries.pop(key, entry)
+                else:
+                    self.pending_entries[key] = entry
+                    self.pending_entries.move_to_end(key)
+            pending_hits = self.pending_hits.get(key, 0) + 1
+            if pending_hits >= TRACK_INDEX_HIT_FLUSH:
+                flush.append((key, pending_hits))
+                self.pending_entries.pop(key, None)
+                pending_hits = 0
+            self.pending_hits[key] = pending_hits
+            while len(self.pending_entries) > TRACK_INDEX_PENDING_SIZE:
+                pending_key, _ = self.pending_entries.popitem(last=False)
+                flush.append((pending_key, self.pending_hits.pop(pending_key, 0)))
+        for flush_key, hits in flush:
+            if hits:
+                self.db.increment_field("track_index", flush_key, "hits", hits)
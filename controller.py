@@ -1,22 +1,56 @@
 import logging
-from datetime import datetime
+import os
+from datetime import datetime, timedelta
+from threading import Lock, Thread
 
 from dateutil.relativedelta import relativedelta
-from dotenv import load_dotenv
 
 from clients.cache import Cache
 # from clients.firestore_client import FirestoreClient
-from clients.lastfm_client import LastfmClient
-from clients.monitoring_client import GoogleMonitoringClient, stats_profile
+from clients.lastfm_client import LastfmClient, STREAM_RECENT_TRACKS
+from clients.lastfm_scheduler import lastfm_priority
+from clients.monitoring_client import stats_profile
 from clients.spotify_client import SpotifyClient
+from clients.track_index import TrackIndex
 from countries import spotify_available_countries, timezone_countries
 
 logger = logging.getLogger(__name__)
-load_dotenv()
 
 # firestore_client = FirestoreClient()
 cache = Cache()
-monitoring_client = GoogleMonitoringClient()
+
+PLAYLIST_PREVIEW_TTL_MINUTES = int(os.getenv("PLAYLIST_PREVIEW_TTL_MINUTES") or 25)
+PLAYLIST_PREVIEW_MAX_ENTRIES = int(os.getenv("PLAYLIST_PREVIEW_MAX_ENTRIES") or 500)
+playlist_previews = {}
+playlist_previews_lock = Lock()
+
+STATS_PAGE_CACHE_MAX_ENTRIES = int(os.getenv("STATS_PAGE_CACHE_MAX_ENTRIES") or 100)
+STATS_PAGE_CACHE_MAX_BYTES = int(os.getenv("STATS_PAGE_CACHE_MAX_BYTES") or 8 * 1024 * 1024)
+STATS_DEADLINE_SECONDS = float(os.getenv("STATS_DEADLINE_SECONDS") or 0)
+if STATS_DEADLINE_SECONDS and STREAM_RECENT_TRACKS:
+    logger.warning("STATS_DEADLINE_SECONDS is ignored with STREAM_RECENT_TRACKS: streamed years are cached one by one "
+                   "and can't be returned before they're all fetched")
+stats_pages = {}
+stats_pages_lock = Lock()
+
+USER_INFO_TTL_HOURS = int(os.getenv("USER_INFO_TTL_HOURS") or 24)
+user_info_refreshes = set()
+user_info_refreshes_lock = Lock()
+
+USER_NOT_FOUND_TTL_SECONDS = int(os.getenv("USER_NOT_FOUND_TTL_SECONDS") or 300)
+USER_NOT_FOUND_MAX_ENTRIES = int(os.getenv("USER_NOT_FOUND_MAX_ENTRIES") or 1000)
+users_not_found = {}
+users_not_found_lock = Lock()
+
+
+def evict_entries(entries: dict, is_expired, max_entries: int):
+    """
+    Remove expired entries and then the oldest entries until there is room for a new one
+    """
+    for expired_key in [k for k, v in entries.items() if is_expired(k, v)]:
+        del entries[expired_key]
+    while len(entries) >= max_entries:
+        del entries[next(iter(entries))]
 
 def get_lastfm_user_info(username: str):
     start_time = datetime.now()
@@ -31,6 +65,15 @@ def get_lastfm_user_info(username: str):
 
 
 def get_or_create_user(username: str):
+    """
+    The user's cached document, with their Last.fm profile fetched the first time they're seen.
+    A profile older than USER_INFO_TTL_HOURS is returned as it is and refreshed in the background, and usernames
+    Last.fm doesn't know are remembered for USER_NOT_FOUND_TTL_SECONDS.
+    """
+    username = username.strip().lower()
+    if is_user_not_found(username):
+        logger.info(f"User {username} not found on lastfm (cached)")
+        return {}
     user = cache.get_user(username)
     if not user or not user.get("user_info"):
         lastfm_user_info = LastfmClient.get_lastfm_user_data(username)
@@ -40,34 +83,344 @@ def get_or_create_user(username: str):
             )
         else:
             logger.info(f"User {username} not found on lastfm")
+            if lastfm_user_info is not None:
+                set_user_not_found(username)
+    elif is_user_info_stale(user):
+        refresh_user_info_in_background(username)
     return user
 
 
+def is_user_info_stale(user: dict) -> bool:
+    user_info_updated = user.get("user_info_updated")
+    if not user_info_updated:
+        return True
+    return user_info_updated.replace(tzinfo=None) < datetime.utcnow() - timedelta(hours=USER_INFO_TTL_HOURS)
+
+
+def refresh_user_info_in_background(username: str):
+    """
+    Refresh the user's Last.fm profile on a separate thread, unless it's already being refreshed
+    """
+    with user_info_refreshes_lock:
+        if username in user_info_refreshes:
+            return
+        user_info_refreshes.add(username)
+    Thread(target=refresh_user_info, args=(username,), name=f"refresh_user_info_{username}", daemon=True).start()
+
+
+def refresh_user_info(username: str):
+    try:
+        with lastfm_priority("background"):
+            lastfm_user_info = LastfmClient.get_lastfm_user_data(username)
+        if lastfm_user_info and lastfm_user_info.get("username"):
+            cache.update_user_info(username, lastfm_user_info)
+            logger.info(f"Refreshed user info for {username}")
+        else:
+            logger.info(f"Couldn't refresh user info for {username}, keeping the cached user info")
+    except Exception:
+        logger.exception(f"Error refreshing user info for {username}")
+    finally:
+        with user_info_refreshes_lock:
+            user_info_refreshes.discard(username)
+
+
+def is_user_not_found(username: str) -> bool:
+    with users_not_found_lock:
+        expires = users_not_found.get(username)
+        return bool(expires) and expires > datetime.utcnow()
+
+
+def set_user_not_found(username: str):
+    with users_not_found_lock:
+        evict_entries(users_not_found, lambda k, expires: expires <= datetime.utcnow(), USER_NOT_FOUND_MAX_ENTRIES)
+        users_not_found[username] = datetime.utcnow() + timedelta(seconds=USER_NOT_FOUND_TTL_SECONDS)
+
+
+def warm_up():
+    """
+    Connect to the database and load the most requested Spotify track resolutions, so that the first request on a
+    new instance doesn't have to
+    """
+    cache.get_user("_warmup")
+    TrackIndex().warm_up()
+
+
 def clear_stats(username: str):
     if username:
         cache.clear_user_data(username)
+        with stats_pages_lock:
+            for key in [k for k in stats_pages if k[0] == username.lower()]:
+                del stats_pages[key]
+
+
+def get_stats_page(lastfm_user_data: dict, tz_offset: int, poll: bool = False) -> dict:
+    """
+    The user's stats for today and their rendered fragments.
+    The fragments are cached per (username, tz_offset, local date) until the stats are cleared or the day changes,
+    for at most STATS_PAGE_CACHE_MAX_ENTRIES users and STATS_PAGE_CACHE_MAX_BYTES of fragments.
+    The stats themselves aren't kept, since they're in the database cache: a cached page has "stats" set to None,
+    and get_stats_fragment reads them back when a fragment hasn't been rendered yet.
+    With STATS_DEADLINE_SECONDS, the years Last.fm hasn't returned by then are left out and the page is partial.
+    If a year couldn't be fetched, the others are returned and the page is marked failed instead.
+    Partial and failed pages aren't cached, so the next request gets the years fetched since.
+    :param poll: Only check on the fetch started by an earlier request, without waiting for Last.fm
+    :return: {"stats", "has_stats", "date_cached", "fragments", "partial", "failed"}
+    """
+    key = get_stats_page_key(lastfm_user_data, tz_offset)
+    stats_page = stats_pages.get(key)
+    if stats_page:
+        # A copy, so the stats read back for this request's fragments aren't cached with it
+        stats_page = dict(stats_page)
+    else:
+        deadline = 0 if poll else STATS_DEADLINE_SECONDS or None
+        stats, date_cached, partial, failed = get_stats(lastfm_user_data, tz_offset, deadline)
+        if partial or failed:
+            stats_page = new_stats_page(stats, date_cached, partial=partial, failed=failed)
+        else:
+            stats_page = set_stats_page(key, stats, date_cached)
+    return stats_page
+
+
+async def get_stats_page_async(http_session, lastfm_user_data: dict, tz_offset: int) -> dict:
+    """
+    get_stats_page, fetching the stats from Last.fm on the event loop
+    :param http_session: aiohttp session for the event loop
+    """
+    from clients.async_lastfm_client import AsyncLastfmClient
+
+    key = get_stats_page_key(lastfm_user_data, tz_offset)
+    stats_page = stats_pages.get(key)
+    if not stats_page or (stats_page["stats"] is None and stats_page["has_stats"]):
+        lfm_client = AsyncLastfmClient(http_session, key[0], lastfm_user_data["join_date"], tz_offset)
+        stats, date_cached = await lfm_client.get_stats_async()
+        if stats_page:
+            stats_page = dict(stats_page, stats=stats)
+        else:
+            stats_page = set_stats_page(key, stats, date_cached)
+    return stats_page
+
+
+def get_stats_page_key(lastfm_user_data: dict, tz_offset: int) -> tuple:
+    today = (datetime.utcnow() - timedelta(minutes=tz_offset)).date()
+    return lastfm_user_data["username"].lower(), tz_offset, today
+
+
+def new_stats_page(stats: list, date_cached: datetime, partial: bool = False, failed: bool = False) -> dict:
+    return {
+        "stats": stats,
+        "has_stats": bool(stats),
+        "date_cached": date_cached,
+        "fragments": {},
+        "partial": partial,
+        "failed": failed,
+    }
+
+
+def set_stats_page(key: tuple, stats: list, date_cached: datetime) -> dict:
+    """
+    Cache the page without its stats. The cached page shares its fragments with the returned one.
+    :return: The page with its stats, for the current request
+    """
+    stats_page = new_stats_page(stats, date_cached)
+    with stats_pages_lock:
+        evict_entries(stats_pages, lambda k, v: k[2] < key[2] - timedelta(days=1), STATS_PAGE_CACHE_MAX_ENTRIES)
+        stats_pages[key] = dict(stats_page, stats=None)
+    return stats_page
+
+
+def evict_oversized_stats_pages():
+    """
+    Remove the oldest pages while the cached fragments add up to more than STATS_PAGE_CACHE_MAX_BYTES
+    """
+    with stats_pages_lock:
+        size = sum(get_fragments_size(stats_page) for stats_page in stats_pages.values())
+        while size > STATS_PAGE_CACHE_MAX_BYTES:
+            size -= get_fragments_size(stats_pages.pop(next(iter(stats_pages))))
+
+
+def get_fragments_size(stats_page: dict) -> int:
+    return sum(len(fragment) for fragment in stats_page["fragments"].values() if isinstance(fragment, str))
 
 
 @stats_profile
-def get_stats(lastfm_user_data: dict, tz_offset: int):
+def get_stats(lastfm_user_data: dict, tz_offset: int, deadline: float = None):
+    """
+    :param deadline: Seconds to wait for Last.fm before returning the years fetched so far
+    :return: (data, date_cached, partial, failed)
+    """
     data = None
     date_cached = None
+    partial = False
+    failed = False
     username = lastfm_user_data.get("username", "").lower()
     logger.debug(f"username:{username} lastfm_user_data:{lastfm_user_data}")
     if username:
         lfm_client = LastfmClient(
-            username, lastfm_user_data["join_date"], tz_offset
+            username, lastfm_user_data["join_date"], tz_offset, total_tracks=lastfm_user_data.get("total_tracks")
         )
-        data, date_cached = lfm_client.get_stats()
+        data, date_cached = lfm_client.get_stats(deadline)
+        partial = lfm_client.partial
+        failed = lfm_client.failed
 
     years_of_data = len(data) if data else 0
-    logger.info(f"Stats summary: {username} had {years_of_data} years of data")
-    return data, date_cached
+    logger.info(f"Stats summary: {username} had {years_of_data} years of data{' so far' if partial else ''}")
+    return data, date_cached, partial, failed
+
+def get_stats_fragment(stats_page: dict, fragment_key: tuple, render_fragment, lastfm_user_data: dict,
+                       tz_offset: int):
+    """
+    A rendered fragment of the stats page, rendered the first time it is requested.
+    The stats of a cached page are read back from the database cache to render it.
+    :param fragment_key: e.g. (view, year)
+    :param render_fragment: Function rendering the fragment from the stats
+    """
+    fragment = stats_page["fragments"].get(fragment_key)
+    if fragment is None:
+        stats = stats_page["stats"]
+        if stats is None and stats_page["has_stats"]:
+            stats = stats_page["stats"] = get_stats(lastfm_user_data, tz_offset)[0]
+        fragment = stats_page["fragments"][fragment_key] = render_fragment(stats)
+        if isinstance(fragment, str):
+            evict_oversized_stats_pages()
+    return fragment
+
+
+def iter_stats(lastfm_user_data: dict, tz_offset: int):
+    """
+    The user's stats for each year, yielded as soon as each year's data is available
+    """
+    username = lastfm_user_data.get("username", "").lower()
+    if username:
+        lfm_client = LastfmClient(username, lastfm_user_data["join_date"], tz_offset)
+        yield from lfm_client.iter_stats()
+
+
+def is_stats_cached(lastfm_user_data: dict, tz_offset: int) -> bool:
+    today = (datetime.utcnow() - timedelta(minutes=tz_offset)).date()
+    username = lastfm_user_data.get("username", "").lower()
+    if (username, tz_offset, today) in stats_pages:
+        return True
+    data, _, _ = LastfmClient(username, lastfm_user_data["join_date"], tz_offset).get_cached_data()
+    return bool(data)
+
 
 def get_cached_stats(username: str):
     return cache.get_user_data(username)
 
 
+def get_skip_recent_start_date(playlist_skip_recent_time: str = None) -> datetime or None:
+    if playlist_skip_recent_time:
+        if playlist_skip_recent_time.lower() == "year":
+            return datetime.utcnow() - relativedelta(years=1) + relativedelta(days=1)
+        elif playlist_skip_recent_time.lower() == "6 months":
+            return datetime.utcnow() - relativedelta(months=6)
+        elif playlist_skip_recent_time.lower() == "week":
+            return datetime.utcnow() - relativedelta(weeks=1)
+        else:
+            logger.warning(f"Unhandled playlist_skip_recent_time_start_date {playlist_skip_recent_time}")
+
+
+def get_playlist_preview(lastfm_user_data: dict, tz_offset: int, available_market: str) -> dict:
+    """
+    The server-side playlist state for the user's day and Spotify market, so that Spotify searches, recently played
+    scans and selected tracklists are reused when the playlist options change.
+    """
+    now = datetime.utcnow()
+    local_date = (now - timedelta(minutes=tz_offset)).date()
+    key = (lastfm_user_data["username"].lower(), local_date, available_market)
+    max_age = timedelta(minutes=PLAYLIST_PREVIEW_TTL_MINUTES)
+    with playlist_previews_lock:
+        preview = playlist_previews.get(key)
+        if preview and now - preview["date_created"] < max_age:
+            return preview
+        evict_entries(playlist_previews, lambda k, v: now - v["date_created"] >= max_age,
+                      PLAYLIST_PREVIEW_MAX_ENTRIES)
+        preview = {"date_created": now, "resolved_tracks": {}, "recently_played_tracks": {}, "tracklists": {}}
+        playlist_previews[key] = preview
+    return preview
+
+
+def get_recently_played_tracks(preview: dict, lastfm_user_data: dict, playlist_skip_recent_time: str = None) -> set:
+    skip_key = (playlist_skip_recent_time or "").lower()
+    if skip_key not in preview["recently_played_tracks"]:
+        preview["recently_played_tracks"][skip_key] = SpotifyClient.get_recently_played_tracks(
+            lastfm_user_data, get_skip_recent_start_date(playlist_skip_recent_time)
+        )
+    return preview["recently_played_tracks"][skip_key]
+
+
+@stats_profile
+def preview_playlist(
+    spotify_client: SpotifyClient,
+    lastfm_user_data: dict = None,
+    playlist_tracks_per_year: int = None,
+    playlist_order_recent_first: bool = True,
+    playlist_repeat_artists: bool = False,
+    playlist_skip_recent_time: str = None,
+    tz_offset: int = 0,
+) -> list:
+    """
+    Choose the tracks for a playlist without creating it.
+    The tracklist is kept so that creating the playlist with the same options only needs the playlist calls.
+    """
+    data, _, _, _ = get_stats(lastfm_user_data, tz_offset)
+    if not data:
+        return []
+    preview = get_playlist_preview(lastfm_user_data, tz_offset, spotify_client.available_market)
+    spotify_client.resolved_tracks = preview["resolved_tracks"]
+    options = (playlist_tracks_per_year, playlist_order_recent_first, playlist_repeat_artists,
+               playlist_skip_recent_time)
+    track_uris = preview["tracklists"].get(options)
+    if track_uris is None:
+        track_uris = spotify_client.select_playlist_tracks(
+            data, playlist_tracks_per_year, playlist_order_recent_first, playlist_repeat_artists,
+            get_recently_played_tracks(preview, lastfm_user_data, playlist_skip_recent_time)
+        )
+        preview["tracklists"][options] = track_uris
+    return spotify_client.describe_tracks(track_uris)
+
+
+async def select_playlist_tracks_async(
+    http_session,
+    spotify_client,
+    lastfm_user_data: dict = None,
+    playlist_tracks_per_year: int = None,
+    playlist_order_recent_first: bool = True,
+    playlist_repeat_artists: bool = False,
+    playlist_skip_recent_time: str = None,
+    tz_offset: int = 0,
+):
+    """
+    Choose the playlist's tracks on the event loop and keep them in the playlist preview,
+    so that previewing or making the playlist with these options only needs the playlist calls
+    :param http_session: aiohttp session for the event loop
+    :param spotify_client: AsyncSpotifyClient
+    """
+    from clients.async_lastfm_client import AsyncLastfmClient
+
+    data = (await get_stats_page_async(http_session, lastfm_user_data, tz_offset))["stats"]
+    if not data:
+        return
+    preview = get_playlist_preview(lastfm_user_data, tz_offset, spotify_client.available_market)
+    spotify_client.resolved_tracks = preview["resolved_tracks"]
+    options = (playlist_tracks_per_year, playlist_order_recent_first, playlist_repeat_artists,
+               playlist_skip_recent_time)
+    if options in preview["tracklists"]:
+        return
+    skip_key = (playlist_skip_recent_time or "").lower()
+    if skip_key not in preview["recently_played_tracks"]:
+        start_date = get_skip_recent_start_date(playlist_skip_recent_time)
+        recently_played_tracks = set()
+        if start_date:
+            lfm_client = AsyncLastfmClient(http_session, lastfm_user_data["username"], lastfm_user_data["join_date"])
+            recently_played_tracks = await lfm_client.get_scrobble_hashes_since_async(start_date)
+        preview["recently_played_tracks"][skip_key] = recently_played_tracks
+    preview["tracklists"][options] = await spotify_client.select_playlist_tracks_async(
+        data, playlist_tracks_per_year, playlist_order_recent_first, playlist_repeat_artists,
+        preview["recently_played_tracks"][skip_key]
+    )
+
+
 @stats_profile
 def make_playlist(
     spotify_client: SpotifyClient,
@@ -78,22 +431,23 @@ def make_playlist(
     playlist_skip_recent_time: str = None,
     tz_offset: int = 0,
 ):
-    data, _ = get_stats(lastfm_user_data, tz_offset)
-    playlist_skip_recent_time_start_date = False
-    if playlist_skip_recent_time:
-        if playlist_skip_recent_time.lower() == "year":
-            playlist_skip_recent_time_start_date = datetime.utcnow() - relativedelta(years=1) + relativedelta(days=1)
-        elif playlist_skip_recent_time.lower() == "6 months":
-            playlist_skip_recent_time_start_date = datetime.utcnow() - relativedelta(months=6)
-        elif playlist_skip_recent_time.lower() == "week":
-            playlist_skip_recent_time_start_date = datetime.utcnow() - relativedelta(weeks=1)
-        else:
-            logger.warning(f"Unhandled playlist_skip_recent_time_start_date {playlist_skip_recent_time}")
+    data, _, _, _ = get_stats(lastfm_user_data, tz_offset)
+    cache.update_user_playlist_market(lastfm_user_data["username"], spotify_client.available_market)
+    preview = get_playlist_preview(lastfm_user_data, tz_offset, spotify_client.available_market)
+    spotify_client.resolved_tracks = preview["resolved_tracks"]
+    options = (playlist_tracks_per_year, playlist_order_recent_first, playlist_repeat_artists,
+               playlist_skip_recent_time)
+    track_uris = preview["tracklists"].get(options)
+    # A previewed tracklist already skipped the recently played tracks
+    recently_played_tracks = None
+    if track_uris is None and playlist_skip_recent_time:
+        recently_played_tracks = get_recently_played_tracks(preview, lastfm_user_data, playlist_skip_recent_time)
 
     return spotify_client.make_playlist(
         data, lastfm_user_data, playlist_tracks_per_year=playlist_tracks_per_year,
         playlist_order_recent_first=playlist_order_recent_first, playlist_repeat_artists=playlist_repeat_artists,
-        skip_recently_played_start_date=playlist_skip_recent_time_start_date
+        skip_recently_played_start_date=get_skip_recent_start_date(playlist_skip_recent_time),
+        recently_played_tracks=recently_played_tracks, track_uris=track_uris,
     )
 
 
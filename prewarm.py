@@ -0,0 +1,93 @@
+"""
+Pre-warm the Spotify search cache with tomorrow's playlist tracks for recently active users.
+
+Each user's tracks are chosen with the same selection a playlist build uses, for each --tracks-per-year, both year
+orders and with and without repeated artists. Each artist's tracks are shuffled in an order fixed for the day
+(SpotifyClient.shuffle_tracks), so tomorrow's builds with these options make the same searches. Playlists that skip
+recently played tracks can't be predicted and may need other tracks.
+
+Run off-peak, e.g. from cron:
+    python prewarm.py --days 7 --tracks-per-year 5 10
+"""
+import argparse
+import logging
+from datetime import datetime, timedelta
+from itertools import product
+
+from spotipy.oauth2 import SpotifyClientCredentials
+
+from clients.cache import Cache
+from clients.lastfm_client import LastfmClient
+from clients.lastfm_scheduler import lastfm_priority
+from clients.spotify_client import SpotifyClient, DEFAULT_TRACKS_PER_YEAR
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+cache = Cache()
+
+
+def prewarm_user(username: str, day: datetime, spotify_client: SpotifyClient, tracks_per_year: list) -> (int, int):
+    """
+    Resolve the tracks of the user's playlists for the day into the Spotify search cache
+    :param tracks_per_year: The playlist lengths to pre-warm, as tracks per year
+    :return: (warm, searched): the tracks already in the track index or search cache, and the tracks searched for
+    """
+    user = cache.get_user(username)
+    user_info = user.get("user_info")
+    if not user_info or "playlist_market" not in user:
+        logger.info(f"Skipping {username}: no playlist made yet")
+        return 0, 0
+    tz_offset = user.get("tz_offset") or 0
+    lfm_client = LastfmClient(user_info["username"], user_info["join_date"], tz_offset,
+                              day=day - timedelta(minutes=tz_offset), total_tracks=user_info.get("total_tracks"))
+    with lastfm_priority("background"):
+        data = lfm_client.get_data_for_days(lfm_client.get_list_of_year_dates())
+        summary = lfm_client.summarize_and_filter_for_timezone(data, user.get("artist_tags"))
+    if not summary:
+        logger.info(f"Skipping {username}: no data for {day.date()}")
+        return 0, 0
+
+    spotify_client.available_market = user["playlist_market"] or None
+    spotify_client.search_cache_hits = spotify_client.search_cache_misses = spotify_client.track_index_hits = 0
+    spotify_client.resolved_tracks = {}
+    for playlist_tracks_per_year, order_recent_first, repeat_artists in product(tracks_per_year, (True, False),
+                                                                               (False, True)):
+        spotify_client.select_playlist_tracks(summary, playlist_tracks_per_year, order_recent_first, repeat_artists)
+    warm = spotify_client.track_index_hits + spotify_client.search_cache_hits
+    logger.info(f"Pre-warmed {username} ({spotify_client.available_market}): "
+                f"{spotify_client.track_index_hits} in the track index, {spotify_client.search_cache_hits} cached, "
+                f"{spotify_client.search_cache_misses} searched")
+    return warm, spotify_client.search_cache_misses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=7, help="Pre-warm users active in the last N days")
+    parser.add_argument("--tracks-per-year", type=int, nargs="+", default=[DEFAULT_TRACKS_PER_YEAR],
+                        help="Pre-warm playlists with these numbers of tracks per year")
+    args = parser.parse_args()
+
+    day = datetime.utcnow() + timedelta(days=1)
+    spotify_client = SpotifyClient(auth_manager=SpotifyClientCredentials())
+    usernames = cache.get_usernames_visited_since(datetime.utcnow() - timedelta(days=args.days))
+    logger.info(f"Pre-warming {day.date()} for {len(usernames)} users active in the last {args.days} days")
+
+    total_warm, total_searched = 0, 0
+    for username in usernames:
+        try:
+            warm, searched = prewarm_user(username, day, spotify_client, args.tracks_per_year)
+        except Exception:
+            logger.exception(f"Error pre-warming {username}")
+            continue
+        total_warm += warm
+        total_searched += searched
+
+    tracks = total_warm + total_searched
+    coverage = total_warm / tracks * 100 if tracks else 100
+    logger.info(f"Coverage before pre-warm: {total_warm}/{tracks} tracks ({coverage:.1f}%). "
+                f"{total_searched} searches added to the cache")
+
+
+if __name__ == "__main__":
+    main()
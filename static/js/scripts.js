@@ -20,6 +20,7 @@
 
 		        viewTypeSwitch.innerHTML = "<u>See All Scrobbles</u>"
 		    } else {
+		        loadFragment(statsChronoView);
 		        statsArtistView.style.display = "none";
 		        statsChronoView.style.display = "block";
 
@@ -30,6 +31,23 @@
 		    }
         }
 
+        function loadFragment(element) {
+            // Fetch a stats fragment the first time it's needed, rather than with the page
+            if (!element.dataset.fragmentUrl) {
+                return Promise.resolve();
+            }
+            if (!element.fragmentLoaded) {
+                element.fragmentLoaded = fetch(element.dataset.fragmentUrl)
+                    .then(response => response.ok ? response.text() : "")
+                    .then(html => { element.innerHTML = html; })
+                    .catch(err => {
+                        element.fragmentLoaded = null;
+                        console.error('Could not load stats: ', err);
+                    });
+            }
+            return element.fragmentLoaded;
+        }
+
         function loadingButton(btn_id, url=null, loading_msg=null) {
            btn = document.getElementById(btn_id);
            if (loading_msg != null){
@@ -128,3 +146,87 @@ var showPlaylistOptions = false;
     }
  };
 
+
+  function previewPlaylist(form_id, btn_id, preview_id){
+    var form = document.getElementById(form_id);
+    var btn = document.getElementById(btn_id);
+    var preview = document.getElementById(preview_id);
+    var formData = new FormData(form);
+    formData.delete("make_playlist");
+
+    btn.value = "Please wait...";
+    btn.disabled = true;
+    fetch("/playlist/preview", {method: "POST", body: formData})
+        .then(response => response.json()
+            .catch(() => ({tracks: []}))
+            .then(data => ({ok: response.ok, data: data})))
+        .then(({ok, data}) => {
+            preview.innerHTML = "";
+            preview.style.display = "block";
+            if (!ok){
+                preview.textContent = data.error || "Could not preview the playlist, please try again";
+                return;
+            }
+            if (data.tracks.length == 0){
+                preview.textContent = "No tracks found";
+            }
+            data.tracks.forEach(track => {
+                var line = document.createElement("div");
+                line.textContent = track.artist + " - " + track.track_name;
+                preview.appendChild(line);
+            });
+        })
+        .catch(err => {
+            console.error("Could not preview playlist: ", err);
+            preview.textContent = "Could not preview the playlist, please try again";
+            preview.style.display = "block";
+        })
+        .finally(() => {
+            btn.value = "Preview";
+            btn.disabled = false;
+        });
+ };
+
+  function streamStats(url, container_id){
+    var container = document.getElementById(container_id);
+    var source = new EventSource(url);
+
+    source.addEventListener("year", function(event){
+        var yearData = JSON.parse(event.data);
+        var block = document.createElement("div");
+        block.dataset.year = yearData.year;
+        block.innerHTML = yearData.html;
+        // Keep the most recent year first, whatever order the years arrive in
+        var next = Array.from(container.children).find(child => Number(child.dataset.year) < yearData.year);
+        container.insertBefore(block, next || null);
+    });
+    source.addEventListener("done", function(event){
+        source.close();
+        window.location.href = "/";
+    });
+    source.onerror = function(){
+        source.close();
+    };
+ };
+
+  function pollForCompleteStats(url, interval){
+    // Reload the page once every year's stats are in, if some were still being fetched when it was rendered
+    setTimeout(function poll(){
+        fetch(url)
+            .then(response => response.json())
+            .then(data => {
+                if (data.failed){
+                    document.getElementById("stats-partial").innerText =
+                        "Some years couldn't be loaded from Last.fm, try again in a moment.";
+                } else if (data.partial){
+                    setTimeout(poll, interval);
+                } else {
+                    window.location.href = "/";
+                }
+            })
+            .catch(err => {
+                console.error("Could not check for the rest of the stats: ", err);
+                setTimeout(poll, interval);
+            });
+    }, interval);
+ };
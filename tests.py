@@ -1,12 +1,37 @@
+import contextvars
+import json
 import logging
 import math
+import os
 import sys
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
-from unittest.mock import MagicMock, Mock
+from itertools import product
+from unittest.mock import AsyncMock, MagicMock, Mock, patch
 
+import pytz
+
+import controller
+import prewarm
+from clients import async_lastfm_client
+from clients import async_spotify_client
+from clients import cache
+from clients import cassette
+from clients import database
+from clients import fetch_planner
 from clients import lastfm_client
+from clients import lastfm_scheduler
+from clients import log_events
+from clients import monitoring_client
 from clients import spotify_client
+from clients import track_index
+from clients import profiling
+from clients import tracing
+from clients import submit_in_context
 
 ADD_TO_PLAYLIST_BATCH_LIMIT = 10
 logger = logging.getLogger()
@@ -77,6 +102,491 @@ class TestSpotifyClient(unittest.TestCase):
         sp.batch_add_tracks_to_playlist(playlist_id, mock_track_data)
         self.assertEqual(sp.spotify_client.playlist_add_items.call_count, batches)
 
+    def test_build_playlist_pipelined_preserves_order(self):
+        spotify_client.ADD_TO_PLAYLIST_BATCH_LIMIT = 100
+        mock_auth_manager = Mock()
+        sp = spotify_client.SpotifyClient(auth_manager=mock_auth_manager)
+        sp.spotify_client = Mock()
+        sp.spotify_client.current_user = MagicMock(return_value={"id": "user"})
+        sp.spotify_client.user_playlist_create = MagicMock(
+            return_value={"id": "123", "external_urls": {"spotify": "https://open.spotify.com/playlist/123"}}
+        )
+        track_uris = [f"spotify:track:{i}" for i in range(250)]
+        sp.iter_tracks_for_playlist = MagicMock(return_value=iter(track_uris))
+
+        playlist_id, playlist_url, track_count = sp.build_playlist_pipelined({}, {"username": "schiz0rr",
+                                                                                  "join_date": datetime(2006, 1, 12)})
+
+        self.assertEqual(playlist_id, "123")
+        self.assertEqual(track_count, len(track_uris))
+        self.assertEqual(sp.spotify_client.user_playlist_create.call_count, 1)
+        added = [uri for call in sp.spotify_client.playlist_add_items.call_args_list for uri in call.args[1]]
+        self.assertEqual(added, track_uris)
+        self.assertEqual(sp.spotify_client.playlist_add_items.call_count, 3)
+
+    def test_format_track_data(self):
+        def _artist_data(artist, track_names):
+            return {"artist": artist, "track_data": {"playcount": len(track_names), "tracks": [
+                {"track_name": track_name, "artist": artist, "date": None} for track_name in track_names
+            ]}}
+
+        data = [
+            {"day": datetime(2022, 1, 12), "data": [
+                _artist_data("Radiohead", ["Creep", "Airbag", "Creep"]),
+                _artist_data("Bjork", ["Joga"]),
+                _artist_data("Portishead", ["Roads"]),
+                _artist_data("Muse", []),
+            ]},
+            {"day": datetime(2021, 1, 12), "data": [
+                _artist_data("Bjork", ["Joga"]),
+                _artist_data("Air", ["La Femme d'Argent", "Playground Love"]),
+            ]},
+        ]
+
+        track_data = self.sp.format_track_data(data, playlist_order_recent_first=False)
+
+        self.assertEqual(list(track_data), [datetime(2021, 1, 12), datetime(2022, 1, 12)])
+        self.assertEqual(track_data[datetime(2021, 1, 12)], [
+            {"artist": "Air", "tracks": ["La Femme d'Argent", "Playground Love"], "playcount": 2},
+            {"artist": "Bjork", "tracks": ["Joga"], "playcount": 1},
+        ])
+        self.assertEqual(track_data[datetime(2022, 1, 12)], [
+            {"artist": "Radiohead", "tracks": ["Creep", "Airbag", "Creep"], "playcount": 3},
+            {"artist": "Bjork", "tracks": ["Joga"], "playcount": 1},
+            {"artist": "Portishead", "tracks": ["Roads"], "playcount": 1},
+        ])
+        self.assertEqual(data[0]["day"], datetime(2022, 1, 12))
+
+    def test_spotify_search_reuses_resolved_tracks(self):
+        mock_auth_manager = Mock()
+        sp = spotify_client.SpotifyClient(auth_manager=mock_auth_manager)
+        sp.spotify_client = Mock()
+        sp.spotify_client.search = MagicMock(return_value={"tracks": {"items": [
+            {"name": "Creep", "uri": "spotify:track:1", "artists": [{"name": "Radiohead"}]}
+        ]}})
+        sp.cache = Mock()
+        sp.cache.get_cached_spotify_search_result = MagicMock(return_value=None)
+        sp.track_index = Mock()
+        sp.track_index.get = MagicMock(return_value=None)
+
+        self.assertEqual(sp.spotify_search("Radiohead", "Creep"), "spotify:track:1")
+        self.assertIsNone(sp.spotify_search("Radiohead", "Creep", {hash("radioheadcreep")}))
+        self.assertEqual(sp.spotify_search("Radiohead", "Creep", {hash("bjorkjoga")}), "spotify:track:1")
+        self.assertEqual(sp.spotify_client.search.call_count, 1)
+        self.assertEqual(sp.track_index.set.call_count, 1)
+
+    def test_failed_retry_search_not_remembered(self):
+        sp = spotify_client.SpotifyClient(auth_manager=Mock())
+        sp.spotify_client = Mock()
+        sp.spotify_client.search = MagicMock(side_effect=[
+            {"tracks": {"items": []}}, None, {"tracks": {"items": []}},
+            {"tracks": {"items": [{"name": "Joga", "uri": "spotify:track:1", "artists": [{"name": "Bjork"}]}]}},
+        ])
+        sp.cache = Mock()
+        sp.cache.get_cached_spotify_search_result = MagicMock(return_value=None)
+        sp.track_index = Mock()
+        sp.track_index.get = MagicMock(return_value=None)
+
+        # The retry without brackets fails, so neither search is remembered as not found
+        self.assertIsNone(sp.resolve_track("Bjork", "Joga [Live]"))
+        self.assertEqual(sp.resolved_tracks, {})
+        self.assertEqual(sp.resolve_track("Bjork", "Joga [Live]")["uri"], "spotify:track:1")
+
+    def test_build_playlist_pipelined_no_tracks(self):
+        mock_auth_manager = Mock()
+        sp = spotify_client.SpotifyClient(auth_manager=mock_auth_manager)
+        sp.spotify_client = Mock()
+        sp.iter_tracks_for_playlist = MagicMock(return_value=iter([]))
+
+        self.assertEqual(sp.build_playlist_pipelined({}), (None, None, 0))
+        self.assertEqual(sp.spotify_client.user_playlist_create.call_count, 0)
+
+    @patch.object(spotify_client, "ADD_TO_PLAYLIST_BATCH_LIMIT", 2)
+    def test_build_playlist_pipelined_deletes_unfinished_playlist(self):
+        sp = spotify_client.SpotifyClient(auth_manager=Mock())
+        sp.spotify_client = Mock()
+        sp.spotify_client.current_user = MagicMock(return_value={"id": "user"})
+        sp.spotify_client.user_playlist_create = MagicMock(return_value={"id": "123", "external_urls": {}})
+
+        def _search_fails():
+            yield from ("spotify:track:1", "spotify:track:2", "spotify:track:3")
+            raise spotify_client.SpotifyForbiddenException()
+
+        sp.iter_tracks_for_playlist = MagicMock(return_value=_search_fails())
+        with self.assertRaises(spotify_client.SpotifyForbiddenException):
+            sp.build_playlist_pipelined({})
+        sp.spotify_client.current_user_unfollow_playlist.assert_called_once_with("123")
+        self.assertEqual(sp.spotify_client.playlist_add_items.call_count, 1)
+
+        searched = []
+        searched_when_added = []
+        futures = []
+
+        def _submit(executor, fn, *args):
+            future = submit_in_context(executor, fn, *args)
+            futures.append(future)
+            return future
+
+        def _search():
+            for i in range(10):
+                if i == 2:
+                    # Carry on once the first batch's add has failed
+                    wait(futures)
+                searched.append(i)
+                yield f"spotify:track:{i}"
+
+        def _add_fails(playlist_id, track_uris):
+            searched_when_added.append(list(searched))
+            raise Exception("502")
+
+        sp.spotify_client.playlist_add_items = MagicMock(side_effect=_add_fails)
+        sp.spotify_client.current_user_unfollow_playlist.reset_mock()
+        sp.iter_tracks_for_playlist = MagicMock(return_value=_search())
+        with patch.object(spotify_client, "submit_in_context", side_effect=_submit), \
+                self.assertRaisesRegex(Exception, "502"):
+            sp.build_playlist_pipelined({})
+        self.assertEqual(searched_when_added, [[0, 1]])
+        self.assertEqual(searched, [0, 1, 2])
+        sp.spotify_client.current_user_unfollow_playlist.assert_called_once_with("123")
+
+    def test_match_search_result(self):
+        search_result = {"tracks": {"items": [
+            {"name": "Creep (Live)", "uri": "spotify:track:1", "artists": [{"name": "Radiohead"}]},
+            {"name": "Creep", "uri": "spotify:track:2", "artists": [{"name": "Radiohead"}]},
+        ]}}
+        self.assertEqual(spotify_client.SpotifyClient.match_search_result("Radiohead", "Creep", search_result), (
+            {"uri": "spotify:track:2", "artist": "Radiohead", "track_name": "Creep"}, None
+        ))
+        self.assertEqual(spotify_client.SpotifyClient.match_search_result("Bjork", "Joga", search_result), (None, None))
+        self.assertEqual(
+            spotify_client.SpotifyClient.match_search_result("Bjork", "Joga [Remastered]", search_result),
+            (None, ("Bjork", "Joga "))
+        )
+
+
+class TestTrackIndex(unittest.TestCase):
+
+    def test_canonicalize(self):
+        self.assertEqual(track_index.canonicalize("Song (Album Version)"), track_index.canonicalize("Song"))
+        self.assertEqual(track_index.canonicalize("Song - Remastered 2011"), "song")
+        self.assertEqual(track_index.canonicalize("Song [feat. Someone]"), "song")
+        self.assertEqual(track_index.canonicalize("Don't Stop ft. Someone"), "dont stop")
+        self.assertNotEqual(track_index.canonicalize("Song (Live)"), track_index.canonicalize("Song"))
+        self.assertEqual(track_index.canonicalize("Song - Live at Wembley"), "song live at wembley")
+        self.assertEqual(track_index.canonicalize("Song - 2011 Remaster"), "song")
+        self.assertEqual(track_index.canonicalize("Song (Remastered Version) [Explicit]"), "song")
+        for version in ("Blue Monday (Remix)", "Blue Monday - 1988 Remix", "Blue Monday (Acoustic)",
+                        "Blue Monday - Instrumental", "Blue Monday (Reprise)", "Blue Monday - Radio Edit"):
+            self.assertNotEqual(track_index.canonicalize(version), "blue monday", version)
+        self.assertEqual(track_index.canonicalize("!!!"), "!!!")
+        self.assertNotEqual(track_index.canonicalize("???"), track_index.canonicalize("!!!"))
+
+    @patch.object(track_index, "TRACK_INDEX_WARM_SIZE", 1)
+    @patch.object(track_index, "TRACK_INDEX_PENDING_SIZE", 1)
+    def test_hits_written_in_batches(self):
+        index = type.__call__(track_index.TrackIndex)
+        index.warm_up_started = True
+        index._db = Mock()
+        entry = {"uri": "spotify:track:1", "resolved_artist": "Air", "resolved_track_name": "Playground Love",
+                 "date_cached": datetime.utcnow(), "hits": 0}
+        index._db.get_document = Mock(side_effect=lambda collection, key: dict(entry))
+
+        for track_name in ("warm", "cold"):
+            for _ in range(track_index.TRACK_INDEX_HIT_FLUSH - 1):
+                self.assertEqual(index.get("GB", "Air", track_name)["uri"], "spotify:track:1")
+        self.assertEqual(index._db.increment_field.call_count, 0)
+        self.assertEqual(index._db.get_document.call_count, 2)
+        index.get("GB", "Air", "cold")
+        index._db.increment_field.assert_called_once_with(
+            "track_index", index.get_key("GB", "Air", "cold"), "hits", track_index.TRACK_INDEX_HIT_FLUSH)
+        index.get("GB", "Air", "other")
+        index.get("GB", "Air", "another")
+        index._db.increment_field.assert_called_with("track_index", index.get_key("GB", "Air", "other"), "hits", 1)
+        index._db.set_document.assert_not_called()
+
+
+class TestCache(unittest.TestCase):
+
+    def test_db_client_created_on_first_use(self):
+        get_db_client = cache.get_db_client
+        cache.get_db_client = MagicMock()
+        try:
+            user_cache = cache.Cache()
+            self.assertEqual(cache.get_db_client.call_count, 0)
+            user_cache.get_user("schiz0rr")
+            user_cache.get_user("schiz0rr")
+            self.assertEqual(cache.get_db_client.call_count, 1)
+        finally:
+            cache.get_db_client = get_db_client
+
+
+class TestLocalFiles(unittest.TestCase):
+
+    def test_get_document_ids_since(self):
+        local_files = database.LocalFiles()
+        local_dir = local_files.local_dir
+        with tempfile.TemporaryDirectory() as temp_dir:
+            local_files.local_dir = temp_dir
+            try:
+                local_files.set_document("users", "recent", {"last_visited": datetime(2024, 3, 10), "data": [1]})
+                local_files.set_document("users", "old", {"last_visited": datetime(2024, 1, 1)})
+                local_files.set_document("users", "cached", {"date_cached": datetime(2024, 3, 9)})
+                self.assertEqual(
+                    local_files.get_document_ids_since("users", "last_visited", datetime(2024, 3, 1, tzinfo=pytz.UTC)),
+                    ["recent"]
+                )
+                with patch.object(cache, "get_db_client", return_value=local_files):
+                    self.assertEqual(cache.Cache().get_usernames_visited_since(datetime(2024, 3, 1)),
+                                     ["cached", "recent"])
+            finally:
+                local_files.local_dir = local_dir
+
+    def test_increment_field(self):
+        local_files = database.LocalFiles()
+        local_dir = local_files.local_dir
+        with tempfile.TemporaryDirectory() as temp_dir:
+            local_files.local_dir = temp_dir
+            try:
+                local_files.increment_field("track_index", "key", "hits", 2)
+                local_files.set_document("track_index", "key", {"uri": "spotify:track:1"})
+                local_files.increment_field("track_index", "key", "hits", 3)
+                self.assertEqual(local_files.get_document("track_index", "key"), {"uri": "spotify:track:1", "hits": 5})
+            finally:
+                local_files.local_dir = local_dir
+
+        firestore_client = database.FirestoreClient.__new__(database.FirestoreClient)
+        firestore_client.client = MagicMock()
+        firestore_client.increment_field("track_index", "key", "hits", 3)
+        doc_ref = firestore_client.client.collection.return_value.document.return_value
+        data = doc_ref.set.call_args.args[0]
+        self.assertEqual(data["hits"].value, 3)
+        self.assertEqual(doc_ref.set.call_args.kwargs, {"merge": True})
+
+    def test_firestore_get_document_ids_since_only_reads_ids(self):
+        firestore_client = database.FirestoreClient.__new__(database.FirestoreClient)
+        firestore_client.client = MagicMock()
+        query = firestore_client.client.collection.return_value.where.return_value.select.return_value
+        query.stream.return_value = [Mock(id="nickyreid")]
+        since = datetime(2024, 3, 1, tzinfo=pytz.UTC)
+        self.assertEqual(firestore_client.get_document_ids_since("users", "last_visited", since), ["nickyreid"])
+        field_filter = firestore_client.client.collection.return_value.where.call_args.kwargs["filter"]
+        self.assertEqual((field_filter.field_path, field_filter.op_string, field_filter.value),
+                         ("last_visited", ">=", since))
+        firestore_client.client.collection.return_value.where.return_value.select.assert_called_once_with(
+            ["__name__"]
+        )
+
+    def test_deserialize_only_parses_iso_dates(self):
+        data = database.LocalFiles.deserialize({"day": "2015-03-10T00:00:00", "tracks": [{"track_name": "1999"}]})
+        self.assertEqual(data["day"], datetime(2015, 3, 10))
+        self.assertEqual(data["tracks"], [{"track_name": "1999"}])
+
+    def test_concurrent_writes_to_a_document_are_all_kept(self):
+        local_files = database.LocalFiles()
+        local_dir = local_files.local_dir
+        with tempfile.TemporaryDirectory() as temp_dir:
+            local_files.local_dir = temp_dir
+            try:
+                with ThreadPoolExecutor(max_workers=8) as executor:
+                    for i in range(40):
+                        executor.submit(local_files.set_document, "artist_tags", "tags", {f"artist{i}": ["rock"]})
+                self.assertEqual(len(local_files.get_document("artist_tags", "tags")), 40)
+                self.assertEqual(os.listdir(os.path.join(temp_dir, "artist_tags")), ["tags.json"])
+            finally:
+                local_files.local_dir = local_dir
+
+
+class TestMonitoringClient(unittest.TestCase):
+
+    def test_distribution(self):
+        values = [0, 1, 3, 4, 2**30]
+        distribution = monitoring_client.Distribution()
+        for value in values:
+            distribution.add(value)
+        mean = sum(values) / len(values)
+        self.assertEqual(distribution.count, 5)
+        self.assertAlmostEqual(distribution.mean, mean)
+        self.assertAlmostEqual(distribution.sum_of_squared_deviation / sum((v - mean) ** 2 for v in values), 1)
+        self.assertEqual(distribution.bucket_counts[:4], [1, 1, 1, 1])
+        self.assertEqual(distribution.bucket_counts[-1], 1)
+
+    def test_registry_evicts_least_recently_updated_series(self):
+        registry = monitoring_client.MetricsRegistry(max_series=2, evict=True)
+        registry.increment("a")
+        registry.record("b", 10)
+        registry.increment("a")
+        registry.set_gauge("c", 1)
+        self.assertEqual((registry.counters, registry.gauges, registry.distributions), ({"a": 2}, {"c": 1}, {}))
+        self.assertEqual((registry.evicted, registry.dropped), (1, 0))
+
+    def test_registry_drops_new_series_when_full(self):
+        registry = monitoring_client.MetricsRegistry(max_series=2)
+        registry.increment("a")
+        registry.record("b", 10)
+        registry.increment("c")
+        registry.increment("a", 2)
+        counters, gauges, distributions, dropped = registry.swap()
+        self.assertEqual(counters, {"a": 3})
+        self.assertEqual(distributions["b"].count, 1)
+        self.assertEqual(dropped, 1)
+        self.assertEqual(registry.swap(), ({}, {}, {}, 0))
+
+    def test_flush_sends_batches(self):
+        monitoring = monitoring_client.GoogleMonitoringClient.__new__(monitoring_client.GoogleMonitoringClient)
+        monitoring.project_name = "projects/test"
+        monitoring.registry = monitoring_client.MetricsRegistry()
+        monitoring._client = MagicMock()
+        for i in range(monitoring_client.CREATE_TIME_SERIES_BATCH_LIMIT + 1):
+            monitoring.registry.increment(f"metric-{i}")
+        monitoring.registry.record("latency", 12)
+        monitoring.flush()
+        batches = [call.kwargs["time_series"] for call in monitoring._client.create_time_series.call_args_list]
+        self.assertEqual([len(batch) for batch in batches], [monitoring_client.CREATE_TIME_SERIES_BATCH_LIMIT, 2])
+        self.assertEqual(batches[-1][-1].metric.type, "custom.googleapis.com/distribution/latency")
+
+    def test_registries_write_separate_series(self):
+        series_keys = []
+        for registry in (monitoring_client.MetricsRegistry(), monitoring_client.MetricsRegistry()):
+            registry.increment("lastfm-request")
+            registry.record("latency", 12)
+            time_series = monitoring_client.GoogleMonitoringClient.build_time_series(
+                *registry.swap()[:3], registry.get_instance_label()
+            )
+            series_keys.append({(series.metric.type, tuple(series.metric.labels.items())) for series in time_series})
+        self.assertEqual(len(series_keys[0]), 2)
+        self.assertFalse(series_keys[0] & series_keys[1])
+
+    def test_render_prometheus_text(self):
+        text = monitoring_client.render_prometheus_text(
+            counters={"track-index-hit": 3, "track-index-miss": 1, "lastfm-request": 5},
+            gauges={"user-count": 2},
+            distributions={"get_stats": (2, 5.0, [0, 1, 0, 1] + [0] * 22)},
+        )
+        lines = text.splitlines()
+        self.assertEqual(monitoring_client.float_below(2.0), 1.9999999999999998)
+        self.assertIn("lasthop_lastfm_request_total 5", lines)
+        self.assertIn("lasthop_user_count 2", lines)
+        self.assertIn('lasthop_cache_hit_ratio{cache="track-index"} 0.7500', lines)
+        self.assertIn('lasthop_get_stats_bucket{le="1.9999999999999998"} 1', lines)
+        self.assertIn('lasthop_get_stats_bucket{le="7.999999999999999"} 2', lines)
+        self.assertIn('lasthop_get_stats_bucket{le="+Inf"} 2', lines)
+        self.assertIn("lasthop_get_stats_sum 5.0", lines)
+
+
+class TestTracing(unittest.TestCase):
+
+    def test_spans_recorded_from_worker_threads(self):
+        @tracing.traced("lookup")
+        def lookup(name):
+            return name.upper()
+
+        self.assertEqual(lookup("untraced"), "UNTRACED")
+        token = tracing.start_trace("test")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [submit_in_context(executor, lookup, name) for name in ("a", "b")]
+            self.assertEqual([future.result() for future in futures], ["A", "B"])
+        with tracing.span("search", "query"):
+            pass
+        trace = tracing.end_trace(token)
+        self.assertIsNone(tracing.current_trace.get())
+        self.assertEqual(sorted(span["detail"] for span in trace.spans), ["a", "b", "query"])
+        self.assertEqual(trace.summary()["lookup"][0], 2)
+        self.assertIn("lookup;dur=", trace.server_timing())
+
+    def test_lastfm_span_detail(self):
+        self.assertEqual(lastfm_client.LastfmClient.get_span_detail(
+            "user.getrecenttracks", {"username": "schiz0rr", "_from": 1, "to": 2, "page": 3}),
+            "user.getrecenttracks _from=1 page=3")
+
+
+class TestLogEvents(unittest.TestCase):
+
+    def test_events_sampled_within_budget_and_summarized(self):
+        logger = logging.getLogger("test_log_events")
+        logger.setLevel(logging.INFO)
+        token = log_events.start_request_log("GET /")
+        with patch.object(log_events, "LOG_SAMPLE_RATES", {"sampled": 0}), \
+                patch.object(log_events, "LOG_REQUEST_BUDGET", 2), \
+                self.assertLogs(logger, logging.INFO) as logs:
+            log_events.log_event(logger, "sampled", seconds=0.5)
+            log_events.log_event(logger, "unlogged", logging.DEBUG)
+            for page in range(3):
+                log_events.log_event(logger, "page", page=page, seconds=0.25)
+            log_events.log_event(logger, "failed", logging.WARNING)
+            log_events.set_request_fields(username="schiz0rr")
+            request_log = log_events.end_request_log(token)
+            log_events.log_request_summary(logger, request_log, status=200)
+
+        self.assertIsNone(log_events.current_request_log.get())
+        self.assertEqual([record.getMessage().split()[0] for record in logs.records],
+                         ["page", "page", "failed", "request.summary"])
+        self.assertEqual(logs.records[0].getMessage(), 'page {"page": 0, "seconds": 0.25}')
+        summary = logs.records[-1].json_fields
+        self.assertEqual(summary["events"], {"sampled": 1, "unlogged": 1, "page": 3, "failed": 1})
+        self.assertEqual(summary["event_seconds"], {"sampled": 0.5, "page": 0.75})
+        self.assertEqual((summary["username"], summary["status"]), ("schiz0rr", 200))
+        self.assertEqual((summary["logs_emitted"], summary["logs_dropped"]), (2, 1))
+
+    def test_end_request_log_in_another_context(self):
+        token = log_events.start_request_log("GET /stats/stream")
+        request_log = log_events.current_request_log.get()
+        self.assertIsNone(contextvars.Context().run(log_events.end_request_log, token))
+        self.assertIs(log_events.end_request_log(token), request_log)
+        self.assertIsNone(log_events.current_request_log.get())
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_profiled(self):
+        def work():
+            return sum(range(1000))
+
+        self.assertIs(profiling.profiled("work")(work), work)
+        settings = profiling.PROFILE_SECRET, profiling.PROFILE_DIR, profiling.PROFILE_MAX_FILES
+        with tempfile.TemporaryDirectory() as profile_dir:
+            profiling.PROFILE_SECRET, profiling.PROFILE_DIR, profiling.PROFILE_MAX_FILES = "s3cret", profile_dir, 2
+            try:
+                secret = Mock(return_value=None)
+                profiled_work = profiling.profiled("work", secret)(work)
+                self.assertEqual(profiled_work(), work())
+                self.assertEqual(os.listdir(profile_dir), [])
+                secret.return_value = "sécret"
+                self.assertEqual(profiled_work(), work())
+                self.assertEqual(os.listdir(profile_dir), [])
+                secret.return_value = "s3cret"
+                for _ in range(3):
+                    self.assertEqual(profiled_work(), work())
+                    time.sleep(0.002)
+                self.assertEqual(len(os.listdir(profile_dir)), 2)
+            finally:
+                profiling.PROFILE_SECRET, profiling.PROFILE_DIR, profiling.PROFILE_MAX_FILES = settings
+
+
+class TestCassette(unittest.TestCase):
+
+    def test_record_and_replay(self):
+        with tempfile.TemporaryDirectory() as cassette_dir:
+            recorded = cassette.requests.Response()
+            recorded.status_code = 200
+            recorded.headers["Content-Type"] = "application/json"
+            recorded._content = b'{"recenttracks": {"track": []}}'
+            recorder = cassette.CassetteAdapter(mode="record", cassette_dir=cassette_dir)
+            with patch.object(cassette.HTTPAdapter, "send", return_value=recorded) as send:
+                session = cassette.requests.Session()
+                session.mount("http://", recorder)
+                session.get("http://lastfm.test/2.0/?method=user.getrecenttracks&page=1&api_key=secret")
+                self.assertEqual(send.call_count, 1)
+
+            replayer = cassette.CassetteAdapter(mode="replay", cassette_dir=cassette_dir, replay_timing="fast")
+            session = cassette.requests.Session()
+            session.mount("http://", replayer)
+            response = session.get("http://lastfm.test/2.0/?api_key=other&page=1&method=user.getrecenttracks")
+            self.assertEqual(response.json(), {"recenttracks": {"track": []}})
+            self.assertEqual(response.headers["content-type"], "application/json")
+            self.assertNotIn("secret", open(replayer.get_path(replayer.get_key(response.request))).read())
+            with self.assertRaises(cassette.CassetteMissError):
+                session.get("http://lastfm.test/2.0/?method=user.getrecenttracks&page=2")
+
 
 class TestLastfmClient(unittest.TestCase):
 
@@ -86,6 +596,25 @@ class TestLastfmClient(unittest.TestCase):
         lastfm_join_date = datetime(2006, 1, 12)
         self.lfm_client = lastfm_client.LastfmClient(lastfm_username, lastfm_join_date)
 
+    def test_decode_recent_tracks_page(self):
+        page = json.dumps({"recenttracks": {"track": [
+            {"artist": {"mbid": "", "#text": "Lifetime"}, "streamable": "0", "mbid": "",
+             "image": [{"size": "small", "#text": "https://lastfm.freetls.fastly.net/i/u/34s/1.png"}],
+             "album": {"mbid": "", "#text": "Jersey's Best Dancers"}, "name": "Rutherford",
+             "url": "https://www.last.fm/music/Lifetime/_/Rutherford", "@attr": {"nowplaying": "true"}},
+            {"artist": {"mbid": "", "#text": "Lifetime"}, "streamable": "0", "mbid": "",
+             "image": [{"size": "small", "#text": "https://lastfm.freetls.fastly.net/i/u/34s/1.png"}],
+             "album": {"mbid": "", "#text": "Hello Bastards"}, "name": "Cut Up Kid",
+             "url": "https://www.last.fm/music/Lifetime/_/Cut+Up+Kid", "date": {"uts": "1700000000", "#text": ""}},
+        ], "@attr": {"user": "schiz0rr", "totalPages": "3", "page": "1", "perPage": "200", "total": "401"}}})
+        decoded = self.lfm_client.decode_recent_tracks_page(page.encode())
+        full = json.loads(page)
+        self.assertEqual(decoded["recenttracks"]["@attr"], full["recenttracks"]["@attr"])
+        self.assertEqual(self.lfm_client.recenttracks_response_summary(decoded["recenttracks"]["track"]),
+                         self.lfm_client.recenttracks_response_summary(full["recenttracks"]["track"]))
+        self.assertNotIn("image", decoded["recenttracks"]["track"][1])
+        self.assertEqual(self.lfm_client.recent_track_hashes(decoded), self.lfm_client.recent_track_hashes(full))
+
     def test_get_list_of_year_dates(self):
         self.lfm_client.join_date = datetime(2006, 12, 1)
         self.lfm_client.stats_start_date = datetime(2023, 12, 25)
@@ -103,3 +632,428 @@ class TestLastfmClient(unittest.TestCase):
         self.lfm_client.stats_start_date = datetime(2024, 2, 29)
         year_dates = self.lfm_client.get_list_of_year_dates()
         self.assertEqual(len(year_dates), 5)
+
+    @patch.object(lastfm_client, "ADD_ARTIST_TAGS", False)
+    def test_summarize_and_filter_for_timezone(self):
+        self.lfm_client.today = datetime(2024, 3, 10, 15)
+
+        def _scrobble(artist, track_name, date):
+            return {"artist": artist, "track_name": track_name, "timestamp": str(int(date.timestamp()))}
+
+        data = [
+            {"day": datetime(2023, 3, 10), "data": [
+                _scrobble("Bjork", "Joga", datetime(2023, 3, 10, 9, tzinfo=pytz.UTC)),
+                _scrobble("Air", "Playground Love", datetime(2023, 3, 10, 10, tzinfo=pytz.UTC)),
+                _scrobble("Bjork", "Hyperballad", datetime(2023, 3, 10, 11, tzinfo=pytz.UTC)),
+                _scrobble("Muse", "Hysteria", datetime(2023, 3, 11, 1, tzinfo=pytz.UTC)),
+            ]},
+            {"day": datetime(2022, 3, 10), "data": [
+                _scrobble("Muse", "Hysteria", datetime(2022, 3, 9, 23, tzinfo=pytz.UTC)),
+            ]},
+        ]
+
+        summary = self.lfm_client.summarize_and_filter_for_timezone(data)
+
+        self.assertEqual(len(summary), 1)
+        self.assertEqual(summary[0]["day"], datetime(2023, 3, 10, tzinfo=pytz.UTC))
+        self.assertEqual([d["artist"] for d in summary[0]["data"]], ["Bjork", "Air"])
+        self.assertEqual(summary[0]["data"][0]["track_data"]["playcount"], 2)
+        self.assertEqual(len(summary[0]["scrobble_list"]), 3)
+
+    def test_page_error_fails_the_year(self):
+        lfm_client = lastfm_client.LastfmClient("schiz0rr", datetime(2021, 1, 1), day=datetime(2024, 3, 10, 15))
+
+        def _page(date, page_num):
+            if page_num == 2:
+                return {"error": 8, "message": "Operation failed"}
+            return {"recenttracks": {"track": [{"name": f"song{page_num}"}], "@attr": {"totalPages": "3"}}}
+
+        lfm_client.lastfm_api_get_scrobbles = Mock(side_effect=_page)
+        with self.assertRaises(lastfm_client.LastfmResponseError):
+            lfm_client.get_lastfm_tracks_for_day(datetime(2023, 3, 10))
+        with self.assertRaises(lastfm_client.LastfmResponseError):
+            lfm_client.get_data_for_days_by_page([datetime(2023, 3, 10)], 2)
+
+    def test_private_user_has_no_scrobbles(self):
+        lfm_client = lastfm_client.LastfmClient("schiz0rr", datetime(2021, 1, 1), day=datetime(2024, 3, 10, 15))
+        lfm_client.lastfm_api_get_scrobbles = Mock(return_value={
+            "error": 17, "message": "Login: User required to be logged in"
+        })
+        self.assertEqual(lfm_client.get_lastfm_tracks_for_day(datetime(2023, 3, 10)), [])
+        self.assertEqual(lfm_client.get_data_for_days_by_page([datetime(2023, 3, 10)], 2),
+                         [{"day": datetime(2023, 3, 10), "data": []}])
+
+    @patch.object(lastfm_client, "ADD_ARTIST_TAGS", False)
+    def test_get_stats_streaming(self):
+        lfm_client = lastfm_client.LastfmClient("schiz0rr", datetime(2021, 1, 1), day=datetime(2024, 3, 10, 15))
+
+        def _page(date, page_num):
+            tracks = [{"artist": {"#text": f"Artist {i % 3}"}, "name": f"Track {page_num}-{i}",
+                       "date": {"uts": str(int(date.replace(hour=i, tzinfo=pytz.UTC).timestamp()))}}
+                      for i in range(4)]
+            tracks.append({"artist": {"#text": "Artist 9"}, "name": "Next day", "date": {
+                "uts": str(int(date.replace(day=date.day + 1, tzinfo=pytz.UTC).timestamp()))}})
+            return {"recenttracks": {"track": tracks, "@attr": {"totalPages": "2"}}}
+
+        year_docs = {}
+        lfm_client.lastfm_api_get_scrobbles = Mock(side_effect=_page)
+        lfm_client.cache = Mock()
+        lfm_client.cache.get_user_data = Mock(return_value={})
+        lfm_client.cache.set_user_year_data = Mock(
+            side_effect=lambda username, day, data: year_docs.update({day.year: {"day": day, "data": data}}))
+        lfm_client.cache.get_user_year_data = Mock(side_effect=lambda username, year: year_docs.get(year))
+
+        with patch.object(lastfm_client, "STREAM_RECENT_TRACKS", True):
+            streamed, _ = lfm_client.get_stats()
+            expected = lfm_client.summarize_and_filter_for_timezone(
+                lfm_client.get_data_for_days(lfm_client.get_list_of_year_dates()))
+            self.assertEqual(streamed, expected)
+            self.assertEqual([summary["day"].year for summary in streamed], [2023, 2022, 2021])
+            self.assertEqual(len(streamed[0]["scrobble_list"]), 8)
+            self.assertEqual(lfm_client.cache.set_user_data.call_args.kwargs["data_years"], [2023, 2022, 2021])
+
+            lfm_client.cache.get_user_data = Mock(return_value={
+                "date_cached": datetime.utcnow(), "tz_offset": 0, "data_years": [2023, 2022, 2021]})
+            cached, _ = lfm_client.get_stats()
+            self.assertEqual(cached, streamed)
+
+
+    @patch.object(lastfm_client, "ADD_ARTIST_TAGS", False)
+    def test_get_stats_deadline(self):
+        lfm_client = lastfm_client.LastfmClient("schiz0rr", datetime(2021, 1, 1), day=datetime(2024, 3, 10, 15))
+        slow_year = threading.Event()
+
+        def _get_data_for_day(day):
+            if day.year == 2022:
+                slow_year.wait(5)
+            timestamp = str(int(day.replace(hour=9, tzinfo=pytz.UTC).timestamp()))
+            return {"day": day, "data": [{"artist": "Air", "track_name": "Alone in Kyoto", "timestamp": timestamp}]}
+
+        cached = threading.Event()
+        lfm_client.get_data_for_day = Mock(side_effect=_get_data_for_day)
+        lfm_client.cache = Mock()
+        lfm_client.cache.get_user_data = Mock(return_value={})
+        lfm_client.cache_data = Mock(side_effect=lambda data, date_cached: cached.set())
+
+        summary, _ = lfm_client.get_stats(deadline=0.2)
+        self.assertTrue(lfm_client.partial)
+        self.assertEqual([year_data["day"].year for year_data in summary], [2023, 2021])
+        lfm_client.cache_data.assert_not_called()
+
+        start = time.perf_counter()
+        summary, _ = lfm_client.get_stats(deadline=0)
+        self.assertLess(time.perf_counter() - start, 0.1)
+        self.assertEqual(len(summary), 2)
+        self.assertEqual(lfm_client.get_data_for_day.call_count, 3)
+
+        slow_year.set()
+        self.assertTrue(cached.wait(5))
+        self.assertEqual(len(lfm_client.cache_data.call_args.args[0]), 3)
+
+    @patch.object(lastfm_client, "ADD_ARTIST_TAGS", False)
+    def test_get_stats_deadline_failed_year(self):
+        lfm_client = lastfm_client.LastfmClient("schiz0rr", datetime(2021, 1, 1), day=datetime(2024, 3, 11, 15))
+
+        def _get_data_for_day(day):
+            if day.year == 2022:
+                raise lastfm_client.LastfmResponseError("error 8")
+            timestamp = str(int(day.replace(hour=9, tzinfo=pytz.UTC).timestamp()))
+            return {"day": day, "data": [{"artist": "Air", "track_name": "Alone in Kyoto", "timestamp": timestamp}]}
+
+        lfm_client.get_data_for_day = Mock(side_effect=_get_data_for_day)
+        lfm_client.cache = Mock()
+        lfm_client.cache.get_user_data = Mock(return_value={})
+        lfm_client.cache_data = Mock()
+
+        summary, _ = lfm_client.get_stats(deadline=1)
+        self.assertEqual((lfm_client.partial, lfm_client.failed), (False, True))
+        self.assertEqual([year_data["day"].year for year_data in summary], [2023, 2021])
+        lfm_client.cache_data.assert_not_called()
+
+
+class TestController(unittest.TestCase):
+
+    def setUp(self):
+        controller.users_not_found.clear()
+
+    @patch.object(controller, "cache")
+    def test_get_or_create_user_caches_not_found(self, mock_cache):
+        mock_cache.get_user = MagicMock(return_value={})
+        with patch.object(lastfm_client.LastfmClient, "get_lastfm_user_data", return_value={}) as get_user_data:
+            self.assertEqual(controller.get_or_create_user("Typo "), {})
+            self.assertEqual(controller.get_or_create_user("typo"), {})
+        get_user_data.assert_called_once_with("typo")
+        with patch.object(lastfm_client.LastfmClient, "get_lastfm_user_data", return_value=None) as get_user_data:
+            controller.get_or_create_user("Unreachable")
+            controller.get_or_create_user("Unreachable")
+        self.assertEqual(get_user_data.call_count, 2)
+
+    @patch.object(controller, "cache")
+    def test_get_or_create_user_refreshes_stale_user_info(self, mock_cache):
+        user_info = {"username": "NickyReid", "total_tracks": 10}
+        fresh_user = {"user_info": user_info, "user_info_updated": datetime.utcnow()}
+        stale_user = {"user_info": user_info, "user_info_updated": datetime(2020, 1, 1, tzinfo=pytz.UTC)}
+        with patch.object(controller, "refresh_user_info_in_background") as refresh:
+            mock_cache.get_user = MagicMock(return_value=fresh_user)
+            self.assertEqual(controller.get_or_create_user("NickyReid"), fresh_user)
+            refresh.assert_not_called()
+            mock_cache.get_user = MagicMock(return_value=stale_user)
+            self.assertEqual(controller.get_or_create_user("NickyReid"), stale_user)
+            refresh.assert_called_once_with("nickyreid")
+        mock_cache.get_user.assert_called_once_with("nickyreid")
+
+        new_user_info = {"username": "NickyReid", "total_tracks": 11}
+        with patch.object(lastfm_client.LastfmClient, "get_lastfm_user_data", return_value=new_user_info):
+            controller.refresh_user_info("nickyreid")
+        mock_cache.update_user_info.assert_called_once_with("nickyreid", new_user_info)
+        self.assertNotIn("nickyreid", controller.user_info_refreshes)
+
+    @patch.object(controller, "cache")
+    def test_make_playlist_from_preview_skips_recently_played_fetch(self, mock_cache):
+        lastfm_user_data = {"username": "schiz0rr", "join_date": datetime(2006, 1, 12)}
+        sp = Mock(available_market="GB")
+        preview = {"resolved_tracks": {}, "tracklists": {(5, True, False, "week"): ["spotify:track:1"]},
+                   "recently_played_tracks": {}}
+        with patch.object(controller, "get_stats", return_value=([{"day": datetime(2020, 1, 1)}], None, False,
+                                                                 False)), \
+                patch.object(controller, "get_playlist_preview", return_value=preview), \
+                patch.object(spotify_client.SpotifyClient, "get_recently_played_tracks") as get_recently_played:
+            controller.make_playlist(sp, lastfm_user_data, 5, True, False, "week")
+            get_recently_played.assert_not_called()
+            self.assertEqual(sp.make_playlist.call_args.kwargs["track_uris"], ["spotify:track:1"])
+            controller.make_playlist(sp, lastfm_user_data, 6, True, False, "week")
+            get_recently_played.assert_called_once()
+
+    def test_stats_page_cache_keeps_fragments_without_stats(self):
+        controller.stats_pages.clear()
+        lastfm_user_data = {"username": "NickyReid", "join_date": datetime(2006, 1, 12)}
+        stats = [{"day": datetime(2020, 1, 1), "data": [{"artist": "Blur"}]}]
+        with patch.object(controller, "get_stats", return_value=(stats, datetime(2024, 1, 1), False, False)) as get:
+            page = controller.get_stats_page(lastfm_user_data, 0)
+            self.assertEqual(page["stats"], stats)
+            self.assertEqual(controller.get_stats_fragment(page, ("view", None), str, lastfm_user_data, 0), str(stats))
+            self.assertIsNone(next(iter(controller.stats_pages.values()))["stats"])
+
+            page = controller.get_stats_page(lastfm_user_data, 0)
+            self.assertEqual(controller.get_stats_fragment(page, ("view", None), len, lastfm_user_data, 0), str(stats))
+            get.assert_called_once()
+            self.assertEqual(controller.get_stats_fragment(page, ("count", None), len, lastfm_user_data, 0), 1)
+            self.assertEqual(controller.get_stats_fragment(page, ("years", None), len, lastfm_user_data, 0), 1)
+            self.assertEqual(get.call_count, 2)
+            self.assertIsNone(next(iter(controller.stats_pages.values()))["stats"])
+        controller.stats_pages.clear()
+
+    def test_stats_page_cache_is_bounded_by_fragment_size(self):
+        controller.stats_pages.clear()
+        with patch.object(controller, "STATS_PAGE_CACHE_MAX_BYTES", 100):
+            for username in ("a", "b", "c"):
+                page = controller.set_stats_page((username, 0, datetime(2024, 1, 1).date()), [], None)
+                controller.get_stats_fragment(page, ("view", None), lambda _stats: "x" * 60, {}, 0)
+        self.assertEqual([k[0] for k in controller.stats_pages], ["c"])
+        controller.stats_pages.clear()
+
+
+class TestPrewarm(unittest.TestCase):
+
+    user = {"user_info": {"username": "nickyreid", "join_date": datetime(2010, 1, 1), "total_tracks": 100},
+            "playlist_market": "ZA", "tz_offset": 120}
+    summary = [
+        {"day": datetime(year, 3, 10), "data": [
+            {"artist": f"Artist {(year + a) % 6}",
+             "track_data": {"tracks": [{"track_name": f"Track {t}"} for t in range(6)]}}
+            for a in range(4)
+        ]}
+        for year in range(2022, 2017, -1)
+    ]
+
+    @staticmethod
+    def new_spotify_client(searched: list) -> spotify_client.SpotifyClient:
+        sp = spotify_client.SpotifyClient(auth_manager=Mock())
+
+        def _resolve_track(artist, track_name):
+            searched.append((artist, track_name))
+            if track_name.endswith(("1", "4")):
+                return None
+            return {"uri": f"{artist}-{track_name}", "artist": artist, "track_name": track_name}
+        sp.resolve_track = _resolve_track
+        return sp
+
+    @patch.object(prewarm, "cache")
+    def test_prewarm_user_resolves_the_tracks_the_playlist_picks(self, mock_cache):
+        mock_cache.get_user = MagicMock(return_value=self.user)
+        prewarmed = []
+        with patch.object(lastfm_client.LastfmClient, "get_data_for_days", return_value=[]), \
+                patch.object(lastfm_client.LastfmClient, "summarize_and_filter_for_timezone",
+                             return_value=self.summary):
+            prewarm_client = self.new_spotify_client(prewarmed)
+            prewarm.prewarm_user("nickyreid", datetime(2023, 3, 10), prewarm_client, [2, 3])
+        self.assertEqual(prewarm_client.available_market, "ZA")
+
+        for tracks_per_year, order_recent_first, repeat_artists in product((2, 3), (True, False), (False, True)):
+            built = []
+            self.new_spotify_client(built).select_playlist_tracks(self.summary, tracks_per_year, order_recent_first,
+                                                                  repeat_artists)
+            self.assertTrue(set(built) <= set(prewarmed))
+
+    @patch.object(prewarm, "cache")
+    def test_prewarm_user_counts_track_index_hits_as_warm(self, mock_cache):
+        mock_cache.get_user = MagicMock(return_value=self.user)
+        sp = spotify_client.SpotifyClient(auth_manager=Mock())
+        sp.track_index = Mock()
+        sp.track_index.get = lambda market, artist, track_name: (
+            {"uri": f"{artist}-{track_name}", "artist": artist, "track_name": track_name}
+            if track_name == "Track 0" else None
+        )
+        sp.cache = Mock()
+        sp.cache.get_cached_spotify_search_result = MagicMock(return_value=None)
+        sp.spotify_client = Mock()
+        sp.spotify_client.search = lambda q, **kwargs: {"tracks": {"items": [{
+            "name": q.split(" Artist ")[0][len("track:"):], "uri": q, "artists": [{"name": "Artist " + q[-1]}],
+        }]}}
+        with patch.object(lastfm_client.LastfmClient, "get_data_for_days", return_value=[]), \
+                patch.object(lastfm_client.LastfmClient, "summarize_and_filter_for_timezone",
+                             return_value=self.summary):
+            warm, searched = prewarm.prewarm_user("nickyreid", datetime(2023, 3, 10), sp, [2])
+        index_hits = sum(1 for _, track_name in sp.resolved_tracks if track_name == "Track 0")
+        self.assertTrue(index_hits)
+        self.assertEqual((warm, searched), (index_hits, len(sp.resolved_tracks) - index_hits))
+
+    @patch.object(prewarm, "cache")
+    def test_prewarm_user_skips_users_without_a_playlist(self, mock_cache):
+        user = {key: value for key, value in self.user.items() if key != "playlist_market"}
+        mock_cache.get_user = MagicMock(return_value=user)
+        with patch.object(lastfm_client.LastfmClient, "get_data_for_days") as get_data:
+            self.assertEqual(prewarm.prewarm_user("nickyreid", datetime(2023, 3, 10), Mock(), [5]), (0, 0))
+        get_data.assert_not_called()
+
+    @patch.object(prewarm, "SpotifyClient")
+    @patch.object(prewarm, "SpotifyClientCredentials")
+    @patch.object(prewarm, "cache")
+    def test_main_prewarms_each_active_user(self, mock_cache, _credentials, _spotify_client):
+        mock_cache.get_usernames_visited_since = MagicMock(return_value=["a", "b", "c"])
+        results = {"a": (1, 2), "b": RuntimeError("Last.fm is down"), "c": (3, 0)}
+
+        def _prewarm_user(username, day, sp, tracks_per_year):
+            self.assertEqual(tracks_per_year, [5, 10])
+            if isinstance(results[username], Exception):
+                raise results[username]
+            return results[username]
+
+        with patch.object(sys, "argv", ["prewarm.py", "--days", "3", "--tracks-per-year", "5", "10"]), \
+                patch.object(prewarm, "prewarm_user", side_effect=_prewarm_user) as prewarm_user, \
+                self.assertLogs(prewarm.logger, logging.INFO) as logs:
+            prewarm.main()
+        self.assertEqual([call.args[0] for call in prewarm_user.call_args_list], ["a", "b", "c"])
+        self.assertIn("Coverage before pre-warm: 4/6 tracks (66.7%). 2 searches added to the cache", logs.output[-1])
+
+
+class TestLastfmScheduler(unittest.TestCase):
+
+    def test_slots_go_to_higher_priority_and_less_busy_users(self):
+        # Not the process's singleton
+        scheduler = type.__call__(lastfm_scheduler.LastfmScheduler, 2)
+        scheduler.acquire("interactive", "power")
+        scheduler.acquire("interactive", "power")
+        granted = []
+
+        def _request(user, priority):
+            with lastfm_scheduler.lastfm_priority(priority):
+                with scheduler.slot(user):
+                    granted.append((user, priority))
+
+        def _waiting():
+            return sum(len(requests) for users in scheduler.waiting.values() for requests in users.values())
+
+        threads = []
+        for user, priority in [("power", "background"), ("power", "interactive"), ("power", "recently_played"),
+                               ("light", "interactive")]:
+            threads.append(threading.Thread(target=_request, args=(user, priority)))
+            threads[-1].start()
+            while _waiting() < len(threads):
+                time.sleep(0.001)
+
+        scheduler.release("power")
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(granted, [("light", "interactive"), ("power", "interactive"),
+                                   ("power", "recently_played"), ("power", "background")])
+        scheduler.release("power")
+        self.assertEqual((scheduler.available, scheduler.in_flight), (2, {}))
+
+
+class TestFetchPlanner(unittest.TestCase):
+
+    def test_plan_fetch(self):
+        join_date = datetime(2010, 1, 1)
+        now = datetime(2024, 1, 1)
+        self.assertEqual(fetch_planner.plan_fetch(14, 20).strategy, "years")
+        self.assertEqual(fetch_planner.plan_fetch(14, 20, 800, join_date, now).strategy, "history")
+        self.assertEqual(fetch_planner.plan_fetch(14, 20, 100000, join_date, now).strategy, "years")
+        plan = fetch_planner.plan_fetch(14, 20, 6000000, join_date, now)
+        self.assertEqual((plan.strategy, plan.pages_per_year, plan.requests), ("pages", 6, 84))
+        self.assertLess(plan.rounds, 6)
+
+    def test_strategies_fetch_the_same_data(self):
+        lfm_client = lastfm_client.LastfmClient("schiz0rr", datetime(2020, 1, 1), day=datetime(2024, 3, 10, 15))
+        dates = lfm_client.get_list_of_year_dates()
+        timestamps = sorted((int(date.replace(hour=hour, tzinfo=pytz.UTC).timestamp()) + offset
+                             for date in dates for hour in (1, 12, 23) for offset in (0, 86400, -60)), reverse=True)
+
+        def _query(api_method, _from, to, page, **args):
+            tracks = [{"artist": {"#text": "Air"}, "name": f"Track {t}", "date": {"uts": str(t)}}
+                      for t in timestamps if _from <= t <= to]
+            return {"recenttracks": {"track": tracks[(page - 1) * 2:page * 2],
+                                     "@attr": {"totalPages": str(max(1, -(-len(tracks) // 2)))}}}
+
+        lfm_client.last_fm_api_query = Mock(side_effect=_query)
+        with patch.object(lastfm_client, "FETCH_PLANNER", True):
+            data = {}
+            for strategy in ("years", "pages", "history"):
+                plan = fetch_planner.FetchPlan(strategy, 4, 0, 0)
+                with patch.object(lfm_client, "get_fetch_plan", return_value=plan):
+                    data[strategy] = lfm_client.get_data_for_days(dates)
+        self.assertEqual(len(data["years"]), 4)
+        self.assertEqual([len(day["data"]) for day in data["years"]], [6, 6, 6, 6])
+        self.assertEqual(data["pages"], data["years"])
+        self.assertEqual(data["history"], data["years"])
+
+
+class TestAsyncLastfmClient(unittest.IsolatedAsyncioTestCase):
+
+    async def test_get_lastfm_tracks_for_day_async(self):
+        lfm_client = async_lastfm_client.AsyncLastfmClient(Mock(), "schiz0rr", datetime(2006, 1, 12))
+
+        def _page(page_num, total_pages):
+            return {"recenttracks": {"track": [{"name": f"song{page_num}"}], "@attr": {"totalPages": total_pages}}}
+
+        lfm_client.last_fm_api_query_async = AsyncMock(side_effect=lambda **query: _page(query["page"], 3))
+
+        tracks = await lfm_client.get_lastfm_tracks_for_day_async(datetime(2020, 1, 12))
+
+        self.assertEqual([track["name"] for track in tracks], ["song1", "song2", "song3"])
+        self.assertEqual(lfm_client.last_fm_api_query_async.call_count, 3)
+
+
+class TestAsyncSpotifyClient(unittest.IsolatedAsyncioTestCase):
+
+    async def test_select_playlist_tracks_async_picks_the_same_tracks(self):
+        # Artists that aren't repeated across years, as the prefetch searches each year's top artists regardless
+        summary = [{"day": year_data["day"], "data": [
+            dict(artist_data, artist=f"{artist_data['artist']} {year_data['day'].year}")
+            for artist_data in year_data["data"]
+        ]} for year_data in TestPrewarm.summary]
+        expected = TestPrewarm.new_spotify_client([]).select_playlist_tracks(summary, 3)
+
+        sp = async_spotify_client.AsyncSpotifyClient(Mock(), auth_manager=Mock())
+        prefetched = []
+
+        async def _resolve_track_async(artist, track_name):
+            prefetched.append((artist, track_name))
+            return TestPrewarm.new_spotify_client([]).resolve_track(artist, track_name)
+        sp.resolve_track_async = _resolve_track_async
+        searched = []
+        sp.resolve_track = TestPrewarm.new_spotify_client(searched).resolve_track
+
+        self.assertEqual(await sp.select_playlist_tracks_async(summary, 3), expected)
+        self.assertEqual(len(prefetched), 3 * len(summary))
+        self.assertTrue(set(prefetched) <= set(searched))